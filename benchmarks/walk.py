@@ -0,0 +1,63 @@
+"""Compare credential discovery with a plain ``os.walk`` against
+``PasspieStorage.walk`` on a generated database with a large git history.
+
+Usage::
+
+    make benchmark
+    PYTHONPATH=. python benchmarks/walk.py [--credentials N] [--git-objects N] [--repeat N]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from passpie.database import PasspieStorage
+
+
+def os_walk(path, extension=".pass"):
+    found = []
+    for rootdir, dirs, files in os.walk(path):
+        found.extend(os.path.join(rootdir, f) for f in files if f.endswith(extension))
+    return found
+
+
+def make_database(path, credentials, git_objects):
+    for number in range(credentials):
+        dirname = os.path.join(path, "name{}.example.com".format(number % 500))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, "login{}.pass".format(number)), "w") as f:
+            f.write("")
+
+    for number in range(git_objects):
+        dirname = os.path.join(path, ".git", "objects", "{:02x}".format(number % 256))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, "{:038x}".format(number)), "w") as f:
+            f.write("")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--credentials", type=int, default=5000)
+    parser.add_argument("--git-objects", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        make_database(path, args.credentials, args.git_objects)
+        storage = PasspieStorage(path)
+        assert sorted(os_walk(path)) == sorted(storage.walk())
+
+        for label, func in (("os.walk", lambda: os_walk(path)),
+                            ("PasspieStorage.walk", lambda: list(storage.walk()))):
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            print("{:<22} {:>8.2f} ms".format(label, best * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,21 @@ try:
 except ImportError:
     from distutils.spawn import find_executable as _which
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 try:
     basestring = basestring
 except NameError:
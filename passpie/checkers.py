@@ -24,3 +24,12 @@ def modified(credentials, days):
             modified_time = None
         result_credentials[i]['modified'] = modified_time
     return result_credentials
+
+
+def stale(columns, days, now=None):
+    """Return ``"N days ago"`` by fullname for credentials modified more
+    than days ago, computed over credential columns
+    """
+    ages = columns.ages(now)
+    return {columns.fullname(i): "{} days ago".format(ages[i])
+            for i in columns.older_than(days, now)}
@@ -1,4 +1,6 @@
 from functools import wraps
+import hashlib
+import itertools
 import json
 import logging
 import os
@@ -8,11 +10,12 @@ import sys
 import click
 import yaml
 
-from . import clipboard, completion, config, checkers, importers
-from .crypt import create_keys, encrypt, decrypt
+from . import clipboard, codec, completion, config, checkers, envelope, importers
+from .credential import make_fullname, split_fullname
+from .crypt import create_keys, encrypt, encrypt_many, decrypt, decrypt_many, BATCH_SIZE
 from .database import Database
 from .table import Table
-from .utils import genpass, ensure_dependencies
+from .utils import genpass, ensure_dependencies, chunked, replace_open
 from .history import clone
 from .validators import validate_config, validate_cols, validate_remote
 
@@ -59,6 +62,134 @@ def logging_exception(exceptions=[Exception]):
     return decorator
 
 
+def visible_fields(headers, hidden):
+    return [h for h in headers if h not in hidden]
+
+
+def jobs_option(func):
+    return click.option("-j", "--jobs", type=click.IntRange(min=1),
+                        help="Number of gpg processes run at once")(func)
+
+
+def data_key(db, passphrase=None):
+    """Return the data key of the envelope format, creating it when the
+    database has none and prompting for the passphrase to unwrap it
+    """
+    if db.has_data_key() and passphrase is None:
+        passphrase = click.prompt('Passphrase', hide_input=True)
+    key = db.data_key(passphrase, create=True)
+    if key is None:
+        raise click.ClickException(click.style('Could not decrypt the vault key', fg='red'))
+    return key
+
+
+def encrypt_password(db, password, passphrase=None):
+    if db.config.get('envelope'):
+        return envelope.seal(data_key(db, passphrase), password, db.config['envelope'])
+    try:
+        return encrypt(password, recipient=db.config['recipient'],
+                       homedir=db.config['homedir'], armor=db.config['armor'])
+    except ValueError as e:
+        raise click.ClickException(click.style(str(e), fg='red'))
+
+
+def encrypt_passwords(db, passwords, jobs=1, key=None):
+    """Return passwords encrypted in order. With the envelope format they
+    are sealed under the data key, or key, instead of each being an
+    OpenPGP message
+    """
+    if db.config.get('envelope'):
+        key = key or data_key(db)
+        return [envelope.seal(key, p, db.config['envelope']) for p in passwords]
+    try:
+        return encrypt_many(passwords,
+                            recipient=db.config['recipient'],
+                            homedir=db.config['homedir'],
+                            armor=db.config['armor'],
+                            jobs=jobs)
+    except ValueError as e:
+        raise click.ClickException(click.style(str(e), fg='red'))
+
+
+def decrypt_passwords(db, ciphertexts, passphrase, jobs=1):
+    """Return the plain texts of ciphertexts in order and None for each
+    one that could not be decrypted. Sealed passwords are opened with the
+    data key, unwrapped once, the others by up to jobs gpg sessions
+    """
+    passwords = [None] * len(ciphertexts)
+    sealed = [i for i, c in enumerate(ciphertexts) if envelope.is_sealed(c)]
+    if sealed:
+        keys = db.data_keys(passphrase)
+        for i in sealed:
+            passwords[i] = envelope.unseal_any(keys, ciphertexts[i])
+    others = [i for i, c in enumerate(ciphertexts) if not envelope.is_sealed(c)]
+    if others:
+        decrypted = decrypt_many([ciphertexts[i] for i in others],
+                                 recipient=db.config['recipient'],
+                                 passphrase=passphrase,
+                                 homedir=db.config['homedir'],
+                                 jobs=jobs)
+        for i, password in zip(others, decrypted):
+            passwords[i] = password
+    return passwords
+
+
+def decrypted_credentials(db, credentials, passphrase, jobs=1):
+    """Yield credentials with decrypted passwords in order. Each chunk of
+    credentials is decrypted by up to jobs gpg sessions at once
+    """
+    for chunk in chunked(credentials, BATCH_SIZE * jobs):
+        passwords = decrypt_passwords(db, [db.password(c) for c in chunk], passphrase, jobs)
+        failed = [c['fullname'] for c, p in zip(chunk, passwords) if p is None]
+        if failed:
+            message = u"Could not decrypt: {}".format(', '.join(failed))
+            raise click.ClickException(click.style(message, fg='red'))
+        for cred, password in zip(chunk, passwords):
+            cred["password"] = password
+            yield cred
+
+
+def write_export(filepath, credentials, as_json=False):
+    """Write the export file one credential at a time. The output is the
+    same as dumping the whole export dict at once
+    """
+    count = 0
+    if as_json:
+        filepath.write(u'{\n  "handler": "passpie",\n  "version": 1.0,\n  "credentials": [')
+        for cred in credentials:
+            cred["modified"] = str(cred["modified"])
+            content = json.dumps(dict(cred), indent=2).replace(u'\n', u'\n    ')
+            filepath.write((u',' if count else u'') + u'\n    ' + content)
+            count += 1
+        filepath.write(u'\n  ]\n}' if count else u']\n}')
+    else:
+        for cred in credentials:
+            filepath.write((u'' if count else u'credentials:\n') +
+                           yaml.dump([dict(cred)], default_flow_style=False))
+            count += 1
+        if not count:
+            filepath.write(u'credentials: []\n')
+        filepath.write(u'handler: passpie\nversion: 1.0\n')
+
+
+def edit_credential(credential):
+    """Return the name, login and comment of credential as edited in the
+    editor. Nothing is written here, so it works with every storage
+    """
+    fields = ('name', 'login', 'comment')
+    content = codec.YAML.dumps({k: credential.get(k) for k in fields})
+    edited = click.edit(content, extension='.yml')
+    try:
+        values = codec.YAML.loads(edited) if edited is not None else credential
+    except yaml.YAMLError as e:
+        message = u"Malformed credential: {}".format(e)
+        raise click.ClickException(click.style(message, fg='red'))
+    if not isinstance(values, dict) or not values.get('name') or values.get('login') is None:
+        message = u"Credential needs a name and a login"
+        raise click.ClickException(click.style(message, fg='red'))
+    return {k: values.get(k) for k in fields}
+
+
 class AliasGroup(click.Group):
 
     def get_command(self, ctx, name):
@@ -88,12 +219,15 @@ class AliasGroup(click.Group):
 @click.pass_context
 def cli(ctx, path, autopull, autopush, configuration, verbose):
     try:
-        ensure_dependencies()
+        ensure_dependencies(configuration.get('crypt_backend', 'gpg'))
     except RuntimeError as e:
         raise click.ClickException(click.style(str(e), fg='red'))
 
     # Setup database
-    db = Database(configuration)
+    try:
+        db = Database(configuration)
+    except ValueError as e:
+        raise click.ClickException(click.style(str(e), fg='red'))
     ctx.obj = db
 
     # Verbose
@@ -117,16 +251,25 @@ def cli(ctx, path, autopull, autopush, configuration, verbose):
 @click.pass_context
 def complete(ctx, db, shell_name):
     commands = cli.commands.keys()
-    script = completion.script(shell_name, db.path, commands)
+    # build the index completion reads fullnames from
+    db.credentials(fields=['fullname'])
+    script = completion.script(shell_name, db.path, commands,
+                               shard_length=db.config['shard_length'],
+                               index_path=db.index_filename())
     click.echo(script)
 
 
 @cli.command(name='list')
+@click.argument("prefix", required=False)
 @logging_exception()
 @pass_db
-def list_database(db):
+def list_database(db, prefix):
     """Print credential as a table"""
-    credentials = db.credentials()
+    fields = visible_fields(db.config['headers'], db.config['hidden'])
+    if prefix:
+        credentials = db.prefixed(prefix, fields=fields)
+    else:
+        credentials = db.credentials(fields=fields)
     if credentials:
         table = Table(
             db.config['headers'],
@@ -229,25 +372,32 @@ def add(db, fullname, password, random, pattern, interactive, comment, force, co
                                 show_default=False,
                                 default="")
 
-    found = db.credential(fullname=fullname)
-    if found and not force:
-        message = u"Credential {} already exists. --force to overwrite".format(
-            fullname)
-        raise click.ClickException(click.style(message, fg='yellow'))
-
-    encrypted = encrypt(password, recipient=db.config['recipient'], homedir=db.config['homedir'])
-    db.add(fullname=fullname, password=encrypted, comment=comment)
+    encrypted = encrypt_password(db, password)
 
+    # the editor may stay open for long, keep other writers out only after
     if interactive:
-        click.edit(filename=db.filename(fullname))
+        login, name = split_fullname(fullname)
+        edited = edit_credential(dict(name=name, login=login, comment=comment))
+        fullname = make_fullname(edited['login'], edited['name'])
+        comment = edited['comment']
+
+    # check, write and commit while other writers wait
+    with db.lock.exclusive():
+        found = db.credential(fullname=fullname)
+        if found and not force:
+            message = u"Credential {} already exists. --force to overwrite".format(
+                fullname)
+            raise click.ClickException(click.style(message, fg='yellow'))
+
+        db.add(fullname=fullname, password=encrypted, comment=comment)
+
+        message = u'Added {}{}'.format(fullname, ' [--force]' if force else '')
+        db.repo.commit(message=message)
 
     if copy:
         clipboard.copy(password)
         click.secho('Password copied to clipboard', fg='yellow')
 
-    message = u'Added {}{}'.format(fullname, ' [--force]' if force else '')
-    db.repo.commit(message=message)
-
 
 @cli.command(help="Copy credential password to clipboard/stdout")
 @click.argument("fullname")
@@ -266,11 +416,14 @@ def copy(db, fullname, passphrase, to, clear):
         message = u"Credential '{}' not found".format(fullname)
         raise click.ClickException(click.style(message, fg='red'))
 
-    encrypted = credential["password"]
-    decrypted = decrypt(encrypted,
-                        recipient=db.config['recipient'],
-                        passphrase=passphrase,
-                        homedir=db.config['homedir'])
+    encrypted = db.password(credential)
+    if envelope.is_sealed(encrypted):
+        decrypted = envelope.unseal_any(db.data_keys(passphrase), encrypted) or ''
+    else:
+        decrypted = decrypt(encrypted,
+                            recipient=db.config['recipient'],
+                            passphrase=passphrase,
+                            homedir=db.config['homedir'])
     if to == 'clipboard':
         clipboard.copy(decrypted, clear)
         if not clear:
@@ -295,6 +448,7 @@ def update(db, fullname, name, login, password, random, interactive, pattern, co
     if not credential:
         message = u"Credential '{}' not found".format(fullname)
         raise click.ClickException(click.style(message, fg='red'))
+    credential["password"] = db.password(credential)
 
     if random or pattern:
         pattern = pattern if pattern else db.config['genpass_pattern']
@@ -318,16 +472,15 @@ def update(db, fullname, name, login, password, random, interactive, pattern, co
         values["comment"] = click.prompt("Comment",
                                          default=credential["comment"])
 
+    if interactive:
+        values.update(edit_credential(values))
+
     if values != credential:
         if values["password"] != credential["password"]:
-            encrypted = encrypt(values["password"],
-                                recipient=db.config['recipient'],
-                                homedir=db.config['homedir'])
-            values['password'] = encrypted
-        db.update(fullname=fullname, values=values)
-        if interactive:
-            click.edit(filename=db.filename(fullname))
-        db.repo.commit(u'Updated {}'.format(credential['fullname']))
+            values['password'] = encrypt_password(db, values["password"])
+        with db.lock.exclusive():
+            db.update(fullname=fullname, values=values)
+            db.repo.commit(u'Updated {}'.format(credential['fullname']))
 
 
 @cli.command(help="Remove credential")
@@ -346,11 +499,10 @@ def remove(db, fullname, yes):
                     click.style(creds, 'yellow')),
                 abort=True
             )
-        for credential in credentials:
-            db.remove(credential['fullname'])
-
         fullnames = ', '.join(c['fullname'] for c in credentials)
-        db.repo.commit(u'Removed {}'.format(fullnames))
+        with db.batch(u'Removed {}'.format(fullnames)):
+            for credential in credentials:
+                db.remove(credential['fullname'])
 
 
 @cli.command(help="Search credentials by regular expressions")
@@ -358,7 +510,8 @@ def remove(db, fullname, yes):
 @logging_exception()
 @pass_db
 def search(db, regex):
-    credentials = db.matches(regex)
+    credentials = db.matches(regex, fields=visible_fields(db.config['headers'],
+                                                          ['password']))
     if credentials:
         table = Table(
             db.config['headers'],
@@ -373,25 +526,28 @@ def search(db, regex):
 @click.option("--full", is_flag=True, help="Show all entries")
 @click.option("--days", default=90, type=int, help="Elapsed days")
 @click.option("--passphrase", prompt="Passphrase", hide_input=True)
+@jobs_option
 @logging_exception()
 @pass_db
-def status(db, full, days, passphrase):
+def status(db, full, days, passphrase, jobs):
     ensure_passphrase(passphrase, db.config)
-    credentials = db.credentials()
-
-    for cred in credentials:
-        decrypted = decrypt(cred['password'],
-                            recipient=db.config['recipient'],
-                            passphrase=passphrase,
-                            homedir=db.config['homedir'])
-        cred["password"] = decrypted
+    jobs = jobs or db.config['jobs']
+    credentials = []
+    for cred in decrypted_credentials(db, db.iter_credentials(), passphrase, jobs):
+        # compare digests so plain text passwords are not all kept around
+        credentials.append({
+            'fullname': cred['fullname'],
+            'password': hashlib.sha256(cred['password'].encode('utf-8')).hexdigest(),
+            'modified': cred['modified'],
+        })
 
     if credentials:
         limit = db.config['status_repeated_passwords_limit']
         credentials = checkers.repeated(credentials, limit)
-        credentials = checkers.modified(credentials, days)
+        stale = checkers.stale(db.columns(), days)
 
         for c in credentials:
+            c['modified'] = stale.get(c['fullname'])
             if c['repeated']:
                 c['repeated'] = click.style(str(c['repeated']), 'red')
             if c['modified']:
@@ -403,13 +559,37 @@ def status(db, full, days, passphrase):
         click.echo(table.render(credentials))
 
 
+@cli.command(help="Show how long ago credentials were modified")
+@click.option("--days", type=int, help="List credentials modified more than days ago")
+@logging_exception()
+@pass_db
+def age(db, days):
+    columns = db.columns()
+    if days is None:
+        bounds = [30, 90, 180, 365]
+        counts = columns.histogram(bounds)
+        rows = [{'days': low, 'credentials': count}
+                for low, count in zip([0] + bounds, counts)]
+        headers = ['days', 'credentials']
+    else:
+        ages = columns.ages()
+        rows = [{'fullname': columns.fullname(i), 'days': ages[i]}
+                for i in columns.older_than(days)]
+        headers = ['fullname', 'days']
+
+    if rows:
+        table = Table(headers, table_format=db.config['table_format'], missing='')
+        click.echo(table.render(rows))
+
+
 @cli.command(name="import", help="Import credentials from path")
 @click.argument("filepath", type=click.Path(readable=True, exists=True))
 @click.option("-I", "--importer", type=click.Choice(importers.get_names()),
               help="Specify an importer")
 @click.option("--cols", help="CSV expected columns", callback=validate_cols)
+@jobs_option
 @pass_db
-def import_database(db, filepath, importer, cols):
+def import_database(db, filepath, importer, cols, jobs):
     if cols:
         importer = importers.get(name='csv')
         kwargs = {'cols': cols}
@@ -418,88 +598,73 @@ def import_database(db, filepath, importer, cols):
         kwargs = {}
 
     if importer:
-        credentials = importer.handle(filepath, **kwargs)
-        for cred in credentials:
-            encrypted = encrypt(cred['password'],
-                                recipient=db.config['recipient'],
-                                homedir=db.config['homedir'])
-            cred['password'] = encrypted
-        db.insert_multiple(credentials)
-        db.repo.commit(message=u'Imported credentials from {}'.format(filepath))
+        credentials = list(importer.handle(filepath, **kwargs))
+        encrypted = encrypt_passwords(db, [cred['password'] for cred in credentials],
+                                      jobs or db.config['jobs'])
+        for cred, password in zip(credentials, encrypted):
+            cred['password'] = password
+        with db.batch(u'Imported credentials from {}'.format(filepath)):
+            db.insert_multiple(credentials)
 
 
 @cli.command(name="export", help="Export credentials in plain text")
-@click.argument("filepath", type=click.File("w"))
+@click.argument("filepath", type=click.Path(dir_okay=False, writable=True, allow_dash=True))
 @click.option("--json", "as_json", is_flag=True, help="Export as JSON")
 @click.option("--passphrase", prompt="Passphrase", hide_input=True)
+@jobs_option
 @logging_exception()
 @pass_db
-def export_database(db, filepath, as_json, passphrase):
+def export_database(db, filepath, as_json, passphrase, jobs):
     ensure_passphrase(passphrase, db.config)
-    credentials = db.all()
-
-    for cred in credentials:
-        decrypted = decrypt(cred['password'],
-                            recipient=db.config['recipient'],
-                            passphrase=passphrase,
-                            homedir=db.config['homedir'])
-        cred["password"] = decrypted
-
-    if as_json:
-        for cred in credentials:
-            cred["modified"] = str(cred["modified"])
-        dict_content = {
-            'handler': 'passpie',
-            'version': 1.0,
-            'credentials': [dict(x) for x in credentials],
-        }
-        content = json.dumps(dict_content, indent=2)
+    credentials = decrypted_credentials(db, db.iter_credentials(sorted=False), passphrase,
+                                        jobs or db.config['jobs'])
+    if filepath == '-':
+        write_export(click.get_text_stream('stdout'), credentials, as_json=as_json)
     else:
-        dict_content = {
-            'handler': 'passpie',
-            'version': 1.0,
-            'credentials': [dict(x) for x in credentials],
-        }
-        content = yaml.dump(dict_content, default_flow_style=False)
-
-    filepath.write(content)
+        # a failed decryption leaves any previous export untouched
+        with replace_open(filepath) as f:
+            write_export(f, credentials, as_json=as_json)
 
 
 @cli.command(help='Renew passpie database and re-encrypt credentials')
 @click.option("--passphrase", prompt="Passphrase", hide_input=True)
+@jobs_option
 @logging_exception()
 @pass_db
-def reset(db, passphrase):
+def reset(db, passphrase, jobs):
     ensure_passphrase(passphrase, db.config)
-    credentials = db.credentials()
-    if credentials:
-        # decrypt all credentials
-        for cred in credentials:
-            decrypted = decrypt(cred['password'],
-                                recipient=db.config['recipient'],
-                                passphrase=passphrase,
-                                homedir=db.config['homedir'])
-            cred["password"] = decrypted
-
-        # recreate keys if exists
-        if db.has_keys():
-            new_passphrase = click.prompt('New passphrase',
-                                          hide_input=True,
-                                          confirmation_prompt=True)
-            create_keys(new_passphrase)
-
-        # encrypt passwords
-        for cred in credentials:
-            cred['password'] = encrypt(cred['password'],
-                                       recipient=db.config['recipient'],
-                                       homedir=db.config['homedir'])
-
-        # remove old and insert re-encrypted credentials
-        db.purge()
-        db.insert_multiple(credentials)
-
-        # commit
-        db.repo.commit(message='Reset database')
+    jobs = jobs or db.config['jobs']
+    # read, re-encrypt and write while other writers wait
+    with db.lock.exclusive():
+        credentials = db.iter_credentials()
+        first = next(credentials, None)
+        if first is not None:
+            # recreate keys if exists
+            if db.has_keys():
+                new_passphrase = click.prompt('New passphrase',
+                                              hide_input=True,
+                                              confirmation_prompt=True)
+                create_keys(new_passphrase)
+
+            # re-encrypt passwords a chunk at a time, only ciphertexts are kept.
+            # The envelope format also gets a new data key
+            key = envelope.new_key() if db.config.get('envelope') else None
+            reencrypted = []
+            decrypted = decrypted_credentials(db, itertools.chain([first], credentials),
+                                              passphrase, jobs)
+            for chunk in chunked(decrypted, BATCH_SIZE * jobs):
+                passwords = encrypt_passwords(db, [cred['password'] for cred in chunk], jobs, key)
+                for cred, password in zip(chunk, passwords):
+                    cred['password'] = password
+                reencrypted.extend(chunk)
+
+            # replace old with re-encrypted credentials in a single commit. The
+            # new data key only replaces the old one once they are written
+            with db.batch('Reset database'):
+                if key is not None:
+                    db.set_data_key(key)
+                db.purge()
+                db.insert_multiple(reencrypted)
 
 
 @cli.command(help='Remove all credentials from database')
@@ -512,8 +677,37 @@ def purge(db, yes):
             alert = u"Purge '{}' credentials".format(len(db.credentials()))
             yes = click.confirm(click.style(alert, 'yellow'), abort=True)
         if yes:
-            db.purge()
-            db.repo.commit(message='Purged database')
+            with db.lock.exclusive():
+                db.purge()
+                db.repo.commit(message='Purged database')
+
+
+@cli.command(help='Compact database storage')
+@logging_exception()
+@pass_db
+def compact(db):
+    with db.lock.exclusive():
+        if not db.compact():
+            message = u"Storage '{}' does not support compaction".format(
+                db.config.get('storage'))
+            raise click.ClickException(click.style(message, fg='yellow'))
+        db.repo.commit(message='Compacted database')
+
+
+@cli.command(name="migrate-format", help='Rewrite credential files in another format')
+@click.argument("name", type=click.Choice(codec.get_names()))
+@logging_exception()
+@pass_db
+def migrate_format(db, name):
+    with db.lock.exclusive():
+        if not db.migrate_format(name):
+            message = u"Storage '{}' does not support credential formats".format(
+                db.config.get('storage'))
+            raise click.ClickException(click.style(message, fg='yellow'))
+        local_config = config.read(db.path)
+        local_config['format'] = name
+        config.create(db.path, defaults=local_config)
+        db.repo.commit(message=u'Migrated credentials to {}'.format(name))
 
 
 @cli.command(help='Shows passpie database changes history')
@@ -0,0 +1,120 @@
+from datetime import datetime
+import json
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+DATETIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S")
+
+
+def encode_cache_value(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def decode_cache_value(obj):
+    if "__datetime__" in obj:
+        for fmt in DATETIME_FORMATS:
+            try:
+                return datetime.strptime(obj["__datetime__"], fmt)
+            except ValueError:
+                continue
+    return obj
+
+
+class YAMLCodec(object):
+    name = "yaml"
+    binary = False
+
+    def match(self, content):
+        return True
+
+    def loads(self, content):
+        return yaml.load(content, Loader=SafeLoader)
+
+    def dumps(self, data):
+        return yaml.dump(data, Dumper=SafeDumper, default_flow_style=False)
+
+
+class JSONCodec(object):
+    name = "json"
+    binary = False
+
+    def match(self, content):
+        return content[:1] in (b"{", u"{")
+
+    def loads(self, content):
+        if isinstance(content, bytes):
+            content = content.decode("utf-8")
+        return json.loads(content, object_hook=decode_cache_value)
+
+    def dumps(self, data):
+        return json.dumps(data, default=encode_cache_value, indent=2, sort_keys=True)
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+    binary = True
+
+    def match(self, content):
+        # fixmap, map16 and map32 headers
+        head = bytearray(content[:1]) if isinstance(content, bytes) else b""
+        return bool(head) and (0x80 <= head[0] <= 0x8f or head[0] in (0xde, 0xdf))
+
+    def loads(self, content):
+        return msgpack.unpackb(content, raw=False, object_hook=decode_cache_value)
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True, default=encode_cache_value)
+
+
+YAML = YAMLCodec()
+JSON = JSONCodec()
+MSGPACK = MsgpackCodec()
+
+
+def get_instances():
+    codecs = [JSON, YAML]
+    if msgpack is not None:
+        codecs.insert(0, MSGPACK)
+    return codecs
+
+
+def get_names():
+    return [c.name for c in get_instances()]
+
+
+def get(name):
+    try:
+        return next(c for c in get_instances() if c.name == name)
+    except StopIteration:
+        return None
+
+
+def detect(content):
+    """Return the codec content was written with. YAML is the fallback
+    since it is the format of vaults written by older versions
+    """
+    return next(c for c in get_instances() if c.match(content))
+
+
+def loads(content):
+    codec = detect(content)
+    try:
+        return codec.loads(content)
+    except ValueError:
+        # a YAML flow mapping also starts with "{"
+        if codec is YAML:
+            raise
+        return YAML.loads(content)
@@ -0,0 +1,144 @@
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .credential import make_fullname
+from .index import NO_TIME, timestamp
+
+
+MAGIC = b"PPCL"
+VERSION = 1
+# credential, name and login counts, then the fingerprint of the files
+HEADER = struct.Struct("<4sIIII20s")
+DAY = 86400 * 10 ** 6
+
+
+def to_array(typecode, content):
+    values = array(typecode)
+    if hasattr(values, "frombytes"):
+        values.frombytes(content)
+    else:
+        values.fromstring(content)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def to_bytes(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+
+class Columns(object):
+    """Modified timestamps, in microseconds since the epoch, and name and
+    login ids of credentials kept as one array per field. Age queries run
+    over the arrays, with NumPy when it is installed, without building
+    credential records
+    """
+
+    def __init__(self, modified, name_ids, login_ids, names, logins, fingerprint=b""):
+        if numpy is not None:
+            modified = numpy.asarray(modified, dtype=numpy.int64)
+        self.modified = modified
+        self.name_ids = name_ids
+        self.login_ids = login_ids
+        self.names = names
+        self.logins = logins
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, credentials, fingerprint=b""):
+        names, logins = {}, {}
+        modified, name_ids, login_ids = array("q"), array("I"), array("I")
+        for credential in credentials:
+            modified.append(timestamp(credential.get("modified")))
+            name_ids.append(names.setdefault(credential["name"], len(names)))
+            login_ids.append(logins.setdefault(credential["login"], len(logins)))
+        return cls(modified, name_ids, login_ids,
+                   sorted(names, key=names.get), sorted(logins, key=logins.get),
+                   fingerprint)
+
+    def __len__(self):
+        return len(self.name_ids)
+
+    def fullname(self, position):
+        return make_fullname(self.logins[self.login_ids[position]],
+                             self.names[self.name_ids[position]])
+
+    def ages(self, now=None):
+        """Return the age in days of each credential, -1 when it has no
+        modified date
+        """
+        now = timestamp(now or datetime.now())
+        if numpy is not None:
+            return numpy.where(self.modified == NO_TIME, -1, (now - self.modified) // DAY)
+        return array("q", (-1 if m == NO_TIME else (now - m) // DAY for m in self.modified))
+
+    def older_than(self, days, now=None):
+        """Return the positions of credentials modified more than days ago"""
+        cutoff = timestamp(now or datetime.now()) - days * DAY
+        if numpy is not None:
+            return numpy.flatnonzero((self.modified != NO_TIME) &
+                                     (self.modified < cutoff)).tolist()
+        return [i for i, m in enumerate(self.modified) if m != NO_TIME and m < cutoff]
+
+    def histogram(self, bounds, now=None):
+        """Return the number of credentials younger than bounds[0] days,
+        then between each pair of bounds and then at least bounds[-1] days
+        old. Credentials without a modified date are not counted
+        """
+        ages = self.ages(now)
+        if numpy is not None:
+            buckets = numpy.searchsorted(bounds, ages[ages >= 0], side="right")
+            return numpy.bincount(buckets, minlength=len(bounds) + 1).tolist()
+        counts = [0] * (len(bounds) + 1)
+        for age in ages:
+            if age >= 0:
+                counts[bisect_right(bounds, age)] += 1
+        return counts
+
+    def dumps(self):
+        modified = array("q", self.modified.tolist() if numpy is not None else self.modified)
+        return b"".join([
+            HEADER.pack(MAGIC, VERSION, len(self), len(self.names), len(self.logins),
+                        self.fingerprint),
+            to_bytes(modified),
+            to_bytes(self.name_ids),
+            to_bytes(self.login_ids),
+            b"".join(s.encode("utf-8") + b"\0" for s in self.names),
+            b"".join(s.encode("utf-8") + b"\0" for s in self.logins),
+        ])
+
+
+def load(filename):
+    """Return the Columns of the file or None when it is missing or not a
+    valid columns file
+    """
+    try:
+        with open(filename, "rb") as f:
+            content = f.read()
+        magic, version, count, name_count, login_count, fingerprint = HEADER.unpack_from(content, 0)
+        if magic != MAGIC or version != VERSION:
+            return None
+        start = HEADER.size
+        ends = [start + count * 8, start + count * 12, start + count * 16]
+        strings = content[ends[2]:].split(b"\0")
+        if len(strings) != name_count + login_count + 1:
+            return None
+        strings = [s.decode("utf-8") for s in strings[:-1]]
+        return Columns(to_array("q", content[start:ends[0]]),
+                       to_array("I", content[ends[0]:ends[1]]),
+                       to_array("I", content[ends[1]:ends[2]]),
+                       strings[:name_count], strings[name_count:],
+                       fingerprint)
+    except (IOError, OSError, struct.error, ValueError):
+        return None
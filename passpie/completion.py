@@ -1,3 +1,6 @@
+import re
+
+
 BASH = """
 function _passpie()
 {
@@ -73,19 +76,27 @@ _passpie() {
 }
 """
 
+# name directories live one level down, under their shard directory
+SHARDED_NAMES = "find {config_path} -mindepth 2 -maxdepth 2 -type d ! -path '*/.*' | sed 's|.*/||'"
+
 SHELLS = ['zsh', 'fish', 'bash']
 
 
-def script(shell_name, config_path, commands):
+def script(shell_name, config_path, commands, shard_length=0, index_path=None):
     text = ''
     if shell_name == 'zsh':
         text = ZSH.replace('{commands}', '\n'.join(commands))
-        text = text.replace('{config_path}', config_path)
     elif shell_name == 'fish':
         text = FISH.replace('{commands}', ' '.join(commands))
-        text = text.replace('{config_path}', config_path)
     elif shell_name == 'bash':
         text = BASH.replace('{commands}', ' '.join(commands))
-        text = text.replace('{config_path}', config_path)
 
+    if shard_length:
+        text = text.replace('ls -1 {config_path}', SHARDED_NAMES)
+    if index_path:
+        # fullnames are NUL terminated strings of the binary index file
+        text = re.sub(r"grep -EhriIo ('[^']*') \{config_path\}",
+                      lambda m: "grep -Ehiao {} {}".format(m.group(1), index_path),
+                      text)
+    text = text.replace('{config_path}', config_path)
     return text
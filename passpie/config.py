@@ -5,8 +5,10 @@ import re
 
 import yaml
 
+from . import codec
 from .utils import tempdir
-from .crypt import ensure_keys, import_keys, get_default_recipient
+from .crypt import ensure_keys, import_keys, get_default_recipient, use
+from .database import DURABILITY
 
 
 HOMEDIR = os.path.expanduser("~")
@@ -16,6 +18,7 @@ DEFAULT = {
     'key_length': 4096,
     'genpass_pattern': r'[a-z]{10} [-_+=*&%$#]{10} [A-Z]{10}',
     'homedir': os.path.join(os.path.expanduser('~/.gnupg')),
+    'crypt_backend': 'gpg',
     'recipient': None,
     'table_format': 'fancy_grid',
     'headers': ['name', 'login', 'password', 'comment'],
@@ -26,10 +29,22 @@ DEFAULT = {
     'status_repeated_passwords_limit': 5,
     'copy_timeout': 0,
     'extension': '.pass',
+    'storage': 'directory',
+    'cache_path': os.path.join(HOMEDIR, '.cache', 'passpie'),
+    'load_workers': 1,
+    'load_pool': 'thread',
+    'jobs': 1,
+    'split_passwords': False,
+    'format': 'yaml',
+    'armor': True,
+    'shard_length': 0,
+    'durability': 'safe',
+    'envelope': None,
     'recipient': None,
     'hidden': ['password'],
     'hidden_string': u'********'
 }
+LOAD_POOLS = ('thread', 'process')
 
 
 def is_repo_url(path):
@@ -46,7 +61,7 @@ def read(path, filename='.config'):
             path = os.path.join(path, '.config')
         with open(path) as config_file:
             content = config_file.read()
-        configuration = yaml.load(content)
+        configuration = codec.YAML.loads(content)
     except IOError:
         logging.debug(u'config file "{}" not found'.format(path))
         return {}
@@ -59,14 +74,39 @@ def read(path, filename='.config'):
 def create(path, defaults={}, filename='.config'):
     config_path = os.path.join(os.path.expanduser(path), filename)
     with open(config_path, 'w') as config_file:
-        config_file.write(yaml.dump(defaults, default_flow_style=False))
+        config_file.write(codec.YAML.dumps(defaults))
+
+
+def validate(configuration):
+    """Raise ValueError for settings the commands cannot use, before any
+    of them runs with a bad worker count, pool or durability
+    """
+    for key in ('load_workers', 'jobs'):
+        value = configuration.get(key, 1)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise ValueError(u"Invalid {} '{}'. Must be an integer of at least 1".format(
+                key, value))
+    if configuration.get('load_pool', 'thread') not in LOAD_POOLS:
+        raise ValueError(u"Unknown load_pool '{}'. Choose from: {}".format(
+            configuration['load_pool'], ", ".join(LOAD_POOLS)))
+    if configuration.get('durability', 'safe') not in DURABILITY:
+        raise ValueError(u"Unknown durability '{}'. Choose from: {}".format(
+            configuration['durability'], ", ".join(DURABILITY)))
+    return configuration
 
 
 def setup_crypt(configuration):
+    path = os.path.expanduser(configuration['path'])
+    # a new database only gets its keys file from init
+    keyring = os.path.join(path, '.keys') if os.path.isdir(path) else None
+    use(configuration.get('crypt_backend', 'gpg'), cache=configuration.get('cache_path'),
+        keyring=keyring)
     keys_filepath = ensure_keys(configuration['path'])
     if keys_filepath:
         configuration['homedir'] = tempdir()
         import_keys(keys_filepath, configuration['homedir'])
     if not configuration['recipient']:
-        configuration['recipient'] = get_default_recipient(configuration['homedir'])
+        # the temporary homedir changes every run, the keys file does not
+        configuration['recipient'] = get_default_recipient(configuration['homedir'],
+                                                           keyring=keys_filepath)
     return configuration
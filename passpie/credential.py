@@ -1,22 +1,24 @@
 import re
 
+from ._compat import MutableMapping
 
-def split_fullname(fullname):
-    regex = re.compile(r'(?:(?P<login>.+?(?:\@.+?)?)@(?P<name>.+?$))')
-    regex_name_only = re.compile(r'(?P<at>@)?(?P<name>.+?$)')
 
-    if regex.match(fullname):
-        mobj = regex.match(fullname)
-    elif regex_name_only.match(fullname):
-        mobj = regex_name_only.match(fullname)
-    else:
+FULLNAME_RE = re.compile(r'(?:(?P<login>.+?(?:\@.+?)?)@(?P<name>.+?$))')
+NAME_ONLY_RE = re.compile(r'(?P<at>@)?(?P<name>.+?$)')
+FIELDS = ('fullname', 'name', 'login', 'password', 'comment', 'modified')
+
+
+def split_fullname(fullname):
+    mobj = FULLNAME_RE.match(fullname) or NAME_ONLY_RE.match(fullname)
+    if mobj is None:
         raise ValueError("Not a valid name")
 
-    if mobj.groupdict().get('at'):
+    groups = mobj.groupdict()
+    if groups.get('at'):
         login = ""
     else:
-        login = mobj.groupdict().get('login')
-    name = mobj.groupdict().get("name")
+        login = groups.get('login')
+    name = groups.get("name")
 
     return login, name
 
@@ -24,3 +26,75 @@ def split_fullname(fullname):
 def make_fullname(login, name):
     fullname = u"{}@{}".format("" if login is None else login, name)
     return fullname
+
+
+class Credential(MutableMapping):
+    """Credential record with a slot per known field and the same keys as
+    the dict stored on disk. Unknown fields are kept in ``extra``
+    """
+    __slots__ = FIELDS + ('extra', '_sort_key')
+
+    def __init__(self, values=(), **kwargs):
+        self.extra = None
+        self._sort_key = None
+        self.update(values, **kwargs)
+
+    @property
+    def sort_key(self):
+        if self._sort_key is None:
+            self._sort_key = self["name"] + self["login"]
+        return self._sort_key
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in FIELDS:
+            setattr(self, key, value)
+            if key in ('name', 'login'):
+                self._sort_key = None
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+            self._sort_key = None
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        for key in self.extra or ():
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return "Credential({!r})".format(dict(self))
+
+    def copy(self):
+        return Credential(self)
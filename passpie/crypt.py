@@ -1,6 +1,12 @@
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import NamedTemporaryFile, gettempdir, mkdtemp
+import base64
+import json
+import logging
 import os
 import re
+import shutil
+import threading
 
 from . import process
 from .utils import tempdir
@@ -24,6 +30,15 @@ Passphrase: {}
 %commit
 %echo done
 """
+BASE64_RE = re.compile(r'^[A-Za-z0-9+/]+={0,2}$')
+# memory backed directory for the plain text files of a batch decryption.
+# Without it, every ciphertext is decrypted by its own gpg process instead
+PLAINTEXT_DIR = '/dev/shm'
+BATCH_SIZE = 500
+# files whose changes can change the default recipient of a homedir
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'secring.gpg', 'private-keys-v1.d',
+                 'passpie.keys')
+RECIPIENTS_FILENAME = 'recipients.json'
 
 
 def ensure_keys(path):
@@ -83,111 +98,422 @@ def export_secret_keys(homedir, passphrase):
     return output
 
 
-def create_keys(passphrase, path=None, key_length=4096):
-    homedir = tempdir()
-    command = [
-        which('gpg2') or which('gpg'),
-        '--batch',
-        '--no-tty',
-        '--homedir', homedir,
-        '--gen-key',
-    ]
-    key_input = make_key_input(passphrase, key_length)
-    output, error = process.call(command, input=key_input)
-    if path:
-        with open(path, 'w') as keysfile:
-            keysfile.write(export_keys(homedir))
-            keysfile.write(export_secret_keys(homedir, passphrase))
-    else:
-        return output
+def binary_packets(data):
+    """Return the raw OpenPGP packets of a compact ciphertext, or None when
+    data is ASCII armored
+    """
+    if BASE64_RE.match(data):
+        try:
+            packets = base64.b64decode(data)
+        except (TypeError, ValueError):
+            return None
+        if is_binary(packets):
+            return packets
+    return None
 
 
-def import_keys(keys_path, homedir):
-    command = [
-        which('gpg2') or which('gpg'),
-        '--no-tty',
-        '--batch',
-        '--no-secmem-warning',
-        '--no-permission-warning',
-        '--no-mdc-warning',
-        '--homedir', homedir,
-        '--import', keys_path
-    ]
-    output, err = process.call(command)
-    return homedir
+def is_binary(content):
+    # every OpenPGP packet tag has its high bit set
+    head = bytearray(content[:1])
+    return bool(head) and bool(head[0] & 0x80)
 
 
-def get_default_recipient(homedir, secret=False):
-    command = [
-        which('gpg2') or which('gpg'),
-        '--no-tty',
-        '--batch',
-        '--no-secmem-warning',
-        '--no-permission-warning',
-        '--no-mdc-warning',
-        '--list-{}-keys'.format('secret' if secret else 'public'),
-        '--fingerprint',
-        '--homedir', homedir,
-    ]
-    output, _ = process.call(command)
-    for line in output.splitlines():
-        try:
-            mobj = re.search(r'(([0-9A-F]{4}\s*?){10})', line)
-            fingerprint = mobj.group().replace(' ', '')
-            return fingerprint
-        except (AttributeError, IndexError):
-            continue
-    return ''
+def unpack_ciphertext(data):
+    """Return the bytes to store on disk for ciphertext data"""
+    packets = binary_packets(data)
+    return packets if packets is not None else data.encode('utf-8')
 
 
-def encrypt(data, recipient, homedir):
-    recipient = recipient if recipient else get_default_recipient(homedir)
-    command = [
-        which('gpg2') or which('gpg'),
-        '--batch',
-        '--no-tty',
-        '--always-trust',
-        '--armor',
-        '--recipient', recipient,
-        '--homedir', homedir,
-        '--encrypt'
-    ]
-    output, _ = process.call(command, input=data)
-    return output
+def pack_ciphertext(content):
+    """Return the ciphertext text of bytes written by unpack_ciphertext"""
+    if is_binary(content):
+        return base64.b64encode(content).decode('ascii')
+    return content.decode('utf-8')
 
 
-def decrypt(data, recipient, passphrase, homedir):
+def pool_map(func, items, jobs=1):
+    """Return func applied to items in order, running up to jobs calls at
+    once. The first exception, in item order, is raised
+    """
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def encrypt_many(datas, recipient, homedir, armor=True, jobs=1):
+    """Encrypt datas with up to jobs encryptions running at once and return
+    the ciphertexts in order
+    """
     recipient = recipient if recipient else get_default_recipient(homedir)
-    with NamedTemporaryFile("w", delete=False) as armored_file:
-        armored_file.write(data)
+    return pool_map(lambda data: encrypt(data, recipient, homedir, armor=armor),
+                    list(datas), jobs)
+
+
+def decrypted_files(status):
+    """Return the names of the files a ``--multifile --status-fd`` gpg
+    session decrypted
+    """
+    decrypted = set()
+    filename, okay = None, False
+    for line in status.splitlines():
+        fields = line.split(' ', 3)
+        if fields[0] != '[GNUPG:]' or len(fields) < 2:
+            continue
+        if fields[1] == 'FILE_START' and len(fields) == 4:
+            filename, okay = fields[3], False
+        elif fields[1] == 'DECRYPTION_OKAY':
+            okay = filename is not None
+        elif fields[1] in ('DECRYPTION_FAILED', 'BADMDC'):
+            filename = None
+        elif fields[1] == 'FILE_DONE':
+            if okay:
+                decrypted.add(filename)
+            filename, okay = None, False
+    return decrypted
+
+
+def decrypt_session(ciphertexts, passphrase, homedir):
+    """Decrypt ciphertexts with a single gpg process. Return the plain
+    texts in order and None for each ciphertext gpg did not decrypt
+    """
+    workdir = mkdtemp(dir=PLAINTEXT_DIR)
+    try:
+        filenames = []
+        for position, data in enumerate(ciphertexts):
+            packets = binary_packets(data)
+            filename = os.path.join(workdir, '{}.{}'.format(
+                position, 'asc' if packets is None else 'gpg'))
+            with open(filename, 'w' if packets is None else 'wb') as f:
+                f.write(data if packets is None else packets)
+            filenames.append(filename)
         command = [
             which('gpg2') or which('gpg'),
             '--no-version',
             '--no-tty',
+            '--batch',
+            '--yes',
             '--pinentry-mode', 'loopback',
             '--passphrase-fd', '0',
             '--always-trust',
             '--homedir', homedir,
-            '--armor',
-            '--decrypt', armored_file.name,
+            '--status-fd', '1',
+            '--multifile',
+            '--decrypt',
+        ] + filenames
+        status, _ = process.call(command, input=passphrase)
+        decrypted = decrypted_files(status or '')
+
+        results = []
+        for filename in filenames:
+            if filename not in decrypted:
+                results.append(None)
+                continue
+            with open(os.path.splitext(filename)[0], 'rb') as f:
+                results.append(f.read().decode('utf-8'))
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class Backend(object):
+    """Interface of the crypt backends. ``use`` selects the backend the
+    module functions run on
+    """
+    name = None
+
+    def encrypt(self, data, recipient, homedir, armor=True):
+        """Return data encrypted to recipient, ASCII armored or as base64
+        encoded binary packets. Raise ValueError when there is no key to
+        encrypt to
+        """
+        raise NotImplementedError
+
+    def decrypt(self, data, recipient, passphrase, homedir):
+        """Return the plain text of data or an empty string when it could
+        not be decrypted
+        """
+        raise NotImplementedError
+
+    def decrypt_many(self, ciphertexts, recipient, passphrase, homedir, jobs=1):
+        """Return the plain texts of ciphertexts in order and None for
+        each ciphertext that could not be decrypted
+        """
+        raise NotImplementedError
+
+    def create_keys(self, passphrase, path=None, key_length=4096):
+        """Generate a key pair and write the public and secret keys to
+        the keys file path
+        """
+        raise NotImplementedError
+
+    def import_keys(self, keys_path, homedir):
+        """Import the keys file keys_path into homedir and return homedir"""
+        raise NotImplementedError
+
+    def get_default_recipient(self, homedir, secret=False):
+        """Return the fingerprint of the first key in homedir"""
+        raise NotImplementedError
+
+
+class GPGBackend(Backend):
+    """Runs the gpg binary for every operation"""
+    name = "gpg"
+
+    def create_keys(self, passphrase, path=None, key_length=4096):
+        homedir = tempdir()
+        command = [
+            which('gpg2') or which('gpg'),
+            '--batch',
+            '--no-tty',
+            '--homedir', homedir,
+            '--gen-key',
         ]
+        key_input = make_key_input(passphrase, key_length)
+        output, error = process.call(command, input=key_input)
+        if path:
+            with open(path, 'w') as keysfile:
+                keysfile.write(export_keys(homedir))
+                keysfile.write(export_secret_keys(homedir, passphrase))
+        else:
+            return output
 
-    output, error = process.call(command, input=passphrase)
-    if not output or error:
-        # Fallback command in case that GPG version < 2.1
-        # with versions lower than 2.1 it was possible to
-        # decrypt armored data with passphrase as an option
-        # now passphrases have to piped loopback
+    def import_keys(self, keys_path, homedir):
+        command = [
+            which('gpg2') or which('gpg'),
+            '--no-tty',
+            '--batch',
+            '--no-secmem-warning',
+            '--no-permission-warning',
+            '--no-mdc-warning',
+            '--homedir', homedir,
+            '--import', keys_path
+        ]
+        output, err = process.call(command)
+        return homedir
+
+    def get_default_recipient(self, homedir, secret=False):
+        command = [
+            which('gpg2') or which('gpg'),
+            '--no-tty',
+            '--batch',
+            '--no-secmem-warning',
+            '--no-permission-warning',
+            '--no-mdc-warning',
+            '--list-{}-keys'.format('secret' if secret else 'public'),
+            '--fingerprint',
+            '--homedir', homedir,
+        ]
+        output, _ = process.call(command)
+        for line in output.splitlines():
+            try:
+                mobj = re.search(r'(([0-9A-F]{4}\s*?){10})', line)
+                fingerprint = mobj.group().replace(' ', '')
+                return fingerprint
+            except (AttributeError, IndexError):
+                continue
+        return ''
+
+    def encrypt(self, data, recipient, homedir, armor=True):
+        recipient = recipient if recipient else get_default_recipient(homedir)
         command = [
             which('gpg2') or which('gpg'),
             '--batch',
             '--no-tty',
             '--always-trust',
-            '--passphrase', passphrase,
+            '--armor',
             '--recipient', recipient,
             '--homedir', homedir,
-            '-o', '-',
-            '--decrypt', "-",
+            '--encrypt'
         ]
-        output, error = process.call(command, input=data)
-    return output
+        if armor:
+            output, _ = process.call(command, input=data)
+            return output
+        command.remove('--armor')
+        output, _ = process.call(command, input=data, binary=True)
+        return base64.b64encode(output).decode('ascii')
+
+    def decrypt(self, data, recipient, passphrase, homedir):
+        recipient = recipient if recipient else get_default_recipient(homedir)
+        packets = binary_packets(data)
+        with NamedTemporaryFile("w" if packets is None else "wb", delete=False) as armored_file:
+            armored_file.write(data if packets is None else packets)
+            command = [
+                which('gpg2') or which('gpg'),
+                '--no-version',
+                '--no-tty',
+                '--pinentry-mode', 'loopback',
+                '--passphrase-fd', '0',
+                '--always-trust',
+                '--homedir', homedir,
+                '--armor',
+                '--decrypt', armored_file.name,
+            ]
+            if packets is not None:
+                command.remove('--armor')
+
+        output, error = process.call(command, input=passphrase)
+        if not output or error:
+            # Fallback command in case that GPG version < 2.1
+            # with versions lower than 2.1 it was possible to
+            # decrypt armored data with passphrase as an option
+            # now passphrases have to piped loopback
+            command = [
+                which('gpg2') or which('gpg'),
+                '--batch',
+                '--no-tty',
+                '--always-trust',
+                '--passphrase', passphrase,
+                '--recipient', recipient,
+                '--homedir', homedir,
+                '-o', '-',
+                '--decrypt', "-",
+            ]
+            output, error = process.call(command, input=data if packets is None else packets)
+        return output
+
+    def decrypt_many(self, ciphertexts, recipient, passphrase, homedir, jobs=1):
+        """Decrypt ciphertexts in gpg sessions of at most ``BATCH_SIZE`` of
+        them, split over up to jobs sessions running at once. Return the plain
+        texts in order and None for each ciphertext that could not be
+        decrypted. Ciphertexts a session fails on are tried again one by one
+        with ``decrypt``. Sessions write plain texts to files, so they only
+        run when ``PLAINTEXT_DIR`` is there to keep them off the disk
+        """
+        ciphertexts = list(ciphertexts)
+        if not os.path.isdir(PLAINTEXT_DIR):
+            outputs = pool_map(lambda data: decrypt(data, recipient, passphrase, homedir),
+                               ciphertexts, jobs)
+            return [output if output else None for output in outputs]
+        size = max(1, min(BATCH_SIZE, -(-len(ciphertexts) // max(jobs, 1))))
+        sessions = pool_map(lambda start: decrypt_session(ciphertexts[start:start + size],
+                                                          passphrase, homedir),
+                            list(range(0, len(ciphertexts), size)), jobs)
+        results = [result for session in sessions for result in session]
+
+        failed = [position for position, result in enumerate(results) if result is None]
+        outputs = pool_map(lambda position: decrypt(ciphertexts[position], recipient,
+                                                    passphrase, homedir),
+                           failed, jobs)
+        for position, output in zip(failed, outputs):
+            results[position] = output if output else None
+        return results
+
+
+BACKENDS = ("gpg", "openpgp")
+backend = GPGBackend()
+cache_path = None
+recipients = None
+recipients_lock = threading.Lock()
+
+
+def use(name, cache=None, keyring=None):
+    """Run the module functions on backend name. ``gpg`` runs the gpg
+    binary, ``openpgp`` runs them in-process on the keys of the database
+    keys file keyring, and raises ValueError when it has no usable key.
+    Default recipients are also cached in the cache directory
+    """
+    global backend, cache_path, recipients
+    cache = os.path.expanduser(cache) if cache else None
+    if cache != cache_path:
+        cache_path, recipients = cache, None
+    if name not in BACKENDS:
+        raise ValueError("Unknown crypt backend '{}', choose one of: {}".format(
+            name, ", ".join(BACKENDS)))
+    if name == "openpgp":
+        from .openpgp import OpenPGPBackend
+        backend = OpenPGPBackend()
+        if keyring is not None:
+            backend.check(keyring)
+    else:
+        backend = GPGBackend()
+    return backend
+
+
+def create_keys(passphrase, path=None, key_length=4096):
+    return backend.create_keys(passphrase, path=path, key_length=key_length)
+
+
+def import_keys(keys_path, homedir):
+    return backend.import_keys(keys_path, homedir)
+
+
+def keyring_stamp(paths):
+    """Return the modification time and size of the existing files in
+    paths, None when there are none
+    """
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        stamp.append([os.path.realpath(path), stat.st_mtime, stat.st_size])
+    return stamp or None
+
+
+def load_recipients():
+    global recipients
+    if recipients is None:
+        recipients = {}
+        if cache_path:
+            try:
+                with open(os.path.join(cache_path, RECIPIENTS_FILENAME)) as f:
+                    recipients = json.load(f)
+            except (IOError, OSError, ValueError):
+                logging.debug(u'recipients cache not found in "{}"'.format(cache_path))
+    return recipients
+
+
+def save_recipients():
+    if not cache_path:
+        return
+    filename = os.path.join(cache_path, RECIPIENTS_FILENAME)
+    temporary = u'{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        with open(temporary, 'w') as f:
+            json.dump(recipients, f)
+        os.rename(temporary, filename)
+    except (IOError, OSError) as e:
+        logging.debug(u'could not save recipients cache: {}'.format(e))
+
+
+def get_default_recipient(homedir, secret=False, keyring=None):
+    """Return the fingerprint of the first key in homedir. Fingerprints
+    are cached in-process and in the cache directory until the keyring,
+    the keyring files of homedir by default, changes
+    """
+    paths = [keyring] if keyring else [os.path.join(homedir, n) for n in KEYRING_FILES]
+    stamp = keyring_stamp(paths)
+    if stamp is None:
+        return backend.get_default_recipient(homedir, secret=secret)
+
+    kind = 'secret' if secret else 'public'
+    key = u'{}:{}:{}'.format(backend.name, kind, '|'.join(path for path, _, _ in stamp))
+    with recipients_lock:
+        cached = load_recipients().get(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    fingerprint = backend.get_default_recipient(homedir, secret=secret)
+    if fingerprint:
+        with recipients_lock:
+            load_recipients()[key] = [stamp, fingerprint]
+            # temporary homedirs are not used again by later runs
+            if keyring or not os.path.realpath(homedir).startswith(os.path.realpath(gettempdir())):
+                save_recipients()
+    return fingerprint
+
+
+def encrypt(data, recipient, homedir, armor=True):
+    return backend.encrypt(data, recipient, homedir, armor=armor)
+
+
+def decrypt(data, recipient, passphrase, homedir):
+    return backend.decrypt(data, recipient, passphrase, homedir)
+
+
+def decrypt_many(ciphertexts, recipient, passphrase, homedir, jobs=1):
+    return backend.decrypt_many(ciphertexts, recipient, passphrase, homedir, jobs=jobs)
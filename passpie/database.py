@@ -1,84 +1,1228 @@
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from operator import attrgetter, itemgetter
+import hashlib
+import inspect
+import json
 import logging
 import os
+import re
 import shutil
+import sqlite3
 
-from tinydb import TinyDB, Storage, where, Query
-import yaml
+from tinydb import TinyDB, Storage, Query
+from tinydb.database import Table
+from tinydb.middlewares import Middleware
+from tinydb.utils import LRUCache
 
-from .utils import mkdir_open
+from . import codec, columns, envelope, index
+from ._compat import scandir
+from .utils import mkdir_open, fsync_dir, FileLock
 from .history import Repository
-from .credential import split_fullname, make_fullname
+from .credential import Credential, split_fullname, make_fullname
+from .codec import encode_cache_value, decode_cache_value
+from .crypt import pack_ciphertext, unpack_ciphertext
+
+
+DURABILITY = ("fast", "safe", "paranoid")
+
+
+def load_credential(docpath):
+    with open(docpath, "rb") as f:
+        return codec.loads(f.read())
 
 
 class PasspieStorage(Storage):
     extension = ".pass"
+    cache_path = None
+    workers = 1
+    pool = "thread"
+    split_passwords = False
+    format = "yaml"
+    shard_length = 0
+    durability = "safe"
+    passwords_dirname = ".passwords"
 
     def __init__(self, path):
         super(PasspieStorage, self).__init__()
         self.path = path
+        self._entries = None
+        self._synced = False
+        self._ids = {}
+        self._staged = []
+        self._dirty_dirs = set()
+        self._stale = set()
+
+    @property
+    def cache_filename(self):
+        if self.cache_path:
+            digest = hashlib.sha1(os.path.abspath(self.path).encode("utf-8"))
+            filename = digest.hexdigest() + ".json"
+            return os.path.join(os.path.expanduser(self.cache_path), filename)
+
+    @property
+    def index_filename(self):
+        if self.cache_filename:
+            return os.path.splitext(self.cache_filename)[0] + ".idx"
+
+    @property
+    def columns_filename(self):
+        if self.cache_filename:
+            return os.path.splitext(self.cache_filename)[0] + ".col"
+
+    def load_cache(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.cache_filename:
+                try:
+                    with open(self.cache_filename) as f:
+                        self._entries = json.load(f, object_hook=decode_cache_value)
+                except (IOError, ValueError):
+                    logging.debug(u"cache file {} not loaded".format(self.cache_filename))
+        return self._entries
+
+    def save_cache(self, entries):
+        self._entries = entries
+        if self.cache_filename:
+            try:
+                content = json.dumps(entries, default=encode_cache_value)
+                with mkdir_open(self.cache_filename, "w") as f:
+                    f.write(content)
+            except (IOError, OSError, TypeError):
+                logging.debug(u"cache file {} not saved".format(self.cache_filename))
+            self.save_index(entries)
+
+    def save_index(self, entries):
+        records = [(os.path.relpath(docpath, self.path), entry[0], entry[1])
+                   for docpath, entry in sorted(entries.items(), key=lambda e: sort_key(e[1][1]))]
+        fingerprint = self.fingerprint((p, e[0]) for p, e in entries.items())
+        self.save_index_file(self.index_filename, index.dumps(records))
+        self.save_index_file(self.columns_filename, columns.Columns.build(
+            (r[2] for r in records), fingerprint).dumps())
+
+    def save_index_file(self, filename, content):
+        try:
+            with mkdir_open(filename, "wb") as f:
+                f.write(content)
+        except (IOError, OSError):
+            logging.debug(u"index file {} not saved".format(filename))
+
+    def fingerprint(self, keys):
+        """Return a digest of ``(docpath, stat key)`` pairs"""
+        digest = hashlib.sha1()
+        for docpath, key in sorted(keys):
+            relpath = os.path.relpath(docpath, self.path)
+            digest.update(u"{}\0{!r}\0".format(relpath, list(key)).encode("utf-8"))
+        return digest.digest()
+
+    def columns(self):
+        """Return the modified, name and login columns of every credential
+        from the columns file. Only credential file stats are read to check
+        it is current, it is rebuilt from the index and saved otherwise
+        """
+        if not self.columns_filename:
+            return columns.Columns.build(self.summaries())
+
+        loaded = columns.load(self.columns_filename)
+        fingerprint = self.fingerprint((p, self.stat_key(p)) for p in self.walk())
+        if loaded is not None and loaded.fingerprint == fingerprint:
+            return loaded
+        logging.debug(u"columns file {} is stale".format(self.columns_filename))
+        built = columns.Columns.build(self.summaries(), fingerprint)
+        self.save_index_file(self.columns_filename, built.dumps())
+        return built
+
+    def summaries(self):
+        """Return the fullname, name, login, comment and modified fields of
+        every credential from the index file, without parsing credential
+        files, ordered by name and login. The index is rebuilt when it does
+        not match the files
+        """
+        docpaths = list(self.walk())
+        records = index.load(self.index_filename) if self.index_filename else None
+        if records is not None and len(records) == len(docpaths):
+            keys = {os.path.join(self.path, relpath): key for relpath, key, _ in records}
+            if all(keys.get(p) == self.stat_key(p) for p in docpaths):
+                return [summary for _, _, summary in records]
+
+        logging.debug(u"index file {} is stale".format(self.index_filename))
+        self.read()
+        if self.index_filename:
+            self.save_index(self._entries)
+        return sorted((index.summarize(entry[1]) for entry in self._entries.values()),
+                      key=sort_key)
+
+    def prefixed(self, prefix):
+        """Return credentials with a name starting with prefix, parsing
+        only their files
+        """
+        elements = []
+        for summary in prefix_slice(self.summaries(), prefix, sort_key):
+            if summary["name"].startswith(prefix):
+                elements.extend(self.find(summary["name"], summary["login"]))
+        return elements
+
+    def stat_key(self, docpath):
+        stat = os.stat(docpath)
+        return [stat.st_mtime, stat.st_size, stat.st_ino]
+
+    def make_dirpath(self, name):
+        if self.shard_length:
+            shard = hashlib.sha1(name.encode("utf-8")).hexdigest()[:self.shard_length]
+            return os.path.join(self.path, shard, name)
+        return os.path.join(self.path, name)
 
     def make_credpath(self, name, login):
-        dirname, filename = name, login + self.extension
-        credpath = os.path.join(self.path, dirname, filename)
+        credpath = os.path.join(self.make_dirpath(name), login + self.extension)
         return credpath
 
+    def make_passpath(self, credpath):
+        relpath = os.path.relpath(credpath, self.path)[:-len(self.extension)]
+        return os.path.join(self.path, self.passwords_dirname, relpath + ".gpg")
+
     def delete(self, credentials):
         for cred in credentials:
             credpath = self.make_credpath(cred["name"], cred["login"])
-            os.remove(credpath)
-            if not os.listdir(os.path.dirname(credpath)):
-                shutil.rmtree(os.path.dirname(credpath))
+            self.unlink(credpath)
+
+    def unlink(self, credpath):
+        passpath = self.make_passpath(credpath)
+        self.remove(credpath)
+        if os.path.exists(passpath):
+            self.remove(passpath)
+            passwords_path = os.path.join(self.path, self.passwords_dirname)
+            try:
+                if not os.listdir(passwords_path):
+                    shutil.rmtree(passwords_path)
+            except OSError:
+                pass
+
+    def remove(self, path):
+        os.remove(path)
+        self.touch_dir(path)
+        dirname = os.path.dirname(path)
+        # name directory, then its shard directory. A flat credential is
+        # not in a shard, so the database root and the password files
+        # directory are never removed here
+        for _ in range(2 if self.shard_length else 1):
+            if os.path.relpath(dirname, self.path) in (os.curdir, self.passwords_dirname):
+                break
+            if os.listdir(dirname):
+                break
+            shutil.rmtree(dirname)
+            dirname = os.path.dirname(dirname)
+
+    def migrate_format(self, name):
+        """Rewrite every credential file with the codec name"""
+        data = self.read()
+        self.format = name
+        self._entries = {}
+        self.write(data)
+
+    def load_password(self, name, login):
+        """Return the encrypted password of a credential from its password
+        file, falling back to a password stored inline with the metadata
+        """
+        credpaths = [self.make_credpath(name, login)]
+        if self.shard_length:
+            # credentials are only moved into their shard on the next write
+            credpaths.append(os.path.join(self.path, name, login + self.extension))
+        for credpath in credpaths:
+            try:
+                with open(self.make_passpath(credpath), "rb") as f:
+                    return pack_ciphertext(f.read())
+            except IOError:
+                continue
+        found = self.find(name, login)
+        return found[0].get("password") if found else None
+
+    def write_password(self, credpath, password):
+        self.stage(self.make_passpath(credpath), unpack_ciphertext(password), "wb")
+
+    def move_password(self, credpath, newpath):
+        """Stage the password file of credpath as the password file of
+        newpath. The old file is left for unlink
+        """
+        try:
+            with open(self.make_passpath(credpath), "rb") as f:
+                content = f.read()
+        except IOError:
+            return
+        self.stage(self.make_passpath(newpath), content, "wb")
+
+    def stage(self, path, content, mode="w"):
+        """Write content to a temporary file next to path. It replaces
+        path when the write is published, so readers never see half
+        written files
+        """
+        dirname, filename = os.path.split(path)
+        tmppath = os.path.join(dirname, "." + filename + ".tmp")
+        with mkdir_open(tmppath, mode) as f:
+            f.write(content)
+            if self.durability != "fast":
+                f.flush()
+                os.fsync(f.fileno())
+        self._staged.append((tmppath, path))
+
+    def touch_dir(self, path):
+        """Mark the directories from path up to the database root to be
+        flushed when the write is published
+        """
+        dirname = os.path.dirname(path)
+        while dirname.startswith(self.path) and dirname not in self._dirty_dirs:
+            self._dirty_dirs.add(dirname)
+            if dirname == self.path:
+                break
+            dirname = os.path.dirname(dirname)
+
+    def publish(self, unlinked=()):
+        """Rename staged files over their targets, then unlink the
+        credential files in unlinked. Staged files were flushed when
+        written unless durability is fast. Safe durability then flushes
+        each changed directory once per write; paranoid durability
+        flushes every directory as it goes; fast durability never flushes
+        """
+        staged, self._staged = self._staged, []
+        for tmppath, path in staged:
+            getattr(os, "replace", os.rename)(tmppath, path)
+            self.touch_dir(path)
+            if self.durability == "paranoid":
+                fsync_dir(os.path.dirname(path))
+        for credpath in unlinked:
+            self.unlink(credpath)
+        dirty_dirs, self._dirty_dirs = self._dirty_dirs, set()
+        if self.durability != "fast":
+            for dirname in sorted(dirty_dirs, reverse=True):
+                fsync_dir(dirname)
+
+    def remove_stale(self):
+        """Remove temporary files left by writes that never published, so
+        they are not committed with the credentials
+        """
+        stale, self._stale = self._stale, set()
+        for tmppath in stale:
+            try:
+                os.remove(tmppath)
+                logging.debug(u"removed stale file {}".format(tmppath))
+            except OSError:
+                pass
+
+    def walk(self, path=None):
+        """Yield credential file paths under path. Dot directories such as
+        ``.git`` are never entered and only files with the credential
+        extension are yielded. Temporary files a crashed write left are
+        noted for the next write to remove
+        """
+        try:
+            dir_entries = list(scandir(path or self.path))
+        except OSError:
+            return
+        for entry in dir_entries:
+            if entry.name.startswith('.') and entry.is_dir():
+                continue
+            elif entry.is_dir(follow_symlinks=False):
+                for docpath in self.walk(entry.path):
+                    yield docpath
+            elif entry.name.endswith(self.extension) and entry.name != '.keys':
+                yield entry.path
+            elif entry.name.startswith('.') and entry.name.endswith('.tmp'):
+                self._stale.add(entry.path)
+
+    def load(self, docpath):
+        """Return the ``[stat key, credential]`` entry for docpath and
+        whether the file had to be parsed again
+        """
+        key = self.stat_key(docpath)
+        cached = self.load_cache().get(docpath)
+        if cached and cached[0] == key:
+            return cached, False
+        return [key, load_credential(docpath)], True
+
+    def load_many(self, docpaths):
+        """Return ``[stat key, credential]`` entries for docpaths in order
+        and whether any file had to be parsed again. Files missing from the
+        cache are parsed by a pool of ``workers`` when configured
+        """
+        cache = self.load_cache()
+        keys = [self.stat_key(p) for p in docpaths]
+        stale = [p for p, k in zip(docpaths, keys)
+                 if not (cache.get(p) and cache[p][0] == k)]
+
+        if self.workers > 1 and len(stale) > 1:
+            if self.pool == "process":
+                executor = ProcessPoolExecutor(max_workers=self.workers)
+                chunksize = max(1, len(stale) // (self.workers * 4))
+            else:
+                executor = ThreadPoolExecutor(max_workers=self.workers)
+                chunksize = 1
+            with executor:
+                parsed = dict(zip(stale, executor.map(load_credential, stale,
+                                                      chunksize=chunksize)))
+        else:
+            parsed = {p: load_credential(p) for p in stale}
+
+        entries = [[k, parsed[p]] if p in parsed else cache[p]
+                   for p, k in zip(docpaths, keys)]
+        return entries, bool(parsed)
+
+    def iterate(self, sorted=True):
+        """Yield credentials one file at a time, ordered by name and login
+        when sorted. Only an already loaded cache is used, the cache file is
+        not read so memory use does not grow with the vault
+        """
+        docpaths = list(self.walk())
+        if sorted:
+            docpaths.sort(key=lambda p: (os.path.basename(os.path.dirname(p)) +
+                                         os.path.basename(p)[:-len(self.extension)]))
+        cache = self._entries or {}
+        for docpath in docpaths:
+            try:
+                cached = cache.get(docpath)
+                if cached and cached[0] == self.stat_key(docpath):
+                    yield dict(cached[1])
+                else:
+                    yield load_credential(docpath)
+            except (IOError, OSError):
+                continue
+
+    def find(self, name, login=None):
+        """Load only the credential files for name and login. When login is
+        None every credential in the name directory is returned
+        """
+        dirnames = [self.make_dirpath(name)]
+        if self.shard_length:
+            # credentials are only moved into their shard on the next write
+            dirnames.append(os.path.join(self.path, name))
+
+        for dirname in dirnames:
+            if login is None:
+                try:
+                    docpaths = sorted(e.path for e in scandir(dirname)
+                                      if e.is_file() and e.name.endswith(self.extension))
+                except OSError:
+                    docpaths = []
+            else:
+                docpaths = [os.path.join(dirname, login + self.extension)]
+
+            elements = []
+            for docpath in docpaths:
+                try:
+                    entry, parsed = self.load(docpath)
+                except (IOError, OSError):
+                    continue
+                self._entries[docpath] = entry
+                elements.append(dict(entry[1]))
+            if elements:
+                return elements
+        return []
 
     def read(self):
-        elements = []
-        for rootdir, dirs, files in os.walk(self.path):
-            filenames = [f for f in files if f.endswith(self.extension)]
-            for filename in filenames:
-                docpath = os.path.join(rootdir, filename)
-                with open(docpath) as f:
-                    elements.append(yaml.load(f.read()))
+        entries = {}
+        elements = {}
+        ids = {}
+        next_id = max(self._ids.values() or [0]) + 1
+        docpaths = list(self.walk())
+        loaded, changed = self.load_many(docpaths)
+        for docpath, entry in zip(docpaths, loaded):
+            entries[docpath] = entry
+            # keep document ids stable for the lifetime of the storage
+            ids[docpath] = self._ids.get(docpath)
+            if ids[docpath] is None:
+                ids[docpath], next_id = next_id, next_id + 1
+            elements[ids[docpath]] = dict(entry[1])
 
-        return {"_default":
-                {idx: elem for idx, elem in enumerate(elements, start=1)}}
+        if changed or len(entries) != len(self.load_cache()):
+            self.save_cache(entries)
+        self._synced = True
+        self._ids = ids
+
+        return {"_default": elements}
 
     def write(self, data):
-        deleted = [c for c in self.read()["_default"].values()
-                   if c not in data["_default"].values()]
-        self.delete(deleted)
+        if not self._synced:
+            self.read()
+        entries = self._entries or {}
 
+        documents = {}
+        ids = {}
         for eid, cred in data["_default"].items():
             credpath = self.make_credpath(cred["name"], cred["login"])
-            with mkdir_open(credpath, "w") as f:
-                f.write(yaml.safe_dump(dict(cred), default_flow_style=False))
+            documents[credpath] = dict(cred)
+            ids[credpath] = eid
+
+        # old files are only unlinked once the new ones are in place
+        unlinked = [p for p in entries if p not in documents]
+        for credpath in unlinked:
+            cred = entries[credpath][1]
+            newpath = self.make_credpath(cred["name"], cred["login"])
+            # a credential moving into its shard keeps its password file
+            if newpath in documents and documents[newpath].get("password") is None:
+                self.move_password(credpath, newpath)
+
+        writer = codec.get(self.format)
+        written = {}
+        changed = {}
+        for credpath, cred in documents.items():
+            if self.split_passwords and cred.get("password") is not None:
+                self.write_password(credpath, cred.pop("password"))
+            cached = entries.get(credpath)
+            if cached and cached[1] == cred:
+                written[credpath] = cached
+                continue
+            self.stage(credpath, writer.dumps(cred), "wb" if writer.binary else "w")
+            changed[credpath] = cred
+
+        self.publish(unlinked)
+        self.remove_stale()
+        for credpath, cred in changed.items():
+            written[credpath] = [self.stat_key(credpath), cred]
+        self.save_cache(written)
+        self._synced = True
+        self._ids = ids
+
+
+def prefix_slice(records, prefix, key):
+    """Return the records, ordered by key, with a key starting with prefix
+    by binary search
+    """
+    lo, hi = 0, len(records)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(records[mid]) < prefix:
+            lo = mid + 1
+        else:
+            hi = mid
+    end = lo
+    while end < len(records) and key(records[end]).startswith(prefix):
+        end += 1
+    return records[lo:end]
+
+
+def sort_key(credential):
+    return credential["name"] + credential["login"]
+
+
+def regexp(pattern, value):
+    """SQLite REGEXP with the same semantics as tinydb ``Query.matches``"""
+    return value is not None and re.match(pattern, value) is not None
+
+
+def migrate_directory(path, target, store):
+    """Move credentials from the one file per credential layout at path into
+    target with store and remove the old credential files. Passwords kept
+    in password files are moved with their credentials
+    """
+    directory = PasspieStorage(path)
+    credentials = list(directory.read()["_default"].values())
+    for credential in credentials:
+        if "password" not in credential:
+            password = directory.load_password(credential["name"], credential["login"])
+            if password is not None:
+                credential["password"] = password
+    if credentials:
+        store(credentials)
+        directory.write({"_default": {}})
+        logging.info(u"migrated {} credentials to {}".format(len(credentials), target))
+
+
+class PackedStorage(Storage):
+    """Keep every credential in one append-only record log. Each line holds
+    a JSON header, ``["put", name, login]`` or ``["del", name, login]``, a
+    tab and the JSON credential. The last record for a name and login wins
+    and an in-memory index maps them to the offset of their live record.
+    Live keys are also kept sorted by name and login for ordered and prefix
+    lookups.
+    """
+    filename = "credentials.pack"
+    compact_threshold = 100
+    durability = "safe"
+
+    def __init__(self, path):
+        super(PackedStorage, self).__init__()
+        self.path = path
+        self.logpath = os.path.join(path, self.filename)
+        self._offsets = {}
+        self._sorted = []
+        self._documents = {}
+        self._position = 0
+        self._inode = None
+        self._dead = 0
+        self._ids = {}
+        self._migrated = False
+
+    def encode(self, op, key, credential=None):
+        header = json.dumps([op, key[0], key[1]])
+        body = json.dumps(credential, default=encode_cache_value, sort_keys=True)
+        return (header + "\t" + body + "\n").encode("utf-8")
+
+    def decode(self, line):
+        body = line.partition(b"\t")[2]
+        return json.loads(body.decode("utf-8"), object_hook=decode_cache_value)
+
+    def migrate(self):
+        self._migrated = True
+        if not os.path.exists(self.logpath):
+            migrate_directory(self.path, self.logpath, lambda credentials: self.replace(
+                self.encode("put", (c["name"], c["login"]), c) for c in credentials))
+
+    def replace(self, records):
+        tmppath = self.logpath + ".tmp"
+        with mkdir_open(tmppath, "wb") as f:
+            f.write(b"".join(records))
+            self.sync(f)
+        getattr(os, "replace", os.rename)(tmppath, self.logpath)
+        if self.durability != "fast":
+            fsync_dir(self.path)
+
+    def sync(self, f):
+        if self.durability != "fast":
+            f.flush()
+            os.fsync(f.fileno())
+
+    def refresh(self):
+        """Update the offset index with records appended since the last
+        scan. The log is scanned again from the start after a compaction
+        """
+        if not self._migrated:
+            self.migrate()
+        try:
+            stat = os.stat(self.logpath)
+        except OSError:
+            stat = None
+        if stat is None or stat.st_ino != self._inode or stat.st_size < self._position:
+            self._offsets, self._sorted, self._documents = {}, [], {}
+            self._position, self._dead = 0, 0
+            self._inode = stat.st_ino if stat else None
+        if stat is None or stat.st_size == self._position:
+            return
+
+        with open(self.logpath, "rb") as f:
+            f.seek(self._position)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # incomplete record left by an interrupted append
+                    break
+                try:
+                    # JSON escapes tabs, so a record has exactly one
+                    if line.count(b"\t") != 1:
+                        raise ValueError("record spans {} tabs".format(line.count(b"\t")))
+                    op, name, login = json.loads(line.partition(b"\t")[0].decode("utf-8"))
+                except ValueError as e:
+                    logging.debug(u"skipped damaged record at {} of {}: {}".format(
+                        self._position, self.logpath, e))
+                    self._dead += 1
+                else:
+                    self.apply(op, (name, login))
+                self._position += len(line)
+
+    def apply(self, op, key):
+        """Point the offset and sorted indexes of key at the record at the
+        current position
+        """
+        self._documents.pop(key, None)
+        entry = (key[0] + key[1], key)
+        if key in self._offsets:
+            self._dead += 1
+        elif op == "put":
+            insort(self._sorted, entry)
+        if op == "put":
+            self._offsets[key] = self._position
+        else:
+            if self._offsets.pop(key, None) is not None:
+                del self._sorted[bisect_left(self._sorted, entry)]
+            self._dead += 1
+
+    def load_all(self):
+        self.refresh()
+        missing = sorted((offset, key) for key, offset in self._offsets.items()
+                         if key not in self._documents)
+        if missing:
+            with open(self.logpath, "rb") as f:
+                for offset, key in missing:
+                    f.seek(offset)
+                    self._documents[key] = self.decode(f.readline())
+        return self._documents
+
+    def load_keys(self, keys):
+        elements = []
+        for key in keys:
+            if key not in self._documents:
+                with open(self.logpath, "rb") as f:
+                    f.seek(self._offsets[key])
+                    self._documents[key] = self.decode(f.readline())
+            elements.append(dict(self._documents[key]))
+        return elements
+
+    def find(self, name, login=None):
+        self.refresh()
+        if login is None:
+            keys = [k for _, k in prefix_slice(self._sorted, name, itemgetter(0))
+                    if k[0] == name]
+        else:
+            keys = [k for k in [(name, login)] if k in self._offsets]
+        return self.load_keys(keys)
+
+    def prefixed(self, prefix):
+        self.refresh()
+        return self.load_keys([k for _, k in prefix_slice(self._sorted, prefix, itemgetter(0))
+                               if k[0].startswith(prefix)])
+
+    def iterate(self, sorted=True):
+        """Yield live records in log order, or ordered by name and login
+        when sorted, reading each from its offset instead of loading them
+        all
+        """
+        self.refresh()
+        if not self._offsets:
+            return
+        if sorted:
+            keys = [k for _, k in self._sorted]
+        else:
+            keys = list(self._offsets)
+            keys.sort(key=lambda k: self._offsets[k])
+        with open(self.logpath, "rb") as f:
+            for key in keys:
+                if key in self._documents:
+                    yield dict(self._documents[key])
+                else:
+                    f.seek(self._offsets[key])
+                    yield self.decode(f.readline())
+
+    def read(self):
+        documents = self.load_all()
+        elements = {}
+        ids = {}
+        next_id = max(self._ids.values() or [0]) + 1
+        for key in sorted(documents, key=lambda k: self._offsets[k]):
+            ids[key] = self._ids.get(key)
+            if ids[key] is None:
+                ids[key], next_id = next_id, next_id + 1
+            elements[ids[key]] = dict(documents[key])
+        self._ids = ids
+        return {"_default": elements}
+
+    def write(self, data):
+        current = self.load_all()
+        if os.path.exists(self.logpath + ".tmp"):
+            # left by a compaction that did not finish
+            os.remove(self.logpath + ".tmp")
+        documents = {}
+        ids = {}
+        for eid, cred in data["_default"].items():
+            key = (cred["name"], cred["login"])
+            documents[key] = dict(cred)
+            ids[key] = eid
+
+        records = [self.encode("del", key) for key in current if key not in documents]
+        records.extend(self.encode("put", key, cred) for key, cred in documents.items()
+                       if current.get(key) != cred)
+        if records:
+            created = not os.path.exists(self.logpath)
+            with mkdir_open(self.logpath, "ab") as f:
+                if os.fstat(f.fileno()).st_size > self._position:
+                    # drop an incomplete record left by an interrupted append
+                    f.truncate(self._position)
+                    self.sync(f)
+                f.write(b"".join(records))
+                self.sync(f)
+            if created and self.durability != "fast":
+                fsync_dir(self.path)
+            self.refresh()
+            self._documents.update((k, v) for k, v in documents.items() if k in self._offsets)
+        self._ids = ids
+
+        if self._dead > max(len(self._offsets), self.compact_threshold):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the log keeping only the live record of each credential"""
+        documents = self.load_all()
+        self.replace(self.encode("put", key, documents[key])
+                     for key in sorted(documents, key=lambda k: self._offsets[k]))
+        self.refresh()
+        self._documents.update(documents)
+
+
+class SQLiteStorage(Storage):
+    """Keep credentials in a SQLite database with indexed name, login and
+    modified columns. Lookups, ordered listings and regex searches run in
+    SQL; each credential is also kept whole as a JSON document.
+    """
+    filename = "credentials.sqlite"
+    synchronous = {"fast": "OFF", "safe": "FULL", "paranoid": "EXTRA"}
+    durability = "safe"
+    schema = """
+    CREATE TABLE IF NOT EXISTS credentials (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        login TEXT NOT NULL,
+        comment TEXT,
+        modified TEXT,
+        document TEXT NOT NULL,
+        UNIQUE (name, login)
+    );
+    CREATE INDEX IF NOT EXISTS credentials_login ON credentials (login);
+    CREATE INDEX IF NOT EXISTS credentials_modified ON credentials (modified);
+    """
+
+    def __init__(self, path):
+        super(SQLiteStorage, self).__init__()
+        self.path = path
+        self.dbpath = os.path.join(path, self.filename)
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            exists = os.path.exists(self.dbpath)
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._connection = sqlite3.connect(self.dbpath)
+            self._connection.create_function("REGEXP", 2, regexp)
+            self._connection.execute("PRAGMA synchronous = {}".format(
+                self.synchronous[self.durability]))
+            self._connection.executescript(self.schema)
+            if not exists:
+                migrate_directory(self.path, self.dbpath, self.insert)
+        return self._connection
+
+    def encode(self, credential):
+        return json.dumps(credential, default=encode_cache_value, sort_keys=True)
+
+    def decode(self, document):
+        return json.loads(document, object_hook=decode_cache_value)
+
+    def row(self, credential):
+        modified = credential.get("modified")
+        return (credential["name"],
+                credential["login"],
+                credential.get("comment"),
+                modified.isoformat() if isinstance(modified, datetime) else modified,
+                self.encode(credential))
+
+    def insert(self, credentials):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO credentials "
+                "(name, login, comment, modified, document) VALUES (?, ?, ?, ?, ?)",
+                [self.row(c) for c in credentials])
+
+    def select(self, where="", params=(), order="name || login"):
+        query = "SELECT document FROM credentials {} ORDER BY {}".format(where, order)
+        return [self.decode(d) for d, in self.connection.execute(query, params)]
+
+    def find(self, name, login=None):
+        if login is None:
+            return self.select("WHERE name = ?", (name,), order="login")
+        return self.select("WHERE name = ? AND login = ?", (name, login))
+
+    def ordered(self):
+        return self.select()
+
+    def iterate(self, sorted=True):
+        """Yield credentials from a cursor, one row at a time"""
+        query = "SELECT document FROM credentials ORDER BY {}".format(
+            "name || login" if sorted else "id")
+        for document, in self.connection.execute(query):
+            yield self.decode(document)
+
+    def prefixed(self, prefix):
+        # GLOB is case sensitive, so its literal prefix uses the name index
+        pattern = re.sub(r"([*?\[])", r"[\1]", prefix) + "*"
+        return self.select("WHERE name GLOB ?", (pattern,))
+
+    def matches(self, regex):
+        return self.select("WHERE name REGEXP ? OR login REGEXP ? OR comment REGEXP ?",
+                           (regex, regex, regex))
+
+    def read(self):
+        rows = self.connection.execute("SELECT id, document FROM credentials")
+        return {"_default": {i: self.decode(d) for i, d in rows}}
+
+    def write(self, data):
+        current = dict(self.connection.execute("SELECT id, document FROM credentials"))
+        rows = {}
+        for eid, cred in data["_default"].items():
+            rows[eid] = self.row(dict(cred))
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM credentials WHERE id = ?",
+                [(i,) for i in current if i not in rows])
+            # a credential moved to another id replaces the old row through
+            # the (name, login) unique constraint
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO credentials "
+                "(id, name, login, comment, modified, document) VALUES (?, ?, ?, ?, ?, ?)",
+                [(i,) + row for i, row in rows.items() if current.get(i) != row[-1]])
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class BatchMiddleware(Middleware):
+    """Keep reads and writes in memory while a Database batch is open and
+    write the final state to the storage once when it closes
+    """
+
+    def __init__(self, storage_cls, lock=None):
+        super(BatchMiddleware, self).__init__(storage_cls)
+        self.lock = lock or FileLock(None)
+        self.depth = 0
+        self.data = None
+        self.dirty = False
+
+    def read(self):
+        if not self.depth:
+            with self.lock.shared():
+                return self.storage.read()
+        if self.data is None:
+            with self.lock.shared():
+                self.data = dict(self.storage.read() or {})
+        return self.data
+
+    def write(self, data):
+        if not self.depth:
+            with self.lock.exclusive():
+                return self.storage.write(data)
+        self.data = data
+        self.dirty = True
+
+    def begin(self):
+        self.depth += 1
+
+    def end(self, flush=True):
+        self.depth -= 1
+        if self.depth:
+            return False
+        data, dirty = self.data, self.dirty
+        self.data, self.dirty = None, False
+        if dirty and flush:
+            self.storage.write(data)
+        return dirty and flush
+
+
+class LazyTable(Table):
+    """Table that only reads storage when documents are first needed, so
+    single credential lookups never trigger a full database read
+    """
+
+    def __init__(self, storage, name, cache_size=10):
+        self._storage = storage
+        self._name = name
+        self._query_cache = LRUCache(capacity=cache_size)
+        self._lazy_last_id = None
+
+    @property
+    def _last_id(self):
+        if self._lazy_last_id is None:
+            data = self._read()
+            self._lazy_last_id = max(data) if data else 0
+        return self._lazy_last_id
+
+    @_last_id.setter
+    def _last_id(self, value):
+        self._lazy_last_id = value
+
+
+class CredentialIndex(object):
+    """Hash indexes of credential documents by name, (login, name) and
+    fullname, and a list of ``(sort key, doc id)`` pairs kept sorted by
+    name and login
+    """
+
+    def __init__(self, documents=()):
+        self.documents = {}
+        self.name = {}
+        self.login_name = {}
+        self.fullname = {}
+        self.ordered = []
+        for document in documents:
+            self.add(document.doc_id, document)
+
+    def keys(self, credential):
+        fullname = credential.get("fullname") or make_fullname(
+            credential["login"], credential["name"])
+        return ((self.name, credential["name"]),
+                (self.login_name, (credential["login"], credential["name"])),
+                (self.fullname, fullname))
+
+    def add(self, doc_id, credential):
+        self.discard(doc_id)
+        self.documents[doc_id] = Credential(credential)
+        for mapping, key in self.keys(credential):
+            mapping.setdefault(key, set()).add(doc_id)
+        insort(self.ordered, (self.documents[doc_id].sort_key, doc_id))
+
+    def discard(self, doc_id):
+        credential = self.documents.pop(doc_id, None)
+        if credential is None:
+            return
+        for mapping, key in self.keys(credential):
+            mapping[key].discard(doc_id)
+            if not mapping[key]:
+                del mapping[key]
+        del self.ordered[bisect_left(self.ordered, (credential.sort_key, doc_id))]
+
+    def doc_ids(self, name, login=None):
+        if login is None:
+            doc_ids = self.name.get(name, ())
+        else:
+            doc_ids = self.login_name.get((login, name), ())
+        return sorted(doc_ids)
+
+    def sorted_ids(self):
+        return [doc_id for _, doc_id in self.ordered]
+
+    def prefix_ids(self, prefix):
+        """Return doc ids of credentials with a name starting with prefix"""
+        return [doc_id for _, doc_id in prefix_slice(self.ordered, prefix, itemgetter(0))
+                if self.documents[doc_id]["name"].startswith(prefix)]
+
+    def get(self, doc_ids):
+        return [self.documents[i].copy() for i in doc_ids]
+
+
+STORAGES = {
+    'directory': PasspieStorage,
+    'packed': PackedStorage,
+    'sqlite': SQLiteStorage,
+}
 
 
 class Database(TinyDB):
+    table_class = LazyTable
 
-    def __init__(self, config, storage=PasspieStorage):
+    def __init__(self, config, storage=None):
         self.config = config
         self.path = config['path']
+        self.lock = FileLock(self.path)
         self.repo = Repository(self.path,
                                autopull=config.get('autopull'),
-                               autopush=config.get('autopush'))
+                               autopush=config.get('autopush'),
+                               lock=self.lock)
         PasspieStorage.extension = config['extension']
-        super(Database, self).__init__(self.path, storage=storage)
+        PasspieStorage.cache_path = config.get('cache_path')
+        PasspieStorage.workers = config.get('load_workers', 1)
+        PasspieStorage.pool = config.get('load_pool', 'thread')
+        PasspieStorage.split_passwords = config.get('split_passwords', False)
+        PasspieStorage.format = config.get('format', 'yaml')
+        PasspieStorage.shard_length = config.get('shard_length', 0)
+        if codec.get(PasspieStorage.format) is None:
+            raise ValueError(u"Unknown format '{}'. Choose from: {}".format(
+                PasspieStorage.format, ", ".join(codec.get_names())))
+        durability = config.get('durability', 'safe')
+        if durability not in DURABILITY:
+            raise ValueError(u"Unknown durability '{}'. Choose from: {}".format(
+                durability, ", ".join(DURABILITY)))
+        for storage_cls in STORAGES.values():
+            storage_cls.durability = durability
+        if config.get('envelope'):
+            envelope.check(config['envelope'])
+        if storage is None:
+            storage_name = config.get('storage', 'directory')
+            try:
+                storage = STORAGES[storage_name]
+            except KeyError:
+                raise ValueError(u"Unknown storage '{}'. Choose from: {}".format(
+                    storage_name, ", ".join(sorted(STORAGES))))
+        super(Database, self).__init__(self.path, storage=BatchMiddleware(storage, lock=self.lock))
+        self._index = None
+        self._messages = []
+        self._data_key = None
+        self._pending_key = None
+        self._replace_data_key = False
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = CredentialIndex(self._table.all())
+        return self._index
+
+    def locked(self, method, exclusive=False):
+        """Return method holding the vault lock while it runs, or while the
+        generator it returns is consumed
+        """
+        if method is None:
+            return None
+        lock = self.lock.exclusive if exclusive else self.lock.shared
+
+        if inspect.isgeneratorfunction(method):
+            def wrapper(*args, **kwargs):
+                with lock():
+                    for item in method(*args, **kwargs):
+                        yield item
+        else:
+            def wrapper(*args, **kwargs):
+                with lock():
+                    return method(*args, **kwargs)
+        return wrapper
+
+    def storage_method(self, name):
+        """Return storage method name, unless a batch holds changes the
+        storage has not seen yet
+        """
+        if self._storage.dirty:
+            return None
+        return self.locked(getattr(self._storage, name, None))
+
+    @contextmanager
+    def batch(self, message=None):
+        """Buffer the changes made inside the block, write them to the
+        storage once on exit and make a single repository commit with
+        message. Nothing is written when the block raises
+        """
+        if message:
+            self._messages.append(message)
+        with self.lock.exclusive():
+            self._storage.begin()
+            try:
+                yield self
+            except Exception:
+                self._storage.end(flush=False)
+                if not self._storage.depth:
+                    self._index = None
+                    self._messages = []
+                    self._replace_data_key = False
+                raise
+            try:
+                flushed = self._storage.end()
+            except Exception:
+                self._replace_data_key = False
+                raise
+            if not self._storage.depth:
+                self.replace_data_key()
+            if flushed and self._messages:
+                self.repo.commit(u'\n'.join(self._messages))
+            if not self._storage.depth:
+                self._messages = []
 
     def has_keys(self):
         return os.path.exists(os.path.join(self.path, '.keys'))
 
+    def has_data_key(self, pending=False):
+        return os.path.exists(envelope.key_path(self.path, pending))
+
+    def data_key(self, passphrase=None, create=False):
+        """Return the data key of the envelope format unwrapped with
+        passphrase, or None when it cannot be. With create, a database
+        without one gets a new key wrapped to the recipient
+        """
+        if self._data_key is None and create:
+            with self.lock.exclusive():
+                if not self.has_data_key():
+                    key = envelope.new_key()
+                    envelope.write_key(self.path, key, self.config['recipient'],
+                                       self.config['homedir'])
+                    self._data_key = key
+        if self._data_key is None:
+            self._data_key = envelope.read_key(self.path, self.config['recipient'],
+                                               passphrase, self.config['homedir'])
+        return self._data_key
+
+    def data_keys(self, passphrase=None):
+        """Return the keys sealed passwords can be under: the data key and
+        the key left in the side file by a reset that did not finish
+        """
+        if self._pending_key is None and self.has_data_key(pending=True):
+            self._pending_key = envelope.read_key(self.path, self.config['recipient'],
+                                                  passphrase, self.config['homedir'],
+                                                  pending=True)
+        return [k for k in (self.data_key(passphrase), self._pending_key) if k is not None]
+
+    def set_data_key(self, key):
+        """Wrap key to the recipient in a side file. It replaces the data
+        key once the open batch is written, or right away outside a batch,
+        so passwords sealed under the old key stay readable until then
+        """
+        with self.lock.exclusive():
+            envelope.write_key(self.path, key, self.config['recipient'],
+                               self.config['homedir'], pending=True)
+        self._pending_key = key
+        self._replace_data_key = True
+        if not self._storage.depth:
+            self.replace_data_key()
+
+    def replace_data_key(self):
+        """Make the key of the side file the data key"""
+        if self._replace_data_key:
+            with self.lock.exclusive():
+                envelope.commit_key(self.path)
+            self._data_key, self._pending_key = self._pending_key, None
+            self._replace_data_key = False
+
     def filename(self, fullname):
         login, name = split_fullname(fullname)
-        return self._storage.make_credpath(name=name, login=login)
+        make_credpath = getattr(self._storage, 'make_credpath', None)
+        if make_credpath is not None:
+            return make_credpath(name=name, login=login)
+
+    def index_filename(self):
+        return getattr(self._storage, 'index_filename', None)
+
+    def password(self, credential):
+        """Return the encrypted password of credential. Storages that keep
+        passwords apart from the metadata only read it here
+        """
+        if 'password' in credential:
+            return credential['password']
+        load_password = self.locked(getattr(self._storage, 'load_password', None))
+        if load_password is not None:
+            return load_password(credential['name'], credential['login'])
+
+    def migrate_format(self, name):
+        """Rewrite the credentials with codec name. Return False when the
+        storage has its own format
+        """
+        migrate_format = self.locked(getattr(self._storage, 'migrate_format', None),
+                                     exclusive=True)
+        if migrate_format is None:
+            return False
+        migrate_format(name)
+        return True
+
+    def compact(self):
+        compact = self.locked(getattr(self._storage, 'compact', None), exclusive=True)
+        if compact is None:
+            return False
+        compact()
+        return True
+
+    def find(self, name, login=None):
+        find = self.storage_method('find')
+        if find is None or self._index is not None:
+            return self.index.get(self.index.doc_ids(name, login))
+        return [Credential(c) for c in find(name, login)]
 
     def credential(self, fullname):
         login, name = split_fullname(fullname)
-        Credential = Query()
-        if login is None:
-            creds = self.get(Credential.name == name)
-        else:
-            creds = self.get((Credential.login == login) & (Credential.name == name))
-        return creds
+        creds = self.find(name, login)
+        return creds[0] if creds else None
+
+    def all(self):
+        return self.index.get(sorted(self.index.documents))
+
+    def insert(self, document):
+        doc_id = self._table.insert(dict(document))
+        if self._index is not None:
+            self._index.add(doc_id, document)
+        return doc_id
+
+    def insert_multiple(self, documents):
+        documents = [dict(d) for d in documents]
+        doc_ids = self._table.insert_multiple(documents)
+        if self._index is not None:
+            for doc_id, document in zip(doc_ids, documents):
+                self._index.add(doc_id, document)
+        return doc_ids
+
+    def purge(self):
+        self._table.purge()
+        self._index = CredentialIndex()
 
     def add(self, fullname, password, comment):
         login, name = split_fullname(fullname)
@@ -98,33 +1242,96 @@ class Database(TinyDB):
         login, name = split_fullname(fullname)
         values['fullname'] = make_fullname(values["login"], values["name"])
         values['modified'] = datetime.now()
-        Credential = Query()
-        if login is None:
-            query = (Credential.name == name)
-        else:
-            query = ((Credential.login == login) & (Credential.name == name))
-        self.table().update(values, query)
+        doc_ids = self.index.doc_ids(name, login)
+        if 'password' not in values and len(doc_ids) == 1:
+            # keep the password when a credential moves to another file
+            password = self.password(self.index.documents[doc_ids[0]])
+            if password is not None:
+                values['password'] = password
+        if doc_ids:
+            self.table().update(values, doc_ids=doc_ids)
+        for doc_id in doc_ids:
+            credential = dict(self.index.documents[doc_id], **values)
+            self.index.add(doc_id, credential)
+
+    def summaries(self, fields):
+        """Return credentials with only the indexed fields from the storage
+        index file, or None when fields are not all indexed
+        """
+        summaries = self.storage_method('summaries')
+        if summaries is None or self._index is not None or fields is None:
+            return None
+        if not set(fields) <= set(index.FIELDS):
+            return None
+        return summaries()
 
-    def credentials(self, fullname=None):
+    def credentials(self, fullname=None, fields=None):
+        summaries = None if fullname else self.summaries(fields)
         if fullname:
             login, name = split_fullname(fullname)
-            Credential = Query()
-            if login is None:
-                creds = self.search(Credential.name == name)
-            else:
-                creds = self.search((Credential.login == login) & (Credential.name == name))
+            creds = self.find(name, login)
+        elif summaries is not None:
+            return [Credential(c) for c in summaries]
+        elif self._index is None and self.storage_method('ordered'):
+            return [Credential(c) for c in self.storage_method('ordered')()]
         else:
-            creds = self.all()
-        return sorted(creds, key=lambda x: x["name"] + x["login"])
+            return self.index.get(self.index.sorted_ids())
+        return sorted(creds, key=attrgetter('sort_key'))
+
+    def columns(self):
+        """Return the Columns of every credential ordered by name and login"""
+        method = self.storage_method('columns')
+        if method is None or self._index is not None:
+            return columns.Columns.build(self.credentials(fields=index.FIELDS))
+        return method()
+
+    def prefixed(self, prefix, fields=None):
+        """Return credentials with a name starting with prefix, ordered by
+        name and login, by binary search of a sorted index
+        """
+        summaries = self.summaries(fields)
+        if summaries is not None:
+            return [Credential(c) for c in prefix_slice(summaries, prefix, sort_key)
+                    if c['name'].startswith(prefix)]
+        elif self._index is None and self.storage_method('prefixed'):
+            return [Credential(c) for c in self.storage_method('prefixed')(prefix)]
+        return self.index.get(self.index.prefix_ids(prefix))
+
+    def iter_credentials(self, sorted=True, fields=None):
+        """Yield credentials one at a time straight from the storage instead
+        of building the full list first. Only the index file is read when
+        fields are all indexed fields
+        """
+        summaries = self.summaries(fields)
+        if summaries is not None:
+            records = summaries
+        elif self._index is None and self.storage_method('iterate'):
+            records = self.storage_method('iterate')(sorted=sorted)
+        elif sorted:
+            records = self.credentials()
+        else:
+            records = self.all()
+        for record in records:
+            yield Credential(record)
 
     def remove(self, fullname):
-        self.table().remove(where('fullname') == fullname)
+        doc_ids = sorted(self.index.fullname.get(fullname, ()))
+        if doc_ids:
+            self.table().remove(doc_ids=doc_ids)
+        for doc_id in doc_ids:
+            self.index.discard(doc_id)
 
-    def matches(self, regex):
-        Credential = Query()
+    def matches(self, regex, fields=None):
+        summaries = self.summaries(fields)
+        if summaries is not None:
+            return [Credential(c) for c in summaries
+                    if any(regexp(regex, c[k]) for k in ('name', 'login', 'comment'))]
+        if self.storage_method('matches'):
+            return [Credential(c) for c in self.storage_method('matches')(regex)]
+        query = Query()
         credentials = self.search(
-            Credential.name.matches(regex) |
-            Credential.login.matches(regex) |
-            Credential.comment.matches(regex)
+            query.name.matches(regex) |
+            query.login.matches(regex) |
+            query.comment.matches(regex)
         )
-        return sorted(credentials, key=lambda x: x["name"] + x["login"])
+        return sorted((Credential(c) for c in credentials), key=attrgetter('sort_key'))
@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import os
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+except ImportError:
+    AESGCM = ChaCha20Poly1305 = None
+
+from . import crypt
+from .utils import fsync_dir
+
+
+PREFIX = "$passpie$"
+KEY_FILENAME = ".vaultkey"
+PENDING_SUFFIX = ".new"
+CIPHERS = ("aes-gcm", "chacha20-poly1305")
+KEY_SIZE = 32
+NONCE_SIZE = 12
+
+
+def check(name):
+    """Raise ValueError when the envelope cipher name cannot be used"""
+    if name not in CIPHERS:
+        raise ValueError("Unknown envelope cipher '{}', choose one of: {}".format(
+            name, ", ".join(CIPHERS)))
+    if AESGCM is None:
+        raise ValueError("The envelope format needs cryptography. "
+                         "pip install passpie[envelope]")
+
+
+def aead(name, key):
+    return {"aes-gcm": AESGCM, "chacha20-poly1305": ChaCha20Poly1305}[name](key)
+
+
+def is_sealed(data):
+    return bool(data) and data.startswith(PREFIX)
+
+
+def key_id(key):
+    return hashlib.sha256(key).hexdigest()[:8]
+
+
+def seal(key, plaintext, name="aes-gcm"):
+    """Return plaintext encrypted under key as ``$passpie$<cipher>$<key id>$``
+    and the base64 of the nonce and ciphertext
+    """
+    header = PREFIX + name + "$" + key_id(key) + "$"
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = aead(name, key).encrypt(nonce, plaintext.encode("utf-8"),
+                                         header.encode("ascii"))
+    return header + base64.b64encode(nonce + ciphertext).decode("ascii")
+
+
+def unseal(key, data):
+    """Return the plaintext of sealed data, or None when key does not
+    open it. Data sealed before key ids were added has none
+    """
+    name, _, rest = data[len(PREFIX):].partition("$")
+    sealed_id, _, body = rest.rpartition("$")
+    if name not in CIPHERS or key is None:
+        return None
+    if sealed_id and sealed_id != key_id(key):
+        return None
+    try:
+        content = base64.b64decode(body)
+        plaintext = aead(name, key).decrypt(content[:NONCE_SIZE], content[NONCE_SIZE:],
+                                            data[:len(data) - len(body)].encode("ascii"))
+        return plaintext.decode("utf-8")
+    except (InvalidTag, TypeError, ValueError):
+        return None
+
+
+def unseal_any(keys, data):
+    """Return the plaintext of sealed data opened with the one of keys it
+    was sealed under, or None
+    """
+    for key in keys:
+        plaintext = unseal(key, data)
+        if plaintext is not None:
+            return plaintext
+    return None
+
+
+def new_key():
+    return os.urandom(KEY_SIZE)
+
+
+def key_path(path, pending=False):
+    return os.path.join(path, KEY_FILENAME + (PENDING_SUFFIX if pending else ""))
+
+
+def write_key(path, key, recipient, homedir, pending=False):
+    """Write key encrypted to recipient in the database path, or with
+    pending in a side file that commit_key later swaps in. The file is
+    flushed to disk before it replaces the old one, since losing it loses
+    every sealed password
+    """
+    wrapped = crypt.encrypt(base64.b64encode(key).decode("ascii"), recipient, homedir)
+    if not wrapped:
+        raise ValueError("Could not encrypt the vault key to '{}'".format(recipient))
+    filename = key_path(path, pending)
+    temporary = filename + ".tmp"
+    with open(temporary, "w") as keyfile:
+        keyfile.write(wrapped)
+        keyfile.flush()
+        os.fsync(keyfile.fileno())
+    os.rename(temporary, filename)
+    fsync_dir(path)
+
+
+def commit_key(path):
+    """Replace the key of the database path with the one of the side file"""
+    os.rename(key_path(path, pending=True), key_path(path))
+    fsync_dir(path)
+
+
+def read_key(path, recipient, passphrase, homedir, pending=False):
+    """Return the key of the database path, or of its side file with
+    pending, decrypted with passphrase, or None when it cannot be
+    """
+    try:
+        with open(key_path(path, pending)) as keyfile:
+            wrapped = keyfile.read()
+    except (IOError, OSError):
+        return None
+    output = crypt.decrypt(wrapped, recipient, passphrase, homedir)
+    try:
+        key = base64.b64decode(output.strip()) if output else None
+    except (TypeError, ValueError):
+        return None
+    return key if key and len(key) == KEY_SIZE else None
@@ -20,6 +20,19 @@ def ensure_git(return_value=None):
     return decorator
 
 
+def locked(exclusive=True):
+    """Run the repository method holding the repository lock"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.lock is None:
+                return func(self, *args, **kwargs)
+            with (self.lock.exclusive() if exclusive else self.lock.shared()):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 @ensure_git()
 def clone(url, dest=None, depth=None):
     if dest and os.path.exists(dest):
@@ -34,8 +47,9 @@ def clone(url, dest=None, depth=None):
 
 class Repository(object):
 
-    def __init__(self, path, autopull=None, autopush=None):
+    def __init__(self, path, autopull=None, autopush=None, lock=None):
         self.path = path
+        self.lock = lock
         self.autopush = autopush
         self.autopull = autopull
         self.author = "Passpie <passpie@localhost>"
@@ -43,21 +57,25 @@ class Repository(object):
             self.pull_rebase(*autopull)
 
     @ensure_git()
+    @locked()
     def init(self):
         cmd = ['git', 'init', self.path]
         process.call(cmd)
 
     @ensure_git()
+    @locked()
     def pull_rebase(self, remote='origin', branch='master'):
         cmd = ['git', 'pull', '--rebase', remote, branch]
         process.call(cmd, cwd=self.path)
 
     @ensure_git()
+    @locked()
     def push(self, remote='origin', branch='master'):
         cmd = ['git', 'push', remote, branch]
         process.call(cmd, cwd=self.path)
 
     @ensure_git()
+    @locked()
     def add(self, all=False):
         if all is True:
             cmd = ['git', 'add', '--all', '.']
@@ -66,6 +84,7 @@ class Repository(object):
         process.call(cmd, cwd=self.path)
 
     @ensure_git()
+    @locked()
     def commit(self, message, add=True):
         author_option = "--author={}".format(self.author)
         if add:
@@ -76,18 +95,21 @@ class Repository(object):
             self.push()
 
     @ensure_git(return_value=[])
+    @locked(exclusive=False)
     def commit_list(self):
         cmd = ['git', 'log', '--reverse', '--pretty=format:%s']
         output, _ = process.call(cmd, cwd=self.path)
         return output.splitlines()
 
     @ensure_git(return_value=[])
+    @locked(exclusive=False)
     def sha_list(self):
         cmd = ['git', 'log', '--reverse', '--pretty=format:%h']
         output, _ = process.call(cmd, cwd=self.path)
         return output.splitlines()
 
     @ensure_git()
+    @locked()
     def reset(self, to_index):
         try:
             sha = self.sha_list()[to_index]
@@ -1,7 +1,6 @@
 import yaml
-from yaml.reader import ReaderError
-from yaml.scanner import ScannerError
 
+from passpie import codec
 from passpie.importers import BaseImporter
 
 
@@ -15,8 +14,8 @@ class DefaultImporter(BaseImporter):
             return False
 
         try:
-            dict_content = yaml.load(file_content)
-        except (ReaderError, ScannerError):
+            dict_content = codec.loads(file_content)
+        except yaml.YAMLError:
             return False
 
         try:
@@ -30,6 +29,6 @@ class DefaultImporter(BaseImporter):
     def handle(self, filepath):
         with open(filepath) as fp:
             file_content = fp.read()
-        dict_content = yaml.load(file_content)
+        dict_content = codec.loads(file_content)
         credentials = dict_content.get('credentials')
         return credentials
@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+import mmap
+import struct
+
+from ._compat import unicode
+from .credential import make_fullname
+
+
+MAGIC = b"PPIX"
+VERSION = 2
+HEADER = struct.Struct("<4sII")
+# path, fullname, name, login and comment string offsets, modified,
+# then the mtime, size and inode of the credential file
+RECORD = struct.Struct("<5IqdQQ")
+NONE = 0xFFFFFFFF
+NO_TIME = -2 ** 63
+EPOCH = datetime(1970, 1, 1)
+FIELDS = ("fullname", "name", "login", "comment", "modified")
+
+
+def summarize(credential):
+    """Return the indexed fields of credential"""
+    summary = {k: credential.get(k) for k in FIELDS}
+    if not summary["fullname"]:
+        summary["fullname"] = make_fullname(credential["login"], credential["name"])
+    return summary
+
+
+def timestamp(modified):
+    """Return modified as microseconds since the epoch, or NO_TIME"""
+    if not isinstance(modified, datetime):
+        return NO_TIME
+    delta = modified - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def dumps(records):
+    """Return the index content of ``(relpath, stat key, credential)``
+    records, given ordered by name and login. Strings are interned in a table of NUL terminated UTF-8
+    strings at the end of the file, records point into it by offset
+    """
+    strings = {}
+    table = bytearray()
+
+    def intern(value):
+        if value is None:
+            return NONE
+        value = unicode(value)
+        offset = strings.get(value)
+        if offset is None:
+            offset = strings[value] = len(table)
+            table.extend(value.encode("utf-8") + b"\0")
+        return offset
+
+    body = bytearray()
+    count = 0
+    for relpath, key, credential in records:
+        summary = summarize(credential)
+        body.extend(RECORD.pack(
+            intern(relpath),
+            intern(summary["fullname"]),
+            intern(summary["name"]),
+            intern(summary["login"]),
+            intern(summary["comment"]),
+            timestamp(summary["modified"]),
+            key[0], key[1], key[2],
+        ))
+        count += 1
+    return HEADER.pack(MAGIC, VERSION, count) + bytes(body) + bytes(table)
+
+
+def load(filename):
+    """Return the ``(relpath, stat key, summary)`` records of the index
+    file or None when it is missing or not a valid index
+    """
+    try:
+        with open(filename, "rb") as f:
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+
+    try:
+        magic, version, count = HEADER.unpack_from(content, 0)
+        start = HEADER.size + count * RECORD.size
+        if magic != MAGIC or version != VERSION or start > len(content):
+            return None
+
+        strings = {NONE: None}
+
+        def string(offset):
+            if offset not in strings:
+                end = content.find(b"\0", start + offset)
+                if end < 0:
+                    raise ValueError("unterminated string")
+                strings[offset] = content[start + offset:end].decode("utf-8")
+            return strings[offset]
+
+        records = []
+        for position in range(HEADER.size, start, RECORD.size):
+            fields = RECORD.unpack_from(content, position)
+            modified = fields[5]
+            summary = {
+                "fullname": string(fields[1]),
+                "name": string(fields[2]),
+                "login": string(fields[3]),
+                "comment": string(fields[4]),
+                "modified": None if modified == NO_TIME else EPOCH + timedelta(microseconds=modified),
+            }
+            records.append((string(fields[0]), [fields[6], fields[7], fields[8]], summary))
+        return records
+    except (struct.error, ValueError):
+        return None
+    finally:
+        content.close()
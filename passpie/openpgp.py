@@ -0,0 +1,697 @@
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+import base64
+import bz2
+import hashlib
+import logging
+import os
+import re
+import struct
+import time
+import zlib
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import dsa
+    from cryptography.hazmat.primitives.asymmetric.utils import Prehashed, decode_dss_signature
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+else:
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import CAST5, Camellia, TripleDES
+    except ImportError:
+        CAST5, Camellia, TripleDES = algorithms.CAST5, algorithms.Camellia, algorithms.TripleDES
+
+from ._compat import unicode
+from .crypt import Backend, binary_packets
+
+
+KEYRING = "passpie.keys"
+USER_ID = u"Passpie (Auto-generated by Passpie) <passpie@local>"
+ARMOR_RE = re.compile(r"-----BEGIN PGP ([A-Z ]+)-----\r?\n(.*?)-----END PGP \1-----", re.S)
+HASHES = {1: "md5", 2: "sha1", 3: "ripemd160", 8: "sha256", 9: "sha384", 10: "sha512", 11: "sha224"}
+# public and secret key MPI counts of RSA, ElGamal and DSA keys
+PUBLIC_MPIS = {1: 2, 2: 2, 3: 2, 16: 3, 17: 4}
+SECRET_MPIS = {1: 4, 2: 4, 3: 4, 16: 1, 17: 1}
+ENCRYPTION = (1, 2, 16)
+SESSION_CIPHER = 9  # AES256
+PROTECT_CIPHER = 7  # AES128
+S2K_COUNT = 0xE0    # 16777216 bytes hashed to derive a secret key protection key
+# RFC 3526 2048-bit MODP group, generator 2, used for ElGamal subkeys
+MODP_PRIME = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+    "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+    "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+    "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+    "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+    "3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF", 16)
+# exponent size RFC 3526 gives for the group
+ELGAMAL_EXPONENT_BYTES = 40
+
+
+def to_int(data):
+    return int(hexlify(data), 16) if data else 0
+
+
+def to_bytes(value, size):
+    return unhexlify("{:0{}x}".format(value, size * 2)) if size else b""
+
+
+def byte_size(value):
+    return (value.bit_length() + 7) // 8
+
+
+def inverse(value, modulus):
+    a, b, x, y = value % modulus, modulus, 1, 0
+    while b:
+        quotient = a // b
+        a, b, x, y = b, a - quotient * b, y, x - quotient * y
+    return x % modulus
+
+
+def crc24(data):
+    crc = 0xB704CE
+    for byte in bytearray(data):
+        crc ^= byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def enarmor(kind, data):
+    """Return data as an ASCII armored block of kind, like ``MESSAGE``"""
+    body = base64.b64encode(data).decode("ascii")
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    checksum = base64.b64encode(struct.pack(">I", crc24(data))[1:]).decode("ascii")
+    return u"-----BEGIN PGP {0}-----\n\n{1}\n={2}\n-----END PGP {0}-----\n".format(
+        kind, "\n".join(lines), checksum)
+
+
+def dearmor(text):
+    """Return the ``(kind, data)`` of the ASCII armored blocks in text"""
+    blocks = []
+    for kind, body in ARMOR_RE.findall(text):
+        lines = body.splitlines()
+        if "" in lines and all(":" in line for line in lines[:lines.index("")]):
+            lines = lines[lines.index("") + 1:]
+        checksum = [line for line in lines if line.startswith("=")]
+        data = base64.b64decode("".join(x for x in lines if x and not x.startswith("=")))
+        if checksum and base64.b64decode(checksum[0][1:]) != struct.pack(">I", crc24(data))[1:]:
+            raise ValueError("armor checksum mismatch")
+        blocks.append((kind, data))
+    return blocks
+
+
+def read_packets(data):
+    """Yield the ``(tag, body)`` of the OpenPGP packets in data"""
+    data = bytearray(data)
+    position = 0
+    while position < len(data):
+        head = data[position]
+        position += 1
+        if not head & 0x80:
+            raise ValueError("invalid packet header")
+        if not head & 0x40:
+            tag, kind = (head >> 2) & 0x0F, head & 0x03
+            if kind == 3:
+                length = len(data) - position
+            else:
+                size = 1 << kind
+                length = to_int(bytes(data[position:position + size]))
+                position += size
+            yield tag, bytes(data[position:position + length])
+            position += length
+            continue
+
+        tag, body, partial = head & 0x3F, bytearray(), True
+        while partial:
+            first, partial = data[position], False
+            if first < 192:
+                length, position = first, position + 1
+            elif first < 224:
+                length = ((first - 192) << 8) + data[position + 1] + 192
+                position += 2
+            elif first == 255:
+                length = to_int(bytes(data[position + 1:position + 5]))
+                position += 5
+            else:
+                length, partial = 1 << (first & 0x1F), True
+                position += 1
+            body += data[position:position + length]
+            position += length
+        yield tag, bytes(body)
+
+
+def packet(tag, body):
+    length = len(body)
+    if length < 192:
+        header = bytearray([0xC0 | tag, length])
+    elif length < 8384:
+        length -= 192
+        header = bytearray([0xC0 | tag, (length >> 8) + 192, length & 0xFF])
+    else:
+        header = bytearray([0xC0 | tag, 255]) + struct.pack(">I", length)
+    return bytes(header) + body
+
+
+def read_mpis(data, position, count):
+    values = []
+    for _ in range(count):
+        size = (struct.unpack_from(">H", data, position)[0] + 7) // 8
+        values.append(to_int(data[position + 2:position + 2 + size]))
+        position += 2 + size
+    return values, position
+
+
+def mpi(value):
+    return struct.pack(">H", value.bit_length()) + to_bytes(value, byte_size(value))
+
+
+def cipher(algorithm):
+    """Return the cryptography algorithm class and key size of an OpenPGP
+    symmetric algorithm id
+    """
+    ciphers = {
+        2: (TripleDES, 24), 3: (CAST5, 16),
+        7: (algorithms.AES, 16), 8: (algorithms.AES, 24), 9: (algorithms.AES, 32),
+        11: (Camellia, 16), 12: (Camellia, 24), 13: (Camellia, 32),
+    }
+    try:
+        return ciphers[algorithm]
+    except KeyError:
+        raise ValueError("unsupported cipher algorithm {}".format(algorithm))
+
+
+def cfb(algorithm, key, iv, data, decrypt=True):
+    """Return data run through algorithm in CFB mode, built on ECB so the
+    OpenPGP resynchronization can restart it at any offset
+    """
+    cls, _ = cipher(algorithm)
+    encryptor = Cipher(cls(key), modes.ECB(), backend=default_backend()).encryptor()
+    output, register, size = bytearray(), bytes(iv), len(iv)
+    for start in range(0, len(data), size):
+        block = bytearray(data[start:start + size])
+        stream = bytearray(encryptor.update(register))
+        chunk = bytearray(b ^ s for b, s in zip(block, stream))
+        output += chunk
+        register = bytes(block if decrypt else chunk)
+    return bytes(output)
+
+
+def block_size(algorithm):
+    return cipher(algorithm)[0].block_size // 8
+
+
+def s2k(hash_algorithm, salt, count, passphrase, size):
+    """Return size bytes of key derived from passphrase by the salted and
+    iterated string-to-key, simple and salted being iterated once
+    """
+    data = salt + passphrase
+    count = max(count, len(data))
+    key, preload = b"", 0
+    while len(key) < size:
+        digest = hashlib.new(HASHES[hash_algorithm])
+        digest.update(b"\0" * preload)
+        if data:
+            chunk = data * max(1, 65536 // len(data))
+            remaining = count
+            while remaining >= len(chunk):
+                digest.update(chunk)
+                remaining -= len(chunk)
+            digest.update((data * (remaining // len(data) + 1))[:remaining])
+        key += digest.digest()
+        preload += 1
+    return key[:size]
+
+
+def s2k_count(coded):
+    return (16 + (coded & 15)) << ((coded >> 4) + 6)
+
+
+def checksum(data):
+    return struct.pack(">H", sum(bytearray(data)) & 0xFFFF)
+
+
+class Key(object):
+    """A version 4 public or secret key or subkey packet"""
+
+    def __init__(self, tag, body):
+        body = bytes(body)
+        version, self.created, self.algorithm = struct.unpack_from(">BIB", body, 0)
+        if version != 4 or self.algorithm not in PUBLIC_MPIS:
+            raise ValueError("unsupported key version {} or algorithm {}".format(
+                version, self.algorithm))
+        self.public, position = read_mpis(body, 6, PUBLIC_MPIS[self.algorithm])
+        self.tag = tag
+        self.body, self.protected = body[:position], body[position:]
+        self.flags = None
+        self.secret = None
+
+    @classmethod
+    def create(cls, tag, created, algorithm, public, secret):
+        key = cls(tag, struct.pack(">BIB", 4, created, algorithm) +
+                  b"".join(mpi(v) for v in public))
+        key.secret = secret
+        return key
+
+    @property
+    def fingerprint(self):
+        material = b"\x99" + struct.pack(">H", len(self.body)) + self.body
+        return hexlify(hashlib.sha1(material).digest()).decode("ascii").upper()
+
+    @property
+    def keyid(self):
+        return self.fingerprint[-16:]
+
+    @property
+    def has_secret(self):
+        return self.tag in (5, 7)
+
+    def unlock(self, passphrase):
+        """Decrypt the secret key values with passphrase. Raise ValueError
+        when passphrase is wrong or the secret key is not available
+        """
+        data = bytearray(self.protected)
+        usage = data[0]
+        if usage == 0:
+            self.secret, _ = read_mpis(bytes(data), 1, SECRET_MPIS[self.algorithm])
+            return
+        if usage not in (254, 255):
+            raise ValueError("unsupported secret key protection {}".format(usage))
+
+        algorithm, specifier, hash_algorithm = data[1], data[2], data[3]
+        if specifier == 0:
+            salt, count, position = b"", 0, 4
+        elif specifier == 1:
+            salt, count, position = bytes(data[4:12]), 0, 12
+        elif specifier == 3:
+            salt, count, position = bytes(data[4:12]), s2k_count(data[12]), 13
+        else:
+            raise ValueError("secret key is not available")
+        size = block_size(algorithm)
+        iv, encrypted = bytes(data[position:position + size]), bytes(data[position + size:])
+        key = s2k(hash_algorithm, salt, count, passphrase, cipher(algorithm)[1])
+        plain = cfb(algorithm, key, iv, encrypted)
+        if usage == 254:
+            valid = hashlib.sha1(plain[:-20]).digest() == plain[-20:]
+        else:
+            valid = checksum(plain[:-2]) == plain[-2:]
+        if not valid:
+            raise ValueError("bad passphrase")
+        self.secret, _ = read_mpis(plain, 0, SECRET_MPIS[self.algorithm])
+
+    def protect(self, passphrase):
+        """Return the secret key packet body with values encrypted by
+        passphrase
+        """
+        plain = b"".join(mpi(v) for v in self.secret)
+        if not passphrase:
+            return self.body + b"\0" + plain + checksum(plain)
+        salt, iv = os.urandom(8), os.urandom(block_size(PROTECT_CIPHER))
+        key = s2k(2, salt, s2k_count(S2K_COUNT), passphrase, cipher(PROTECT_CIPHER)[1])
+        encrypted = cfb(PROTECT_CIPHER, key, iv, plain + hashlib.sha1(plain).digest(),
+                        decrypt=False)
+        return (self.body + struct.pack(">BBBB", 254, PROTECT_CIPHER, 3, 2) +
+                salt + struct.pack(">B", S2K_COUNT) + iv + encrypted)
+
+
+class Certificate(object):
+    """A primary key with its user ids and subkeys"""
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.userids = []
+        self.subkeys = []
+
+    @property
+    def keys(self):
+        return [self.primary] + self.subkeys
+
+    def merge(self, other):
+        """Take the secret keys, subkeys and user ids of other, a
+        certificate of the same key
+        """
+        known = {k.fingerprint: k for k in self.keys}
+        for key in other.keys:
+            if key.fingerprint not in known:
+                self.subkeys.append(key)
+            elif key.has_secret:
+                known[key.fingerprint].tag = key.tag
+                known[key.fingerprint].protected = key.protected
+        self.userids.extend(u for u in other.userids if u not in self.userids)
+
+    def matches(self, recipient):
+        needle = recipient.replace(" ", "").upper()
+        if needle.startswith("0X"):
+            needle = needle[2:]
+        if len(needle) >= 8 and all(c in "0123456789ABCDEF" for c in needle):
+            if any(k.fingerprint.endswith(needle) for k in self.keys):
+                return True
+        return any(recipient.lower() in u.lower() for u in self.userids)
+
+    def encryption_key(self):
+        candidates = [k for k in self.subkeys + [self.primary] if k.algorithm in ENCRYPTION]
+        flagged = [k for k in candidates if k.flags is not None and k.flags & 0x0C]
+        return (flagged or candidates or [None])[0]
+
+
+def signature_flags(body):
+    """Return the key flags of a version 4 self-signature or binding
+    signature packet body, None when it has none
+    """
+    body = bytearray(body)
+    if body[0] != 4 or body[1] not in (0x10, 0x11, 0x12, 0x13, 0x18, 0x1F):
+        return None
+    end = 6 + struct.unpack_from(">H", bytes(body), 4)[0]
+    position = 6
+    while position < end:
+        first = body[position]
+        if first < 192:
+            length, position = first, position + 1
+        elif first < 255:
+            length = ((first - 192) << 8) + body[position + 1] + 192
+            position += 2
+        else:
+            length = to_int(bytes(body[position + 1:position + 5]))
+            position += 5
+        if body[position] & 0x7F == 27 and length > 1:
+            return body[position + 1]
+        position += length
+    return None
+
+
+def read_certificates(data):
+    """Return the certificates of the key packets in data"""
+    certificates, certificate, key = [], None, None
+    for tag, body in read_packets(data):
+        try:
+            if tag in (5, 6):
+                key = Key(tag, body)
+                certificate = Certificate(key)
+                certificates.append(certificate)
+            elif tag in (7, 14) and certificate is not None:
+                key = Key(tag, body)
+                certificate.subkeys.append(key)
+            elif tag == 13 and certificate is not None:
+                certificate.userids.append(body.decode("utf-8", "replace"))
+            elif tag == 2 and key is not None:
+                flags = signature_flags(body)
+                key.flags = key.flags if flags is None else flags
+        except (ValueError, IndexError, struct.error) as e:
+            logging.debug(u"skipped OpenPGP packet {}: {}".format(tag, e))
+            if tag in (5, 6):
+                certificate = None
+            if tag in (5, 6, 7, 14):
+                key = None
+    return certificates
+
+
+def load_certificates(text):
+    """Return the certificates of the ASCII armored key blocks in text.
+    Secret keys are merged into the public certificate of the same key
+    """
+    certificates = OrderedDict()
+    for _, data in dearmor(text):
+        for certificate in read_certificates(data):
+            known = certificates.setdefault(certificate.primary.fingerprint, certificate)
+            if known is not certificate:
+                known.merge(certificate)
+    return list(certificates.values())
+
+
+def literal_data(content):
+    for tag, body in read_packets(content):
+        if tag == 8:
+            algorithm, data = bytearray(body[:1])[0], body[1:]
+            if algorithm == 1:
+                data = zlib.decompressobj(-15).decompress(data)
+            elif algorithm == 2:
+                data = zlib.decompress(data)
+            elif algorithm == 3:
+                data = bz2.decompress(data)
+            elif algorithm != 0:
+                raise ValueError("unsupported compression {}".format(algorithm))
+            return literal_data(data)
+        if tag == 11:
+            start = 2 + bytearray(body[1:2])[0] + 4
+            return body[start:]
+    raise ValueError("no literal data")
+
+
+def session_key(body, keys):
+    """Return the symmetric algorithm and key of a public key encrypted
+    session key packet, or None when none of the secret keys opens it
+    """
+    keyid = hexlify(body[1:9]).decode("ascii").upper()
+    algorithm = bytearray(body[9:10])[0]
+    for key in keys:
+        if key.algorithm != algorithm or keyid not in (key.keyid, "0" * 16):
+            continue
+        if algorithm == 16:
+            (c1, c2), _ = read_mpis(body, 10, 2)
+            p, x = key.public[0], key.secret[0]
+            value = c2 * inverse(pow(c1, x, p), p) % p
+            size = byte_size(p)
+        else:
+            (c, ), _ = read_mpis(body, 10, 1)
+            n, d = key.public[0], key.secret[0]
+            value, size = pow(c, d, n), byte_size(n)
+        encoded = bytearray(to_bytes(value, size))
+        if encoded[:2] != bytearray(b"\0\x02") or 0 not in encoded[2:]:
+            continue
+        message = bytes(encoded[encoded.index(0, 2) + 1:])
+        symmetric, session = bytearray(message[:1])[0], message[1:-2]
+        if checksum(session) == message[-2:] and len(session) == cipher(symmetric)[1]:
+            return symmetric, session
+    return None
+
+
+def decrypt_message(data, keys):
+    """Return the literal data of the OpenPGP message data decrypted with
+    the unlocked secret keys. Raise ValueError when it cannot be decrypted.
+    Like gpg, data without integrity protection is refused
+    """
+    sessions, encrypted = [], None
+    for tag, body in read_packets(data):
+        if tag == 1 and bytearray(body[:1]) == bytearray(b"\x03"):
+            sessions.append(body)
+        elif tag == 9:
+            raise ValueError("encrypted data is not integrity protected")
+        elif tag == 18:
+            encrypted = body
+            break
+    if encrypted is None:
+        raise ValueError("no encrypted data")
+    if bytearray(encrypted[:1]) != bytearray(b"\x01"):
+        raise ValueError("unknown encrypted data version")
+    opened = next((s for s in (session_key(b, keys) for b in sessions) if s), None)
+    if opened is None:
+        raise ValueError("no secret key for message")
+
+    algorithm, key = opened
+    size = block_size(algorithm)
+    plain = cfb(algorithm, key, b"\0" * size, encrypted[1:])
+    mdc = hashlib.sha1(plain[:-20]).digest()
+    if plain[-22:-20] != b"\xd3\x14" or plain[-20:] != mdc:
+        raise ValueError("modification detected")
+    prefix, content = plain[:size + 2], plain[size + 2:-22]
+    if prefix[size - 2:size] != prefix[size:size + 2]:
+        raise ValueError("wrong session key")
+    return literal_data(content)
+
+
+def pkcs1_pad(message, size):
+    padding = b""
+    while len(padding) < size - 3 - len(message):
+        padding += os.urandom(size).replace(b"\0", b"")
+    return b"\0\x02" + padding[:size - 3 - len(message)] + b"\0" + message
+
+
+def encrypt_message(data, key):
+    """Return data encrypted to key as the packets of an OpenPGP message"""
+    session = os.urandom(cipher(SESSION_CIPHER)[1])
+    message = struct.pack(">B", SESSION_CIPHER) + session + checksum(session)
+    if key.algorithm == 16:
+        p, g, y = key.public
+        value = to_int(pkcs1_pad(message, byte_size(p)))
+        k = to_int(os.urandom(byte_size(p))) % (p - 2) + 1
+        values = [pow(g, k, p), value * pow(y, k, p) % p]
+    else:
+        n, e = key.public
+        values = [pow(to_int(pkcs1_pad(message, byte_size(n))), e, n)]
+    encrypted_session = (b"\x03" + unhexlify(key.keyid) + struct.pack(">B", key.algorithm) +
+                         b"".join(mpi(v) for v in values))
+
+    literal = packet(11, b"b\0" + struct.pack(">I", int(time.time())) + data)
+    size = block_size(SESSION_CIPHER)
+    prefix = os.urandom(size)
+    plain = prefix + prefix[-2:] + literal + b"\xd3\x14"
+    plain += hashlib.sha1(plain).digest()
+    encrypted = b"\x01" + cfb(SESSION_CIPHER, session, b"\0" * size, plain, decrypt=False)
+    return packet(1, encrypted_session) + packet(18, encrypted)
+
+
+def subpacket(kind, data):
+    return struct.pack(">BB", len(data) + 1, kind) + data
+
+
+def key_material(key):
+    return b"\x99" + struct.pack(">H", len(key.body)) + key.body
+
+
+def sign(private_key, signer, sigtype, material, hashed):
+    """Return a version 4 DSA SHA256 signature packet body over material"""
+    header = struct.pack(">BBBBH", 4, sigtype, 17, 8, len(hashed)) + hashed
+    digest = hashlib.sha256(material + header + b"\x04\xff" +
+                            struct.pack(">I", len(header))).digest()
+    r, s = decode_dss_signature(private_key.sign(digest, Prehashed(hashes.SHA256())))
+    unhashed = subpacket(16, unhexlify(signer.keyid))
+    return header + struct.pack(">H", len(unhashed)) + unhashed + digest[:2] + mpi(r) + mpi(s)
+
+
+def generate_keys(passphrase, key_length=4096):
+    """Return the ASCII armored public and secret key blocks of a new DSA
+    key with an ElGamal encryption subkey, the key types gpg creates for
+    passpie
+    """
+    created = int(time.time())
+    private_key = dsa.generate_private_key(key_size=key_length, backend=default_backend())
+    numbers = private_key.private_numbers()
+    parameters = numbers.public_numbers.parameter_numbers
+    primary = Key.create(5, created, 17,
+                         [parameters.p, parameters.q, parameters.g, numbers.public_numbers.y],
+                         [numbers.x])
+    x = to_int(os.urandom(ELGAMAL_EXPONENT_BYTES)) | 1
+    subkey = Key.create(7, created, 16, [MODP_PRIME, 2, pow(2, x, MODP_PRIME)], [x])
+
+    userid = USER_ID.encode("utf-8")
+    fingerprint = b"\x04" + unhexlify(primary.fingerprint)
+    certification = sign(private_key, primary, 0x13,
+                         key_material(primary) + b"\xb4" + struct.pack(">I", len(userid)) + userid,
+                         subpacket(2, struct.pack(">I", created)) +
+                         subpacket(27, b"\x03") +
+                         subpacket(11, b"\x09\x08\x07") +
+                         subpacket(21, b"\x08\x0a\x09\x0b\x02") +
+                         subpacket(22, b"\x02\x03\x01") +
+                         subpacket(30, b"\x01") +
+                         subpacket(33, fingerprint))
+    binding = sign(private_key, primary, 0x18, key_material(primary) + key_material(subkey),
+                   subpacket(2, struct.pack(">I", created)) +
+                   subpacket(27, b"\x0c") +
+                   subpacket(33, fingerprint))
+
+    passphrase = unicode(passphrase or u"").encode("utf-8")
+    public = (packet(6, primary.body) + packet(13, userid) + packet(2, certification) +
+              packet(14, subkey.body) + packet(2, binding))
+    secret = (packet(5, primary.protect(passphrase)) + packet(13, userid) +
+              packet(2, certification) + packet(7, subkey.protect(passphrase)) +
+              packet(2, binding))
+    return enarmor("PUBLIC KEY BLOCK", public) + enarmor("PRIVATE KEY BLOCK", secret)
+
+
+def message_packets(data):
+    packets = binary_packets(data)
+    if packets is not None:
+        return packets
+    blocks = dearmor(data)
+    if not blocks:
+        raise ValueError("no OpenPGP message")
+    return blocks[0][1]
+
+
+class OpenPGPBackend(Backend):
+    """Reads and writes OpenPGP messages in-process with the keys imported
+    from the database ``.keys`` file, saving a gpg process per operation
+    """
+    name = "openpgp"
+
+    def __init__(self):
+        if Cipher is None:
+            raise RuntimeError("The openpgp crypt backend needs cryptography. "
+                               "pip install passpie[openpgp]")
+
+    def certificates(self, homedir):
+        try:
+            with open(os.path.join(homedir, KEYRING)) as keyring:
+                return load_certificates(keyring.read())
+        except (IOError, OSError):
+            return []
+
+    def unlocked(self, homedir, passphrase):
+        passphrase = unicode(passphrase or u"").encode("utf-8")
+        keys = []
+        for certificate in self.certificates(homedir):
+            for key in certificate.keys:
+                if key.has_secret and key.algorithm in ENCRYPTION:
+                    try:
+                        key.unlock(passphrase)
+                        keys.append(key)
+                    except (ValueError, KeyError, struct.error) as e:
+                        logging.debug(u"could not unlock key {}: {}".format(key.keyid, e))
+        return keys
+
+    def check(self, keys_path):
+        """Raise ValueError when the keys file keys_path has no key to
+        encrypt to. It is the only keyring this backend reads
+        """
+        try:
+            with open(keys_path) as keysfile:
+                certificates = load_certificates(keysfile.read())
+        except (IOError, OSError):
+            certificates = []
+        if not any(c.encryption_key() for c in certificates):
+            raise ValueError(u"The openpgp crypt backend only reads the database keys "
+                             u"and {} has no encryption key".format(keys_path))
+
+    def create_keys(self, passphrase, path=None, key_length=4096):
+        keys = generate_keys(passphrase, key_length)
+        if path:
+            with open(path, "w") as keysfile:
+                keysfile.write(keys)
+        else:
+            return keys
+
+    def import_keys(self, keys_path, homedir):
+        with open(keys_path) as keysfile:
+            keys = keysfile.read()
+        with open(os.path.join(homedir, KEYRING), "a") as keyring:
+            keyring.write(keys)
+        return homedir
+
+    def get_default_recipient(self, homedir, secret=False):
+        for certificate in self.certificates(homedir):
+            if not secret or any(k.has_secret for k in certificate.keys):
+                return certificate.primary.fingerprint
+        return ''
+
+    def encrypt(self, data, recipient, homedir, armor=True):
+        certificates = self.certificates(homedir)
+        if recipient:
+            certificates = [c for c in certificates if c.matches(recipient)]
+        key = certificates[0].encryption_key() if certificates else None
+        if key is None:
+            raise ValueError(u"no encryption key for recipient {}".format(recipient))
+        packets = encrypt_message(unicode(data).encode("utf-8"), key)
+        if armor:
+            return enarmor("MESSAGE", packets)
+        return base64.b64encode(packets).decode("ascii")
+
+    def decrypt(self, data, recipient, passphrase, homedir):
+        return self.decrypt_many([data], recipient, passphrase, homedir)[0] or ''
+
+    def decrypt_many(self, ciphertexts, recipient, passphrase, homedir, jobs=1):
+        keys = self.unlocked(homedir, passphrase)
+        results = []
+        for data in ciphertexts:
+            try:
+                results.append(decrypt_message(message_packets(data), keys).decode("utf-8"))
+            except (ValueError, KeyError, IndexError, TypeError, struct.error, zlib.error) as e:
+                logging.debug(u"could not decrypt message: {}".format(e))
+                results.append(None)
+        return results
@@ -36,12 +36,14 @@ def call(*args, **kwargs):
     kwargs.setdefault('stdin', PIPE)
     kwargs.setdefault('shell', False)
     kwargs_input = kwargs.pop('input', None)
+    binary = kwargs.pop('binary', False)
 
     with Proc(*args, **kwargs) as proc:
         logging.debug(" ".join(args[0]))
         output, error = proc.communicate(input=kwargs_input)
         try:
-            output = output.decode('utf-8')
+            if not binary:
+                output = output.decode('utf-8')
             error = error.decode('utf-8')
         except AttributeError:
             pass
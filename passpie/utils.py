@@ -1,13 +1,16 @@
 from contextlib import contextmanager
 import errno
+import itertools
+import logging
 import os
 import re
 from random import SystemRandom
 import tempfile
+import time
 
 from rstr import Rstr
 
-from ._compat import which
+from ._compat import which, fcntl
 
 rstr = Rstr(SystemRandom())
 
@@ -38,7 +41,52 @@ def mkdir_open(path, mode="r"):
         yield fd
 
 
-def ensure_dependencies():
+@contextmanager
+def replace_open(path, mode="w"):
+    """Open a temporary file next to path that replaces path once the block
+    exits. It is removed instead when the block raises, so path is never
+    left half written
+    """
+    dirname, filename = os.path.split(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(prefix="." + filename + ".", suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        getattr(os, "replace", os.rename)(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size items of iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def fsync_dir(path):
+    """Flush the entries of directory path to disk where the platform
+    supports it
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def ensure_dependencies(crypt_backend='gpg'):
+    if crypt_backend != 'gpg':
+        return
     try:
         assert which('gpg') or which('gpg2')
     except AssertionError:
@@ -52,3 +100,55 @@ def tempdir():
 def touch(path):
     with open(path, "w"):
         pass
+
+
+class FileLock(object):
+    """Reentrant shared or exclusive ``flock`` on path. Locks taken while
+    one is held in the same process are nested; a shared lock is upgraded
+    when an exclusive one is requested. Nothing is locked when path does
+    not exist or fcntl is not available
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.depth = 0
+        self.mode = None
+
+    def acquire(self, exclusive=False):
+        self.depth += 1
+        if self.mode == "exclusive" or (self.mode == "shared" and not exclusive):
+            return
+        if self.fd is None:
+            if fcntl is None or not self.path or not os.path.exists(self.path):
+                return
+            self.fd = os.open(self.path, os.O_RDONLY)
+        mode = "exclusive" if exclusive else "shared"
+        start = time.time()
+        fcntl.flock(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        logging.debug(u"waited {:.3f}s for {} lock on {}".format(
+            time.time() - start, mode, self.path))
+        self.mode = mode
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.mode = None
+
+    @contextmanager
+    def shared(self):
+        self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire(exclusive=True)
+        try:
+            yield self
+        finally:
+            self.release()
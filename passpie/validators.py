@@ -40,5 +40,8 @@ def validate_config(ctx, param, value):
         configuration['path'] = temporary_path
 
     configuration.update(config.read(configuration['path']))
-    configuration = config.setup_crypt(configuration)
+    try:
+        configuration = config.setup_crypt(config.validate(configuration))
+    except (ValueError, RuntimeError) as e:
+        raise click.BadParameter(str(e))
     return configuration
@@ -28,6 +28,8 @@ requirements = [
     'tabulate==0.8.2',
     'tinydb==3.9.0',
     'rstr==2.2.6',
+    'scandir==1.10.0; python_version < "3.5"',
+    'futures==3.2.0; python_version < "3"',
 ]
 
 
@@ -74,6 +76,8 @@ setup(
         ]
     },
     install_requires=requirements,
+    extras_require={'msgpack': ['msgpack>=0.5.6'], 'numpy': ['numpy'],
+                    'openpgp': ['cryptography'], 'envelope': ['cryptography']},
     cmdclass={'test': PyTest, 'coverage': PyTestCoverage},
     test_suite='tests',
     classifiers=[
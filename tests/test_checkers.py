@@ -1,4 +1,5 @@
 from passpie import checkers
+from passpie.columns import Columns
 from datetime import datetime, timedelta
 
 
@@ -38,3 +39,14 @@ def test_modified_deepcopy_credentials(mocker):
     checkers.modified(credentials, days=1)
     assert mock_deepcopy.called
     mock_deepcopy.assert_called_once_with(credentials)
+
+
+def test_stale_returns_days_ago_by_fullname_of_old_credentials():
+    now = datetime(year=2016, month=1, day=10)
+    credentials = [
+        {'name': 'example.com', 'login': 'foo', 'modified': datetime(year=2016, month=1, day=1)},
+        {'name': 'example.com', 'login': 'bar', 'modified': datetime(year=2016, month=1, day=9)},
+    ]
+
+    stale = checkers.stale(Columns.build(credentials), days=2, now=now)
+    assert stale == {'foo@example.com': '9 days ago'}
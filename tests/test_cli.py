@@ -1,10 +1,17 @@
 import csv
+from datetime import datetime, timedelta
+import fcntl
+import io
+import json
+import os
 
 import click
 from click.testing import CliRunner
 import pytest
+import yaml
 
-from passpie import cli
+from passpie import cli, envelope
+from passpie.columns import Columns
 from passpie.database import Database
 
 
@@ -194,10 +201,8 @@ class CliAddTests(object):
             assert mock_copy.called is True
 
     def test_add_credentials_with_interactive_open_cred_in_editor(self, mocker, mock_config, irunner):
-        filename = 'path/to/credential.pass'
-        mocker.patch('passpie.cli.Database.filename', return_value=filename)
         mock_genpass = mocker.patch('passpie.cli.genpass', return_value='random')
-        mock_click_edit = mocker.patch('passpie.cli.click.edit')
+        mock_click_edit = mocker.patch('passpie.cli.click.edit', return_value=None)
 
         with mock_config() as cfg:
             pattern = cfg['genpass_pattern']
@@ -205,17 +210,15 @@ class CliAddTests(object):
 
             assert result.exit_code == 0
             assert mock_click_edit.called is True
-            mock_click_edit.assert_called_once_with(filename=filename)
+            assert mock_click_edit.call_args[1] == {'extension': '.yml'}
 
 
 def test_update_credentials_with_interactive_open_cred_in_editor(mocker, creds, mock_config, irunner):
     credentials = creds.make(2)
     fullname = credentials[0]['fullname']
-    filename = 'path/to/credential.pass'
     mocker.patch('passpie.cli.Database.credential', return_value=credentials[0])
-    mocker.patch('passpie.cli.Database.filename', return_value=filename)
     mock_genpass = mocker.patch('passpie.cli.genpass', return_value='random')
-    mock_click_edit = mocker.patch('passpie.cli.click.edit')
+    mock_click_edit = mocker.patch('passpie.cli.click.edit', return_value=None)
 
     with mock_config() as cfg:
         pattern = cfg['genpass_pattern']
@@ -223,7 +226,7 @@ def test_update_credentials_with_interactive_open_cred_in_editor(mocker, creds,
 
         assert result.exit_code == 0
         assert mock_click_edit.called is True
-        mock_click_edit.assert_called_once_with(filename=filename)
+        assert mock_click_edit.call_args[1] == {'extension': '.yml'}
 
 def test_update_credentials_encrypt_password(mocker, creds, mock_config, irunner):
     credentials = creds.make(2)
@@ -240,3 +243,336 @@ def test_update_credentials_encrypt_password(mocker, creds, mock_config, irunner
         assert mock_encrypt.called is True
         args, _ = mock_encrypt.call_args
         assert args[0] == password
+
+
+def test_compact_compacts_storage_and_commits(mocker, mock_config):
+    mock_repository = mocker.patch('passpie.database.Repository')
+    mock_compact = mocker.patch('passpie.cli.Database.compact', return_value=True)
+
+    with mock_config():
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['compact'], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    assert mock_compact.called is True
+    mock_repository().commit.assert_called_once_with(message='Compacted database')
+
+
+def test_compact_exits_with_error_when_storage_does_not_support_compaction(mocker, mock_config):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.Database.compact', return_value=False)
+
+    with mock_config():
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['compact'])
+
+    assert result.exit_code != 0
+    assert 'does not support compaction' in result.output
+
+
+def test_migrate_format_saves_format_in_database_config_and_commits(mocker, mock_config):
+    mock_repository = mocker.patch('passpie.database.Repository')
+    mock_migrate = mocker.patch('passpie.cli.Database.migrate_format', return_value=True)
+    mock_create = mocker.patch('passpie.cli.config.create')
+
+    with mock_config({'recipient': 'foo'}):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['migrate-format', 'json'], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    mock_migrate.assert_called_once_with('json')
+    args, kwargs = mock_create.call_args
+    assert kwargs['defaults'] == {'recipient': 'foo', 'format': 'json'}
+    mock_repository().commit.assert_called_once_with(message='Migrated credentials to json')
+
+
+def test_cli_exits_with_error_when_storage_is_unknown(mocker, mock_config):
+    mocker.patch('passpie.database.Repository')
+
+    with mock_config({'storage': 'unknown'}):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['list'])
+
+    assert result.exit_code != 0
+    assert "Unknown storage 'unknown'" in result.output
+
+
+def test_cli_exits_with_error_when_config_defaults_are_unusable(mocker, mock_config):
+    mocker.patch('passpie.database.Repository')
+    mock_database = mocker.patch('passpie.cli.Database')
+
+    with mock_config({'jobs': 0}):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['list'])
+
+    assert result.exit_code == 2
+    assert "Invalid jobs '0'" in result.output
+    assert mock_database.called is False
+
+
+def test_write_export_streams_same_content_as_dumping_whole_export(mocker):
+    credentials = [{'name': 'example.com', 'login': 'foo', 'password': 'p',
+                    'modified': datetime(2016, 1, 2)}]
+    for creds in (credentials, []):
+        content = {'handler': 'passpie', 'version': 1.0, 'credentials': creds}
+        stream = io.StringIO()
+        cli.write_export(stream, iter([dict(c) for c in creds]))
+        assert stream.getvalue() == yaml.dump(content, default_flow_style=False)
+
+        stream = io.StringIO()
+        cli.write_export(stream, iter([dict(c) for c in creds]), as_json=True)
+        content['credentials'] = [dict(c, modified=str(c['modified'])) for c in creds]
+        assert stream.getvalue() == json.dumps(content, indent=2)
+
+
+def test_export_decrypts_credentials_from_iterator(mocker, mock_config, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.ensure_passphrase')
+    mocker.patch('passpie.cli.decrypt_many',
+                 side_effect=lambda datas, **kwargs: [d.upper() for d in datas])
+    credentials = [{'name': 'example.com', 'login': 'foo', 'password': 'p',
+                    'modified': datetime(2016, 1, 2)}]
+    mock_iter = mocker.patch('passpie.cli.Database.iter_credentials',
+                             return_value=iter(credentials))
+    filepath = str(tmpdir.join('export.yml'))
+
+    with mock_config():
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['export', filepath, '--passphrase', 'k'],
+                               catch_exceptions=False)
+
+    assert result.exit_code == 0
+    mock_iter.assert_called_once_with(sorted=False)
+    with open(filepath) as f:
+        assert yaml.safe_load(f)['credentials'][0]['password'] == 'P'
+
+
+def test_list_with_prefix_lists_credentials_from_prefix_query(mocker, mock_config):
+    mocker.patch('passpie.database.Repository')
+    mock_prefixed = mocker.patch('passpie.cli.Database.prefixed', return_value=[])
+    mock_credentials = mocker.patch('passpie.cli.Database.credentials', return_value=[])
+
+    with mock_config({'headers': ['name', 'login'], 'hidden': []}):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['list', 'github'], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    mock_prefixed.assert_called_once_with('github', fields=['name', 'login'])
+    assert mock_credentials.called is False
+
+
+def test_age_prints_histogram_or_credentials_older_than_days(mocker, mock_config):
+    mocker.patch('passpie.database.Repository')
+    credentials = [{'name': 'example.com', 'login': 'foo',
+                    'modified': datetime.now() - timedelta(days=100)}]
+    mocker.patch('passpie.cli.Database.columns', return_value=Columns.build(credentials))
+
+    with mock_config({'table_format': 'plain'}):
+        runner = CliRunner()
+        histogram = runner.invoke(cli.cli, ['age'], catch_exceptions=False)
+        older = runner.invoke(cli.cli, ['age', '--days', '90'], catch_exceptions=False)
+
+    assert [line.split() for line in histogram.output.splitlines()[1:]] == [
+        ['0', '0'], ['30', '0'], ['90', '1'], ['180', '0'], ['365', '0']]
+    assert older.output.splitlines()[1].split() == ['foo@example.com', '100']
+
+
+def test_export_exits_with_error_naming_credentials_that_failed_to_decrypt(mocker, mock_config, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.ensure_passphrase')
+    mocker.patch('passpie.cli.decrypt_many', return_value=[None])
+    credentials = [{'fullname': 'foo@example.com', 'password': 'p'}]
+    mocker.patch('passpie.cli.Database.iter_credentials', return_value=iter(credentials))
+
+    with mock_config():
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['export', str(tmpdir.join('export.yml')),
+                                         '--passphrase', 'k'])
+
+    assert result.exit_code != 0
+    assert 'Could not decrypt: foo@example.com' in result.output
+
+
+def test_export_leaves_no_partial_file_when_decryption_fails(mocker, mock_config, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.ensure_passphrase')
+    mocker.patch('passpie.cli.BATCH_SIZE', 1)
+    mocker.patch('passpie.cli.decrypt_many', side_effect=[['s3cr3t'], [None]])
+    credentials = [{'fullname': 'foo@example.com', 'name': 'example.com', 'login': 'foo',
+                    'password': 'p', 'modified': datetime(2016, 1, 2)},
+                   {'fullname': 'bar@example.com', 'password': 'p'}]
+    mocker.patch('passpie.cli.Database.iter_credentials', return_value=iter(credentials))
+    exports = tmpdir.mkdir('exports')
+    filepath = exports.join('export.yml')
+    filepath.write('previous export')
+
+    with mock_config():
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['export', str(filepath), '--passphrase', 'k'])
+
+    assert result.exit_code != 0
+    assert 'Could not decrypt: bar@example.com' in result.output
+    assert filepath.read() == 'previous export'
+    assert exports.listdir() == [filepath]
+
+
+def test_export_to_dash_writes_to_stdout(mocker, mock_config):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.ensure_passphrase')
+    mocker.patch('passpie.cli.Database.iter_credentials', return_value=iter([]))
+
+    with mock_config():
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['export', '-', '--json', '--passphrase', 'k'],
+                               catch_exceptions=False)
+
+    assert result.exit_code == 0
+    assert json.loads(result.output)['credentials'] == []
+
+
+def test_export_passes_jobs_from_option_or_config_to_decrypt_many(mocker, mock_config, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.ensure_passphrase')
+    mock_decrypt_many = mocker.patch('passpie.cli.decrypt_many', return_value=['s3cr3t'])
+    mocker.patch('passpie.cli.Database.iter_credentials',
+                 side_effect=lambda sorted: iter([{'password': 'p'}]))
+    filepath = str(tmpdir.join('export.yml'))
+
+    with mock_config({'jobs': 3}):
+        runner = CliRunner()
+        runner.invoke(cli.cli, ['export', filepath, '--passphrase', 'k'], catch_exceptions=False)
+        assert mock_decrypt_many.call_args[1]['jobs'] == 3
+        runner.invoke(cli.cli, ['export', filepath, '--passphrase', 'k', '--jobs', '2'],
+                      catch_exceptions=False)
+        assert mock_decrypt_many.call_args[1]['jobs'] == 2
+
+
+@pytest.mark.skipif(envelope.AESGCM is None, reason='cryptography is not installed')
+def test_export_opens_sealed_passwords_with_data_key_and_others_with_gpg(mocker, mock_config, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.ensure_passphrase')
+    key = b'k' * 32
+    mock_data_key = mocker.patch('passpie.cli.Database.data_key', return_value=key)
+    mock_decrypt_many = mocker.patch('passpie.cli.decrypt_many', return_value=['gpg'])
+    credentials = [{'name': 'example.com', 'login': 'foo', 'modified': None,
+                    'password': envelope.seal(key, u'sealed')},
+                   {'name': 'example.com', 'login': 'bar', 'modified': None,
+                    'password': '-----BEGIN PGP MESSAGE-----'}]
+    mocker.patch('passpie.cli.Database.iter_credentials', return_value=iter(credentials))
+    filepath = str(tmpdir.join('export.yml'))
+
+    with mock_config():
+        runner = CliRunner()
+        runner.invoke(cli.cli, ['export', filepath, '--passphrase', 'k'], catch_exceptions=False)
+
+    with open(filepath) as f:
+        assert [c['password'] for c in yaml.safe_load(f)['credentials']] == ['sealed', 'gpg']
+    mock_data_key.assert_called_once_with('k')
+    assert mock_decrypt_many.call_args[0][0] == ['-----BEGIN PGP MESSAGE-----']
+
+
+def test_encrypt_passwords_raise_click_exception_without_encryption_key(mocker):
+    db = mocker.MagicMock(config={'recipient': 'r', 'homedir': 'h', 'armor': True})
+    error = ValueError('no encryption key for recipient r')
+    mocker.patch('passpie.cli.encrypt', side_effect=error)
+    mocker.patch('passpie.cli.encrypt_many', side_effect=error)
+
+    with pytest.raises(click.ClickException):
+        cli.encrypt_password(db, 's3cr3t')
+    with pytest.raises(click.ClickException):
+        cli.encrypt_passwords(db, ['s3cr3t'])
+
+
+@pytest.mark.skipif(envelope.AESGCM is None, reason='cryptography is not installed')
+def test_encrypt_password_seals_with_data_key_when_envelope_is_enabled(mocker):
+    db = mocker.MagicMock(config={'envelope': 'chacha20-poly1305'})
+    db.has_data_key.return_value = False
+    db.data_key.return_value = b'k' * 32
+    mock_encrypt = mocker.patch('passpie.cli.encrypt')
+
+    sealed = cli.encrypt_password(db, u's3cr3t')
+
+    assert sealed.startswith('$passpie$chacha20-poly1305$')
+    assert envelope.unseal(b'k' * 32, sealed) == u's3cr3t'
+    db.data_key.assert_called_once_with(None, create=True)
+    assert mock_encrypt.called is False
+
+
+def test_reset_holds_exclusive_lock_from_read_to_write(mocker, mock_config, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.ensure_passphrase')
+    mocker.patch('passpie.cli.decrypt_many', side_effect=lambda c, **kwargs: ['s3cr3t'] * len(c))
+    mocker.patch('passpie.cli.encrypt_many', side_effect=lambda p, **kwargs: ['new'] * len(p))
+    modes = []
+
+    def iter_credentials(db, *args, **kwargs):
+        modes.append(db.lock.mode)
+        yield {'name': 'example.com', 'login': 'foo', 'password': 'old',
+               'comment': '', 'modified': None}
+
+    mocker.patch('passpie.cli.Database.iter_credentials', autospec=True,
+                 side_effect=iter_credentials)
+    mock_batch = mocker.patch('passpie.cli.Database.batch', autospec=True)
+    mock_batch.side_effect = lambda db, message: modes.append(db.lock.mode) or mocker.MagicMock()
+
+    with mock_config({'path': str(tmpdir)}):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['reset', '--passphrase', 'k'], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    assert modes == ['exclusive', 'exclusive']
+
+
+@pytest.mark.parametrize('storage', ['directory', 'packed', 'sqlite'])
+def test_add_and_update_interactive_edit_credentials_of_any_storage(mocker, mock_config, tmpdir,
+                                                                    storage):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.encrypt', return_value='encrypted')
+    mock_click_edit = mocker.patch('passpie.cli.click.edit')
+    config = {'path': str(tmpdir), 'storage': storage}
+
+    with mock_config(config):
+        runner = CliRunner()
+        mock_click_edit.return_value = 'name: example.org\nlogin: bar\ncomment: added\n'
+        result = runner.invoke(cli.cli, ['add', 'foo@example.com', '--password', 's3cr3t', '-i'],
+                               catch_exceptions=False)
+        assert result.exit_code == 0
+        mock_click_edit.return_value = 'name: example.org\nlogin: bar\ncomment: updated\n'
+        result = runner.invoke(cli.cli, ['update', 'bar@example.org', '--comment', 'spam', '-i'],
+                               catch_exceptions=False)
+        assert result.exit_code == 0
+        mock_click_edit.return_value = 'login: bar\n'
+        result = runner.invoke(cli.cli, ['update', 'bar@example.org', '--comment', 'spam', '-i'],
+                               catch_exceptions=False)
+        assert result.exit_code != 0
+
+    db = Database(dict(mock_config(config).values))
+    assert [(c['fullname'], c['comment']) for c in db.credentials()] == [
+        ('bar@example.org', 'updated')]
+    assert db.password(db.credential('bar@example.org')) == 'encrypted'
+
+
+def test_add_and_update_interactive_do_not_lock_database_while_editing(mocker, mock_config, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch('passpie.cli.encrypt', return_value='encrypted')
+    config = {'path': str(tmpdir)}
+
+    def edit(content, **kwargs):
+        fd = os.open(str(tmpdir), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.close(fd)
+        return content
+
+    mock_click_edit = mocker.patch('passpie.cli.click.edit', side_effect=edit)
+    with mock_config(config):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['add', 'foo@example.com', '--password', 's3cr3t', '-i'],
+                               catch_exceptions=False)
+        assert result.exit_code == 0
+        result = runner.invoke(cli.cli, ['update', 'foo@example.com', '--comment', 'spam', '-i'],
+                               catch_exceptions=False)
+        assert result.exit_code == 0
+
+    assert mock_click_edit.call_count == 2
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import pytest
+
+from passpie import codec
+
+
+CREDENTIAL = {
+    'name': 'example.com',
+    'login': 'foo',
+    'comment': u'caf\xe9',
+    'modified': datetime(2016, 5, 1, 12, 30, 15, 120),
+}
+
+
+@pytest.mark.parametrize('name', codec.get_names())
+def test_codec_loads_returns_dumped_credential(name):
+    content = codec.get(name).dumps(CREDENTIAL)
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+
+    assert codec.detect(content) is codec.get(name)
+    assert codec.loads(content) == CREDENTIAL
+
+
+def test_codec_get_returns_none_for_unknown_name():
+    assert codec.get('xml') is None
+
+
+def test_codec_get_names_skips_msgpack_when_not_installed(mocker):
+    mocker.patch('passpie.codec.msgpack', None)
+
+    assert codec.get_names() == ['json', 'yaml']
+
+
+def test_codec_loads_falls_back_to_yaml_for_flow_mappings():
+    assert codec.loads(b'{name: example.com, login: foo}') == {
+        'name': 'example.com', 'login': 'foo'}
+
+
+def test_codec_yaml_loads_with_safe_loader(mocker):
+    mock_load = mocker.patch('passpie.codec.yaml.load')
+
+    codec.YAML.loads('name: foo')
+
+    mock_load.assert_called_once_with('name: foo', Loader=codec.SafeLoader)
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from passpie import columns
+
+
+NOW = datetime(2016, 6, 1)
+CREDENTIALS = [
+    {'name': 'example.com', 'login': 'foo', 'modified': NOW - timedelta(days=10)},
+    {'name': 'example.com', 'login': 'bar', 'modified': NOW - timedelta(days=100, hours=1)},
+    {'name': 'example.org', 'login': 'foo', 'modified': None},
+    {'name': 'example.org', 'login': 'bar', 'modified': NOW - timedelta(days=400)},
+]
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def backend(request, mocker):
+    if request.param == 'array':
+        mocker.patch('passpie.columns.numpy', None)
+    elif columns.numpy is None:
+        pytest.skip('numpy is not installed')
+    return request.param
+
+
+def test_columns_load_returns_dumped_columns(backend, tmpdir):
+    filename = str(tmpdir.join('index.col'))
+    with open(filename, 'wb') as f:
+        f.write(columns.Columns.build(CREDENTIALS, b'f' * 20).dumps())
+
+    loaded = columns.load(filename)
+
+    assert loaded.fingerprint == b'f' * 20
+    assert loaded.names == ['example.com', 'example.org']
+    assert loaded.logins == ['foo', 'bar']
+    assert [loaded.fullname(i) for i in range(len(loaded))] == [
+        'foo@example.com', 'bar@example.com', 'foo@example.org', 'bar@example.org']
+    assert list(loaded.ages(NOW)) == [10, 100, -1, 400]
+
+
+def test_columns_load_returns_none_for_invalid_file(tmpdir):
+    filename = str(tmpdir.join('index.col'))
+    with open(filename, 'wb') as f:
+        f.write(b'PPIX')
+
+    assert columns.load(filename) is None
+    assert columns.load(str(tmpdir.join('missing.col'))) is None
+
+
+def test_columns_older_than_and_histogram_skip_missing_dates(backend):
+    built = columns.Columns.build(CREDENTIALS)
+
+    assert built.older_than(90, NOW) == [1, 3]
+    assert built.older_than(10, NOW) == [1, 3]
+    assert built.histogram([30, 90, 365], NOW) == [1, 0, 1, 1]
@@ -37,3 +37,14 @@ def test_script_returns_bash_script_when_bash_shell_name(mocker):
 
     for line in completion.BASH.split('\n')[:3]:
         assert line in text
+
+
+def test_script_lists_names_inside_shards_when_shard_length_is_set(mocker):
+    commands = ['add', 'remove']
+    text = completion.script(shell_name='bash',
+                             config_path='/db',
+                             commands=commands,
+                             shard_length=2)
+
+    assert 'ls -1 /db' not in text
+    assert "find /db -mindepth 2 -maxdepth 2" in text
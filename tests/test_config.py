@@ -1,14 +1,16 @@
-import passpie.config
+import pytest
 import yaml
 
+import passpie.config
+
 
 def test_config_read_opens_path_and_load_yaml_content(mocker, mock_open):
     config_file = mocker.patch('passpie.config.open', mock_open(), create=True)
-    mock_yaml = mocker.patch('passpie.config.yaml')
+    mock_yaml = mocker.patch('passpie.config.codec.YAML')
 
     passpie.config.read('path')
-    assert mock_yaml.load.called
-    mock_yaml.load.assert_called_once_with(config_file().__enter__().read())
+    assert mock_yaml.loads.called
+    mock_yaml.loads.assert_called_once_with(config_file().__enter__().read())
 
 
 def test_config_read_logs_debug_when_config_file_not_found_and_returns_empty(mocker):
@@ -34,12 +36,12 @@ def test_config_read_logs_error_when_config_file_malformed_found_and_returns_emp
 
 def test_config_create_adds_an_empty_dot_config_file_to_path_when_default_false(mocker, mock_open):
     config_file = mocker.patch('passpie.config.open', mock_open(), create=True)
-    mock_yaml_dump = mocker.patch('passpie.config.yaml.dump')
+    mock_yaml_dumps = mocker.patch('passpie.config.codec.YAML.dumps')
     overrides = {}
     passpie.config.create('path', overrides)
 
     config_file().__enter__().write.assert_called_once_with(
-        mock_yaml_dump(overrides, default_flow_style=False)
+        mock_yaml_dumps(overrides)
     )
 
 
@@ -51,3 +53,28 @@ def path_is_repo_url(mocker):
     assert not is_repo_url(None)
     assert not is_repo_url('')
     assert not is_repo_url('++++++++++++++')
+
+
+@pytest.mark.parametrize('overrides', [
+    {'jobs': 2, 'load_workers': 4, 'load_pool': 'process', 'durability': 'paranoid'},
+    {},
+])
+def test_config_validate_returns_configuration_with_usable_settings(overrides):
+    configuration = dict(passpie.config.DEFAULT, **overrides)
+    assert passpie.config.validate(configuration) is configuration
+
+
+@pytest.mark.parametrize('overrides, message', [
+    ({'jobs': 0}, "Invalid jobs '0'"),
+    ({'jobs': '4'}, "Invalid jobs '4'"),
+    ({'jobs': True}, "Invalid jobs 'True'"),
+    ({'load_workers': -1}, "Invalid load_workers '-1'"),
+    ({'load_workers': 1.5}, "Invalid load_workers '1.5'"),
+    ({'load_pool': 'fork'}, "Unknown load_pool 'fork'"),
+    ({'durability': 'none'}, "Unknown durability 'none'"),
+])
+def test_config_validate_raises_value_error_for_unusable_settings(overrides, message):
+    configuration = dict(passpie.config.DEFAULT, **overrides)
+    with pytest.raises(ValueError) as excinfo:
+        passpie.config.validate(configuration)
+    assert message in str(excinfo.value)
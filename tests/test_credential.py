@@ -1,6 +1,8 @@
+from copy import deepcopy
+
 import pytest
 
-from passpie.credential import split_fullname, make_fullname
+from passpie.credential import Credential, split_fullname, make_fullname
 
 
 def test_split_fullname_raises_value_error_when_invalid_name(mocker):
@@ -21,3 +23,41 @@ def test_make_fullname_returns_expected_fullname(mocker):
     assert make_fullname("foo", "bar") == "foo@bar"
     assert make_fullname("_", "bar") == "_@bar"
     assert make_fullname(None, "bar") == "@bar"
+
+
+def test_credential_behaves_like_the_stored_dict():
+    document = {'name': 'example.com', 'login': 'foo', 'comment': None, 'custom': 1}
+    credential = Credential(document)
+
+    assert credential == document
+    assert dict(credential) == document
+    assert credential['custom'] == 1
+    assert 'password' not in credential
+    with pytest.raises(KeyError):
+        credential['password']
+
+
+def test_credential_keeps_unknown_fields_out_of_slots():
+    credential = Credential(name='example.com', login='foo')
+    assert credential.extra is None
+
+    credential['repeated'] = ['bar@example.com']
+    assert credential.extra == {'repeated': ['bar@example.com']}
+    assert not hasattr(credential, '__dict__')
+
+
+def test_credential_sort_key_is_cached_until_name_or_login_change():
+    credential = Credential(name='example.com', login='foo')
+    assert credential.sort_key == 'example.comfoo'
+
+    credential['login'] = 'bar'
+    assert credential.sort_key == 'example.combar'
+
+
+def test_credential_copies_are_independent():
+    credential = Credential(name='example.com', login='foo', custom={'a': 1})
+    copied = deepcopy(credential)
+    copied['login'] = 'bar'
+
+    assert credential['login'] == 'foo'
+    assert copied == {'name': 'example.com', 'login': 'bar', 'custom': {'a': 1}}
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import re
 
 import pytest
@@ -184,6 +185,45 @@ def test_decrypt_calls_gpg_encrypt_expected_command(mocker, mock_call):
     mock_call.assert_called_once_with(command, input=passphrase)
 
 
+def test_encrypt_without_armor_returns_base64_encoded_binary_packets(mocker, mock_call):
+    packets = b'\x85\x01\x0e\x03'
+    mock_call.return_value = (packets, None)
+    mocker.patch('passpie.crypt.which', return_value='gpg')
+
+    result = passpie.crypt.encrypt('s3cr3t', 'passpie@local', 'homedir', armor=False)
+
+    args, kwargs = mock_call.call_args
+    assert '--armor' not in args[0]
+    assert kwargs == {'input': 's3cr3t', 'binary': True}
+    assert result == 'hQEOAw=='
+    assert passpie.crypt.binary_packets(result) == packets
+
+
+def test_decrypt_feeds_binary_packets_to_gpg_without_armor(mocker, mock_call):
+    mock_call.return_value = ('s3cr3t', None)
+    mocker.patch('passpie.crypt.which', return_value='gpg')
+    mock_tempfile = mocker.patch('passpie.crypt.NamedTemporaryFile')
+
+    passpie.crypt.decrypt('hQEOAw==', 'passpie@local', 'passphrase', 'homedir')
+
+    mock_tempfile.assert_called_once_with('wb', delete=False)
+    mock_tempfile().__enter__().write.assert_called_once_with(b'\x85\x01\x0e\x03')
+    args, _ = mock_call.call_args
+    assert '--armor' not in args[0]
+
+
+@pytest.mark.parametrize('data', ['hQEOAw==', '-----BEGIN PGP MESSAGE-----\n\nhQEOAw==\n'])
+def test_pack_ciphertext_returns_unpacked_ciphertext(data):
+    content = passpie.crypt.unpack_ciphertext(data)
+
+    assert passpie.crypt.pack_ciphertext(content) == data
+
+
+def test_binary_packets_returns_none_for_armored_ciphertext():
+    assert passpie.crypt.binary_packets('-----BEGIN PGP MESSAGE-----') is None
+    assert passpie.crypt.binary_packets('dGV4dA==') is None
+
+
 def test_default_recipient_returns_first_matched_fingerprint(mocker, mock_call):
     output = '123\n456'
     mocker.patch('passpie.crypt.tempdir')
@@ -218,3 +258,169 @@ def test_default_recipient_calls_expected_command_when_secret(mocker, mock_call)
 
     assert mock_call.called is True
     mock_call.assert_called_once_with(command)
+
+
+def test_decrypted_files_returns_files_with_decryption_okay():
+    status = '\n'.join([
+        '[GNUPG:] FILE_START 3 /tmp/0.asc',
+        '[GNUPG:] BEGIN_DECRYPTION',
+        '[GNUPG:] DECRYPTION_OKAY',
+        '[GNUPG:] FILE_DONE',
+        '[GNUPG:] FILE_START 3 /tmp/1.asc',
+        '[GNUPG:] NODATA 1',
+        '[GNUPG:] FILE_DONE',
+        '[GNUPG:] FILE_START 3 /tmp/2.gpg',
+        '[GNUPG:] DECRYPTION_FAILED',
+        '[GNUPG:] FILE_DONE',
+    ])
+
+    assert passpie.crypt.decrypted_files(status) == set(['/tmp/0.asc'])
+
+
+def test_decrypt_session_decrypts_every_file_in_one_gpg_call(mocker, mock_call, tmpdir):
+    mocker.patch('passpie.crypt.which', return_value='gpg')
+    mocker.patch('passpie.crypt.PLAINTEXT_DIR', str(tmpdir))
+
+    def gpg(command, input):
+        filenames = command[command.index('--decrypt') + 1:]
+        with open(filenames[0][:-len('.asc')], 'wb') as f:
+            f.write(u'sécret'.encode('utf-8'))
+        status = '[GNUPG:] FILE_START 3 {}\n[GNUPG:] DECRYPTION_OKAY\n[GNUPG:] FILE_DONE\n'
+        return status.format(filenames[0]), ''
+    mock_call.side_effect = gpg
+
+    results = passpie.crypt.decrypt_session(['-----BEGIN PGP MESSAGE-----', 'hQEOAw=='],
+                                            'passphrase', 'homedir')
+
+    assert results == [u'sécret', None]
+    assert mock_call.call_count == 1
+    assert '--multifile' in mock_call.call_args[0][0]
+    assert mock_call.call_args[1] == {'input': 'passphrase'}
+    assert tmpdir.listdir() == []
+
+
+def test_decrypt_many_retries_failed_items_one_by_one(mocker, tmpdir):
+    mocker.patch('passpie.crypt.PLAINTEXT_DIR', str(tmpdir))
+    mocker.patch('passpie.crypt.BATCH_SIZE', 2)
+    mock_session = mocker.patch('passpie.crypt.decrypt_session',
+                                side_effect=[['one', None], [None]])
+    mock_decrypt = mocker.patch('passpie.crypt.decrypt', side_effect=['two', ''])
+
+    results = passpie.crypt.decrypt_many(['1', '2', '3'], 'recipient', 'passphrase', 'homedir')
+
+    assert results == ['one', 'two', None]
+    assert mock_session.call_count == 2
+    assert [c[0][0] for c in mock_decrypt.call_args_list] == ['2', '3']
+
+
+def test_decrypt_many_splits_sessions_over_jobs_keeping_order(mocker, tmpdir):
+    mocker.patch('passpie.crypt.PLAINTEXT_DIR', str(tmpdir))
+    mock_session = mocker.patch('passpie.crypt.decrypt_session',
+                                side_effect=lambda datas, passphrase, homedir:
+                                [None if d == '3' else d.upper() for d in datas])
+    mocker.patch('passpie.crypt.decrypt', return_value='three')
+
+    results = passpie.crypt.decrypt_many(['a', 'b', '3', 'd'], 'recipient', 'passphrase',
+                                         'homedir', jobs=2)
+
+    assert results == ['A', 'B', 'three', 'D']
+    assert sorted(c[0][0] for c in mock_session.call_args_list) == [['3', 'd'], ['a', 'b']]
+
+
+def test_decrypt_many_without_plaintext_dir_decrypts_one_by_one(mocker, tmpdir):
+    mocker.patch('passpie.crypt.PLAINTEXT_DIR', str(tmpdir.join('missing')))
+    mock_session = mocker.patch('passpie.crypt.decrypt_session')
+    mocker.patch('passpie.crypt.decrypt', side_effect=lambda data, *args: data.upper())
+
+    results = passpie.crypt.decrypt_many(['a', 'b', ''], 'recipient', 'passphrase', 'homedir',
+                                         jobs=2)
+
+    assert results == ['A', 'B', None]
+    assert mock_session.called is False
+
+
+def test_encrypt_many_returns_ciphertexts_in_order_and_raises_first_error(mocker):
+    def encrypt(data, recipient, homedir, armor=True):
+        if data.startswith('bad'):
+            raise ValueError(data)
+        return data.upper()
+    mocker.patch('passpie.crypt.encrypt', side_effect=encrypt)
+
+    assert passpie.crypt.encrypt_many(['a', 'b', 'c'], 'r', 'homedir', jobs=3) == ['A', 'B', 'C']
+    with pytest.raises(ValueError) as excinfo:
+        passpie.crypt.encrypt_many(['a', 'bad1', 'bad2'], 'r', 'homedir', jobs=3)
+    assert str(excinfo.value) == 'bad1'
+
+
+def test_use_selects_backend_of_module_functions(mocker):
+    mocker.patch('passpie.crypt.backend')
+    backend = passpie.crypt.use('gpg')
+
+    assert passpie.crypt.backend is backend
+    assert backend.name == 'gpg'
+    mocker.patch.object(backend, 'encrypt', return_value='encrypted')
+    assert passpie.crypt.encrypt('data', 'recipient', 'homedir') == 'encrypted'
+    backend.encrypt.assert_called_once_with('data', 'recipient', 'homedir', armor=True)
+    with pytest.raises(ValueError):
+        passpie.crypt.use('unknown')
+
+
+def test_use_expands_user_in_cache_path(mocker):
+    mocker.patch('passpie.crypt.backend')
+    mocker.patch('passpie.crypt.cache_path', None)
+    mocker.patch('passpie.crypt.recipients', None)
+
+    passpie.crypt.use('gpg', cache='~/.cache/passpie')
+
+    assert passpie.crypt.cache_path == os.path.expanduser('~/.cache/passpie')
+
+
+def test_get_default_recipient_is_cached_until_keyring_changes(mocker, tmpdir):
+    mocker.patch('passpie.crypt.cache_path', str(tmpdir.join('cache')))
+    mocker.patch('passpie.crypt.recipients', None)
+    mock_backend = mocker.patch('passpie.crypt.backend')
+    mock_backend.name = 'gpg'
+    mock_backend.get_default_recipient.return_value = 'FINGERPRINT'
+    keyring = tmpdir.join('passpie.keys')
+    keyring.write('keys')
+
+    assert passpie.crypt.get_default_recipient(str(tmpdir), keyring=str(keyring)) == 'FINGERPRINT'
+    assert passpie.crypt.get_default_recipient(str(tmpdir), keyring=str(keyring)) == 'FINGERPRINT'
+    assert mock_backend.get_default_recipient.call_count == 1
+
+    # a new process reads the cache file
+    mocker.patch('passpie.crypt.recipients', None)
+    assert passpie.crypt.get_default_recipient(str(tmpdir), keyring=str(keyring)) == 'FINGERPRINT'
+    assert mock_backend.get_default_recipient.call_count == 1
+    assert tmpdir.join('cache', 'recipients.json').check()
+
+    keyring.write('more keys')
+    mock_backend.get_default_recipient.return_value = 'OTHER'
+    assert passpie.crypt.get_default_recipient(str(tmpdir), keyring=str(keyring)) == 'OTHER'
+    assert mock_backend.get_default_recipient.call_count == 2
+
+
+def test_get_default_recipient_is_not_cached_without_keyring_files(mocker, tmpdir):
+    mocker.patch('passpie.crypt.recipients', None)
+    mock_backend = mocker.patch('passpie.crypt.backend')
+    mock_backend.get_default_recipient.return_value = ''
+
+    passpie.crypt.get_default_recipient(str(tmpdir), secret=True)
+    passpie.crypt.get_default_recipient(str(tmpdir), secret=True)
+
+    assert mock_backend.get_default_recipient.call_count == 2
+    mock_backend.get_default_recipient.assert_called_with(str(tmpdir), secret=True)
+
+
+def test_get_default_recipient_does_not_save_temporary_homedirs(mocker, tmpdir):
+    mocker.patch('passpie.crypt.cache_path', str(tmpdir.join('cache')))
+    mocker.patch('passpie.crypt.recipients', None)
+    mocker.patch('passpie.crypt.gettempdir', return_value=str(tmpdir))
+    mock_backend = mocker.patch('passpie.crypt.backend')
+    mock_backend.name = 'gpg'
+    mock_backend.get_default_recipient.return_value = 'FINGERPRINT'
+    homedir = tmpdir.mkdir('homedir')
+    homedir.join('pubring.kbx').write('keys')
+
+    assert passpie.crypt.get_default_recipient(str(homedir)) == 'FINGERPRINT'
+    assert not tmpdir.join('cache', 'recipients.json').check()
@@ -1,17 +1,32 @@
+from datetime import datetime
+import json
 import os
 
-from tinydb import where, Query
+import pytest
+from tinydb import Query
 from tinydb.storages import MemoryStorage
+import yaml
 
-from passpie.database import Database, PasspieStorage
+from passpie import envelope
+from passpie.credential import Credential
+from passpie.database import Database, PackedStorage, PasspieStorage, SQLiteStorage, load_credential
+from passpie.utils import mkdir_open
 from .helpers import MockerTestCase
 
 
+class PathMemoryStorage(MemoryStorage):
+    """Memory storage without direct lookups, queries go through TinyDB"""
+
+    def __init__(self, path):
+        super(PathMemoryStorage, self).__init__()
+
+
 class StorageTests(MockerTestCase):
 
     def setUp(self):
         self.mock_os = self.patch('passpie.database.os')
         self.mock_shutil = self.patch("passpie.database.shutil")
+        self.patch_object(PasspieStorage, "cache_path", None)
         self.storage = PasspieStorage("path")
 
     def test_read_returns_all_found_credentials_in_default_dict(self):
@@ -19,11 +34,10 @@ class StorageTests(MockerTestCase):
                                self.mock_open(), create=True)
         mock_open().read.return_value = "{}"
         self.mock_os = self.patch('passpie.database.os')
-        self.mock_os.walk.return_value = [
-            ('/foo', ('bar',), ('baz',)),
-            ('/foo/bar', (), ('eggs.pass',)),
-            ('/foo/bar2', (), ('spam.pass',))
-        ]
+        self.patch_object(PasspieStorage, "walk", return_value=[
+            '/foo/bar/eggs.pass',
+            '/foo/bar2/spam.pass',
+        ])
         storage = PasspieStorage("path")
         storage.write = self.Mock()
         elements = storage.read()
@@ -36,6 +50,8 @@ class StorageTests(MockerTestCase):
 
         self.patch("passpie.database.PasspieStorage.read",
                    return_value={"_default": {}})
+        self.mock_os.path.join.side_effect = lambda *parts: "/".join(parts)
+        self.mock_os.path.split.side_effect = lambda path: tuple(path.rsplit("/", 1))
         data = {"_default": {1: {"name": "example", "login": "foo"},
                              2: {"name": "example", "login": "bar"}}}
         storage = PasspieStorage("path")
@@ -62,6 +78,7 @@ class StorageTests(MockerTestCase):
             {"name": "spam", "login": "foozy"},
         ]
         self.mock_os.listdir.side_effect = [[], ["not empty"]]
+        self.mock_os.path.exists.return_value = False
         self.storage.delete(credentials)
 
         credpath = self.mock_os.path.join(credentials[0]["name"],
@@ -83,50 +100,40 @@ def test_database_has_keys_returns_true_when_file_dot_keys_found_in_db_path(mock
     mock_exists.assert_called_once_with(mock_join('path', '.keys'))
 
 
-def test_database_credential_with_fullname_does_a_db_where_with_split_fullname(mocker):
+def make_memory_database(credentials):
     config = {
         'path': 'path',
         'extension': '.pass',
     }
-    db = Database(config)
-    mocker.patch('passpie.database.split_fullname', return_value=('login', 'name'))
-    mock_get = mocker.patch.object(db, 'get', return_value=[{}])
+    db = Database(config, storage=PathMemoryStorage)
+    db.insert_multiple(credentials)
+    return db
 
-    result = db.credential('login@name')
-    assert db.get.called
-    assert result == [{}]
-    db.get.assert_called_once_with((where('login') == 'login') & (where('name') == 'name'))
 
+CREDENTIALS = [
+    {'fullname': 'foo@example.com', 'name': 'example.com', 'login': 'foo'},
+    {'fullname': 'bar@example.com', 'name': 'example.com', 'login': 'bar'},
+    {'fullname': '@example.com', 'name': 'example.com', 'login': ''},
+    {'fullname': 'foo@example.org', 'name': 'example.org', 'login': 'foo'},
+]
 
-def test_database_credential_with_fullname_does_a_db_get_with_filtering_name_only(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch('passpie.database.split_fullname', return_value=(None, 'example.com'))
-    mock_get = mocker.patch.object(db, 'get', return_value=[{}])
-    Credential = Query()
 
-    result = db.credential('login@name')
+def test_database_credential_with_fullname_uses_login_name_index(mocker):
+    db = make_memory_database(CREDENTIALS)
+    mocker.patch('passpie.database.split_fullname', return_value=('foo', 'example.org'))
+    mocker.spy(db._table, 'search')
 
-    assert db.get.called
-    db.get.assert_called_once_with(Credential.name == "example.com")
+    result = db.credential('foo@example.org')
+    assert result == CREDENTIALS[3]
+    assert db._table.search.called is False
 
 
-def test_database_credential_with_fullname_does_a_db_where_with_split_fullname(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch('passpie.database.split_fullname', return_value=('login', 'name'))
-    mock_get = mocker.patch.object(db, 'get', return_value=[{}])
+def test_database_credential_with_name_only_uses_name_index(mocker):
+    db = make_memory_database(CREDENTIALS)
 
-    result = db.credential('login@name')
-    assert db.get.called
-    assert result == [{}]
-    db.get.assert_called_once_with((where('login') == 'login') & (where('name') == 'name'))
+    result = db.credential('example.org')
+    assert result == CREDENTIALS[3]
+    assert db.credential('example.net') is None
 
 
 def test_database_add_insert_credential_to_database(mocker):
@@ -165,111 +172,153 @@ def test_database_add_with_empty_login_logs_error_and_return_none(mocker):
         'Cannot add credential with empty login. use "@<name>" syntax')
 
 
-def test_database_update_uses_table_update_credential_to_database(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch.object(db, 'table', mocker.MagicMock())
-    mocker.patch('passpie.database.make_fullname', return_value='login@name')
+def test_database_update_updates_indexed_documents_by_doc_id(mocker):
+    db = make_memory_database(CREDENTIALS)
+    mocker.spy(db._table, 'update')
     mock_datetime = mocker.patch('passpie.database.datetime')
     values = {
-        'login': 'login',
-        'name': 'name',
+        'login': 'spam',
+        'name': 'example.com',
         'comment': 'new comment'
     }
 
-    db.update(fullname='login@name', values=values)
-    query = (Query().login == 'login') & (Query().name == 'name')
+    db.update(fullname='foo@example.com', values=values)
 
-    assert db.table().update.called
-    db.table().update.assert_called_once_with(values, query)
+    db._table.update.assert_called_once_with(values, doc_ids=[1])
+    assert db.credential('foo@example.com') is None
+    assert db.credential('spam@example.com')['comment'] == 'new comment'
+    assert db.get(doc_id=1)['modified'] == mock_datetime.now()
 
 
-def test_database_remove_uses_table_remove_credential_from_database(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch.object(db, 'table', mocker.MagicMock())
-    mocker.patch('passpie.database.make_fullname', return_value='login@name')
+def test_database_remove_removes_documents_found_in_fullname_index(mocker):
+    db = make_memory_database(CREDENTIALS)
+    mocker.spy(db._table, 'remove')
 
-    db.remove(fullname='login@name')
+    db.remove(fullname='foo@example.com')
 
-    assert db.table().remove.called
-    db.table().remove.assert_called_once_with((where('fullname') == 'login@name'))
+    db._table.remove.assert_called_once_with(doc_ids=[1])
+    assert db.credential('foo@example.com') is None
+    assert len(db.all()) == 3
 
 
-def test_credentials_returns_sorted_list_credentials(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch.object(db, 'all', mocker.MagicMock())
+def test_database_remove_does_not_touch_table_when_fullname_not_found(mocker):
+    db = make_memory_database(CREDENTIALS)
+    mocker.spy(db._table, 'remove')
+
+    db.remove(fullname='spam@example.com')
+
+    assert db._table.remove.called is False
+
+
+def test_database_batch_writes_storage_and_commits_once(mocker):
+    db = make_memory_database(CREDENTIALS)
+    db.repo = mocker.Mock()
+    mocker.spy(db._storage.storage, 'write')
+
+    with db.batch('Removed credentials'):
+        db.remove('foo@example.com')
+        db.remove('bar@example.com')
+        assert db.credential('bar@example.com') is None
+        assert db._storage.storage.write.called is False
+
+    assert db._storage.storage.write.call_count == 1
+    db.repo.commit.assert_called_once_with('Removed credentials')
+    assert len(db.all()) == 2
+
+
+def test_database_batch_holds_exclusive_lock_and_reads_share_it(mocker, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    db = Database({'path': str(tmpdir), 'extension': '.pass'})
+    modes = []
+    mocker.patch.object(PasspieStorage, 'read', side_effect=lambda: modes.append(db.lock.mode) or {})
+
+    db.all()
+    with db.batch('Added credentials'):
+        db.insert({'name': 'example.com', 'login': 'foo'})
+        assert db.lock.mode == 'exclusive'
+
+    assert modes[0] == 'shared'
+    assert set(modes[1:]) == {'exclusive'}
+    assert db.lock.mode is None
+
+
+def test_database_batch_discards_changes_when_block_raises(mocker):
+    db = make_memory_database(CREDENTIALS)
+    db.repo = mocker.Mock()
+
+    with pytest.raises(RuntimeError):
+        with db.batch('Removed credentials'):
+            db.remove('foo@example.com')
+            raise RuntimeError()
+
+    assert db.credential('foo@example.com') == CREDENTIALS[0]
+    assert db.repo.commit.called is False
+
+
+def test_credentials_returns_credentials_in_sorted_index_order(mocker):
+    db = make_memory_database(CREDENTIALS)
     mock_sorted = mocker.patch('passpie.database.sorted', create=True)
 
     credentials = db.credentials()
-    assert credentials == mock_sorted()
+    assert [c['fullname'] for c in credentials] == [
+        '@example.com', 'bar@example.com', 'foo@example.com', 'foo@example.org']
+    assert mock_sorted.called is False
+
+
+def test_database_prefixed_bisects_sorted_index_kept_in_sync(mocker):
+    db = make_memory_database(CREDENTIALS)
+    db.insert({'fullname': 'foo@example', 'name': 'example', 'login': 'foo'})
+    db.remove('bar@example.com')
+
+    assert [c['fullname'] for c in db.prefixed('example.')] == [
+        '@example.com', 'foo@example.com', 'foo@example.org']
+    assert [c['fullname'] for c in db.prefixed('example')][-1] == 'foo@example'
+    assert db.prefixed('spam') == []
 
 
 def test_credentials_filter_credentials_by_login_and_name_when_full_fullname_passed(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch('passpie.database.split_fullname', return_value=('foo', 'example.com'))
-    mocker.patch.object(db, 'search')
-    mocker.patch.object(db, 'all')
-    Credential = Query()
+    db = make_memory_database(CREDENTIALS)
+    mocker.spy(db._table, 'search')
 
     credentials = db.credentials(fullname="foo@example.com")
-    assert db.search.called is True
-    assert db.all.called is False
-    db.search.assert_called_once_with(
-        (Credential.login == 'foo') & (Credential.name == 'example.com')
-    )
+    assert credentials == [CREDENTIALS[0]]
+    assert db._table.search.called is False
 
 
 def test_credentials_filter_credentials_by_login_and_name_when_empty_login_fullname_passed(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch.object(db, 'search')
-    mocker.patch.object(db, 'all')
-    mocker.patch('passpie.database.split_fullname', return_value=('', 'example.com'))
-    Credential = Query()
+    db = make_memory_database(CREDENTIALS)
 
     credentials = db.credentials(fullname="@example.com")
-    assert db.search.called is True
-    assert db.all.called is False
-    db.search.assert_called_once_with(
-        (Credential.login == "") & (Credential.name == "example.com")
-    )
+    assert credentials == [CREDENTIALS[2]]
 
 
 def test_credentials_filter_credentials_by_login_and_name_when_name_only_fullname_passed(mocker):
-    config = {
-        'path': 'path',
-        'extension': '.pass',
-    }
-    db = Database(config)
-    mocker.patch.object(db, 'search')
-    mocker.patch.object(db, 'all')
-    mocker.patch('passpie.database.split_fullname', return_value=(None, 'example.com'))
-    Credential = Query()
+    db = make_memory_database(CREDENTIALS)
 
-    credentials = db.credentials(fullname="@example.com")
-    assert db.search.called is True
-    assert db.all.called is False
-    db.search.assert_called_once_with(
-        (Credential.name == "example.com")
-    )
+    credentials = db.credentials(fullname="example.com")
+    assert credentials == [CREDENTIALS[2], CREDENTIALS[1], CREDENTIALS[0]]
+
+
+def test_database_index_is_built_once_and_kept_in_sync_on_insert(mocker):
+    db = make_memory_database(CREDENTIALS[:1])
+    mocker.spy(db._table, 'all')
+    db.credential('foo@example.com')
+    db.insert(CREDENTIALS[1])
+    db.credential('bar@example.com')
+
+    assert db._table.all.call_count == 1
+    assert db.credentials('example.com') == [CREDENTIALS[1], CREDENTIALS[0]]
+    assert db.index.fullname == {'foo@example.com': {1}, 'bar@example.com': {2}}
+
+
+def test_database_purge_empties_index():
+    db = make_memory_database(CREDENTIALS)
+    db.credential('foo@example.com')
+
+    db.purge()
+
+    assert db.credentials() == []
+    assert db.index.documents == {}
 
 
 def test_database_matches_uses_table_remove_credential_from_database(mocker):
@@ -300,3 +349,791 @@ def test_database_filename_returns_expected_filename_of_credential(mocker):
     db = Database(config)
     assert db.filename("login@name") == os.path.normpath("path/name/login.pass")
     assert db.filename("@name") == os.path.normpath("path/name/.pass")
+
+
+def safe_load(content, Loader=yaml.SafeLoader, load=yaml.load):
+    return load(content, Loader=Loader)
+
+
+def make_credential_file(dirpath, name, login, content):
+    credpath = os.path.join(str(dirpath), name, login + ".pass")
+    if not os.path.isdir(os.path.dirname(credpath)):
+        os.makedirs(os.path.dirname(credpath))
+    with open(credpath, "w") as f:
+        f.write(content)
+    return credpath
+
+
+def test_storage_read_reparses_only_changed_files_from_cache(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', str(tmpdir.join('cache')))
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    credpath = make_credential_file(dbpath, 'example.com', 'bar', 'name: example.com\nlogin: bar\n')
+    mock_load = mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+
+    PasspieStorage(str(dbpath)).read()
+    assert mock_load.call_count == 2
+
+    with open(credpath, "w") as f:
+        f.write('name: example.com\nlogin: bar\ncomment: changed\n')
+    os.utime(credpath, (0, 0))
+    elements = PasspieStorage(str(dbpath)).read()["_default"].values()
+
+    assert mock_load.call_count == 3
+    assert {"name": "example.com", "login": "bar", "comment": "changed"} in elements
+
+
+def test_storage_read_cache_keeps_datetime_values(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', str(tmpdir.join('cache')))
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo',
+                         'name: example.com\nlogin: foo\nmodified: 2016-01-02 03:04:05.000006\n')
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    PasspieStorage(str(dbpath)).read()
+
+    mocker.patch('passpie.codec.yaml.load', side_effect=AssertionError)
+    elements = list(PasspieStorage(str(dbpath)).read()["_default"].values())
+
+    assert elements[0]["modified"] == datetime(2016, 1, 2, 3, 4, 5, 6)
+
+
+def test_storage_read_without_cache_path_does_not_write_cache_file(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mock_mkdir_open = mocker.patch('passpie.database.mkdir_open')
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+
+    PasspieStorage(str(dbpath)).read()
+    assert mock_mkdir_open.called is False
+
+
+def test_storage_write_only_writes_changed_credentials(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    make_credential_file(dbpath, 'example.com', 'bar', 'name: example.com\nlogin: bar\n')
+    storage = PasspieStorage(str(dbpath))
+    data = storage.read()
+    mock_mkdir_open = mocker.patch('passpie.database.mkdir_open', wraps=mkdir_open)
+
+    for cred in data["_default"].values():
+        if cred["login"] == "bar":
+            cred["comment"] = "changed"
+    storage.write(data)
+
+    assert mock_mkdir_open.call_count == 1
+    tmppath = str(dbpath.join('example.com', '.bar.pass.tmp'))
+    mock_mkdir_open.assert_called_once_with(tmppath, "w")
+    assert os.path.exists(tmppath) is False
+
+
+@pytest.mark.parametrize('durability,file_fsyncs', [
+    ('fast', 0),
+    ('safe', 2),
+    ('paranoid', 2),
+])
+def test_storage_write_renames_temporary_files_and_flushes_by_durability(
+        mocker, tmpdir, durability, file_fsyncs):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch.object(PasspieStorage, 'durability', durability)
+    mock_sync = mocker.patch('passpie.database.os.sync', create=True)
+    mock_fsync = mocker.patch('passpie.database.os.fsync')
+    mock_fsync_dir = mocker.patch('passpie.database.fsync_dir')
+    dbpath = tmpdir.join('db')
+    storage = PasspieStorage(str(dbpath))
+
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"},
+                                2: {"name": "example.org", "login": "foo"}}})
+
+    assert sorted(os.listdir(str(dbpath.join('example.com')))) == ['foo.pass']
+    assert mock_sync.called is False
+    assert mock_fsync.call_count == file_fsyncs
+    if durability == 'fast':
+        assert mock_fsync_dir.called is False
+    else:
+        flushed = set(c[0][0] for c in mock_fsync_dir.call_args_list)
+        assert flushed == set([str(dbpath), str(dbpath.join('example.com')),
+                               str(dbpath.join('example.org'))])
+
+
+def test_storage_write_removes_stale_temporary_files(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    make_credential_file(tmpdir, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    tmpdir.join('example.com', '.bar.pass.tmp').write('name: example.com\nlogin: bar\n')
+    storage = PasspieStorage(str(tmpdir))
+
+    data = storage.read()
+    data["_default"][2] = {"name": "example.org", "login": "foo"}
+    storage.write(data)
+
+    assert sorted(os.listdir(str(tmpdir.join('example.com')))) == ['foo.pass']
+    assert sorted(os.listdir(str(tmpdir.join('example.org')))) == ['foo.pass']
+
+
+def test_packed_storage_write_removes_stale_compaction_file(tmpdir):
+    tmpdir.join('credentials.pack.tmp').write('partial')
+    storage = PackedStorage(str(tmpdir))
+
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"}}})
+
+    assert os.listdir(str(tmpdir)) == ['credentials.pack']
+
+
+def test_database_raises_value_error_for_unknown_durability():
+    with pytest.raises(ValueError):
+        Database({'path': 'path', 'extension': '.pass', 'durability': 'unknown'})
+
+
+def test_sqlite_storage_maps_durability_to_synchronous_pragma(mocker, tmpdir):
+    mocker.patch.object(SQLiteStorage, 'durability', 'fast')
+    storage = SQLiteStorage(str(tmpdir))
+
+    assert storage.connection.execute("PRAGMA synchronous").fetchone() == (0,)
+
+
+def test_storage_write_unlinks_only_removed_credentials(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    foo_path = make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    bar_path = make_credential_file(dbpath, 'example.com', 'bar', 'name: example.com\nlogin: bar\n')
+    os.utime(foo_path, (0, 0))
+    storage = PasspieStorage(str(dbpath))
+    data = storage.read()
+
+    data["_default"] = {eid: cred for eid, cred in data["_default"].items()
+                        if cred["login"] == "foo"}
+    storage.write(data)
+
+    assert os.path.exists(bar_path) is False
+    assert os.stat(foo_path).st_mtime == 0
+
+
+def test_storage_walk_skips_dot_directories_and_non_credential_files(tmpdir):
+    dbpath = tmpdir.join('db')
+    credpath = make_credential_file(dbpath, 'example.com', 'foo', '')
+    empty_login_path = make_credential_file(dbpath, 'example.com', '', '')
+    make_credential_file(dbpath, '.git', 'objects', '')
+    make_credential_file(dbpath.join('.git'), 'refs', 'heads', '')
+    dbpath.join('.keys').write('')
+    dbpath.join('.config').write('')
+    dbpath.join('example.com', 'notes.txt').write('')
+
+    found = sorted(PasspieStorage(str(dbpath)).walk())
+
+    assert found == sorted([credpath, empty_login_path])
+
+
+def test_storage_walk_enters_nested_name_directories(tmpdir):
+    dbpath = tmpdir.join('db')
+    storage = PasspieStorage(str(dbpath))
+    credpath = make_credential_file(dbpath, os.path.join('example.com', 'admin'), 'foo', '')
+
+    assert list(storage.walk()) == [credpath]
+    assert credpath == storage.make_credpath(os.path.join('example.com', 'admin'), 'foo')
+
+
+def test_storage_split_passwords_keeps_ciphertext_out_of_metadata(mocker, tmpdir):
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    dbpath = str(tmpdir)
+    db = Database({'path': dbpath, 'extension': '.pass', 'split_passwords': True})
+    db.add(fullname='foo@example.com', password='-----PGP-----', comment='')
+
+    credpath = os.path.join(dbpath, 'example.com', 'foo.pass')
+    with open(credpath) as f:
+        assert 'PGP' not in f.read()
+    assert 'password' not in db.credential('foo@example.com')
+
+    mocker.spy(PasspieStorage, 'load_password')
+    credentials = db.credentials()
+    assert 'password' not in credentials[0]
+    assert PasspieStorage.load_password.call_count == 0
+    assert db.password(credentials[0]) == '-----PGP-----'
+
+
+def test_storage_split_passwords_moves_and_removes_password_files(mocker, tmpdir):
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    dbpath = str(tmpdir)
+    db = Database({'path': dbpath, 'extension': '.pass', 'split_passwords': True})
+    db.add(fullname='foo@example.com', password='s3cr3t', comment='')
+    credential = db.credential('foo@example.com')
+    db.update('foo@example.com', dict(credential, login='bar'))
+
+    assert db.password(db.credential('bar@example.com')) == 's3cr3t'
+    assert not os.path.exists(os.path.join(dbpath, '.passwords', 'example.com', 'foo.gpg'))
+
+    db.remove('bar@example.com')
+    assert os.listdir(dbpath) == []
+
+
+def test_storage_split_passwords_writes_binary_packets_to_password_file(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    dbpath = str(tmpdir)
+    db = Database({'path': dbpath, 'extension': '.pass', 'split_passwords': True})
+    db.add(fullname='foo@example.com', password='hQEOAw==', comment='')
+
+    with open(os.path.join(dbpath, '.passwords', 'example.com', 'foo.gpg'), 'rb') as f:
+        assert f.read() == b'\x85\x01\x0e\x03'
+    assert db.password(db.credentials()[0]) == 'hQEOAw=='
+
+
+def test_database_password_falls_back_to_inline_password(mocker, tmpdir):
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    make_credential_file(tmpdir, 'example.com', 'foo',
+                         'name: example.com\nlogin: foo\npassword: s3cr3t\n')
+    db = Database({'path': str(tmpdir), 'extension': '.pass', 'split_passwords': True})
+
+    assert db._storage.load_password('example.com', 'foo') == 's3cr3t'
+
+
+def test_storage_migrate_format_rewrites_every_credential_file(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    make_credential_file(tmpdir, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    make_credential_file(tmpdir, 'example.org', 'bar', 'name: example.org\nlogin: bar\n')
+    db = Database({'path': str(tmpdir), 'extension': '.pass'})
+
+    assert db.migrate_format('json') is True
+
+    with open(str(tmpdir.join('example.com', 'foo.pass'))) as f:
+        assert json.load(f) == {'name': 'example.com', 'login': 'foo'}
+    db = Database({'path': str(tmpdir), 'extension': '.pass'})
+    assert [c['login'] for c in db.credentials()] == ['foo', 'bar']
+
+
+def test_database_raises_value_error_for_unknown_format():
+    with pytest.raises(ValueError):
+        Database({'path': 'path', 'extension': '.pass', 'format': 'xml'})
+
+
+def test_storage_shards_name_directories_under_hash_prefix(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    dbpath = str(tmpdir)
+    db = Database({'path': dbpath, 'extension': '.pass', 'shard_length': 2})
+    db.add(fullname='foo@example.com', password='s3cr3t', comment='')
+
+    credpath = os.path.join(dbpath, '0c', 'example.com', 'foo.pass')
+    assert db.filename('foo@example.com') == credpath
+    assert os.path.isfile(credpath)
+    assert db.credential('foo@example.com')['login'] == 'foo'
+
+    db.remove('foo@example.com')
+    assert os.listdir(dbpath) == []
+
+
+def test_storage_sharding_moves_flat_credentials_on_next_write(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    make_credential_file(tmpdir, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    db = Database({'path': str(tmpdir), 'extension': '.pass', 'shard_length': 2})
+
+    assert db.credential('foo@example.com')['login'] == 'foo'
+
+    db.add(fullname='bar@example.org', password='s3cr3t', comment='')
+    assert sorted(os.listdir(str(tmpdir))) == ['0c', '20']
+    assert db.credential('foo@example.com')['login'] == 'foo'
+
+
+def test_storage_sharding_moves_flat_password_files_into_shards(mocker, tmpdir):
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    dbpath = str(tmpdir)
+    db = Database({'path': dbpath, 'extension': '.pass', 'split_passwords': True})
+    db.add(fullname='foo@example.com', password='s3cr3t', comment='')
+    db.add(fullname='bar@example.org', password='p4ss', comment='')
+
+    db = Database({'path': dbpath, 'extension': '.pass', 'split_passwords': True,
+                   'shard_length': 2})
+    assert db.password(db.credential('foo@example.com')) == 's3cr3t'
+    db.add(fullname='baz@example.com', password='0th3r', comment='')
+
+    assert sorted(os.listdir(dbpath)) == ['.passwords', '0c', '20']
+    assert sorted(os.listdir(os.path.join(dbpath, '.passwords'))) == ['0c', '20']
+    assert os.path.isfile(os.path.join(dbpath, '.passwords', '0c', 'example.com', 'foo.gpg'))
+    db = Database({'path': dbpath, 'extension': '.pass', 'split_passwords': True,
+                   'shard_length': 2})
+    assert [db.password(c) for c in db.credentials()] == ['0th3r', 's3cr3t', 'p4ss']
+
+
+def test_database_credentials_with_indexed_fields_read_index_file_only(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', str(tmpdir.join('cache')))
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\ncomment: spam\n')
+    make_credential_file(dbpath, 'example.org', 'bar', 'name: example.org\nlogin: bar\n')
+    config = {'path': str(dbpath), 'extension': '.pass', 'cache_path': str(tmpdir.join('cache'))}
+    Database(config).credentials()
+
+    mock_load = mocker.patch('passpie.database.load_credential', side_effect=AssertionError)
+    mocker.patch('passpie.database.json.load', side_effect=AssertionError)
+    db = Database(config)
+    credentials = db.credentials(fields=['name', 'login', 'comment'])
+
+    assert [c['fullname'] for c in credentials] == ['foo@example.com', 'bar@example.org']
+    assert [c['fullname'] for c in db.matches('spa', fields=['name'])] == ['foo@example.com']
+    assert mock_load.called is False
+
+
+def test_database_credentials_rebuilds_stale_index_file(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', str(tmpdir.join('cache')))
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    config = {'path': str(dbpath), 'extension': '.pass', 'cache_path': str(tmpdir.join('cache'))}
+    Database(config).credentials()
+
+    make_credential_file(dbpath, 'example.com', 'foo',
+                         'name: example.com\nlogin: foo\ncomment: changed\n')
+    os.utime(str(dbpath.join('example.com', 'foo.pass')), (0, 0))
+    credentials = Database(config).credentials(fields=['comment'])
+
+    assert credentials[0]['comment'] == 'changed'
+    mocker.patch('passpie.database.load_credential', side_effect=AssertionError)
+    assert Database(config).credentials(fields=['comment'])[0]['comment'] == 'changed'
+
+
+def test_database_iter_credentials_yields_sorted_credentials_one_file_at_a_time(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.org', 'foo', 'name: example.org\nlogin: foo\n')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    make_credential_file(dbpath, 'example.com', 'bar', 'name: example.com\nlogin: bar\n')
+    db = Database({'path': str(dbpath), 'extension': '.pass'})
+    mock_load = mocker.patch('passpie.database.load_credential', wraps=load_credential)
+
+    credentials = db.iter_credentials()
+    first = next(credentials)
+
+    assert isinstance(first, Credential)
+    assert first.sort_key == 'example.combar'
+    assert mock_load.call_count == 1
+    assert [c.sort_key for c in credentials] == ['example.comfoo', 'example.orgfoo']
+
+
+def test_database_iter_credentials_with_indexed_fields_reads_index_file_only(mocker, tmpdir):
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.org', 'foo', 'name: example.org\nlogin: foo\n')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    config = {'path': str(dbpath), 'extension': '.pass', 'cache_path': str(tmpdir.join('cache'))}
+    Database(config).credentials()
+
+    mock_load = mocker.patch('passpie.database.load_credential', side_effect=AssertionError)
+    credentials = Database(config).iter_credentials(fields=['fullname'])
+
+    assert [c['fullname'] for c in credentials] == ['foo@example.com', 'foo@example.org']
+    assert mock_load.called is False
+
+
+def test_packed_and_sqlite_storages_iterate_in_storage_or_sorted_order(tmpdir):
+    data = {"_default": {1: {"name": "example.org", "login": "foo"},
+                         2: {"name": "example.com", "login": "foo"}}}
+    for storage in (PackedStorage(str(tmpdir.join('packed'))),
+                    SQLiteStorage(str(tmpdir.join('sqlite')))):
+        storage.write(data)
+
+        assert [c["name"] for c in storage.iterate()] == ["example.com", "example.org"]
+        assert [c["name"] for c in storage.iterate(sorted=False)] == ["example.org", "example.com"]
+
+
+def test_storages_prefixed_return_names_starting_with_prefix_in_order(mocker, tmpdir):
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    data = {"_default": {1: {"name": "github.com", "login": "foo"},
+                         2: {"name": "git", "login": "hub"},
+                         3: {"name": "github.com", "login": "bar"},
+                         4: {"name": "gitlab.com", "login": "foo"}}}
+    for storage in (PackedStorage(str(tmpdir.join('packed'))),
+                    SQLiteStorage(str(tmpdir.join('sqlite'))),
+                    PasspieStorage(str(dbpath))):
+        storage.write(data)
+
+        assert [(c["name"], c["login"]) for c in storage.prefixed("gith")] == [
+            ("github.com", "bar"), ("github.com", "foo")]
+        assert len(storage.prefixed("git")) == 4
+        assert storage.prefixed("[") == []
+
+
+def test_storage_prefixed_parses_only_matching_files(mocker, tmpdir):
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.org', 'foo',
+                         'fullname: foo@example.org\nname: example.org\nlogin: foo\n')
+    make_credential_file(dbpath, 'example.com', 'foo',
+                         'fullname: foo@example.com\nname: example.com\nlogin: foo\n')
+    config = {'path': str(dbpath), 'extension': '.pass', 'cache_path': str(tmpdir.join('cache'))}
+    Database(config).credentials()
+    mocker.patch('passpie.database.json.load', side_effect=ValueError)
+    mock_load = mocker.patch('passpie.database.load_credential', wraps=load_credential)
+
+    credentials = Database(config).prefixed('example.o')
+
+    assert [c['fullname'] for c in credentials] == ['foo@example.org']
+    assert mock_load.call_count == 1
+
+
+def test_database_columns_read_columns_file_and_rebuild_when_files_change(mocker, tmpdir):
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.org', 'foo',
+                         'name: example.org\nlogin: foo\nmodified: 2016-01-02 00:00:00\n')
+    config = {'path': str(dbpath), 'extension': '.pass', 'cache_path': str(tmpdir.join('cache'))}
+    Database(config).credentials()
+
+    mocker.patch('passpie.database.index.load', side_effect=AssertionError)
+    mock_load = mocker.patch('passpie.database.load_credential', wraps=load_credential)
+    assert Database(config).columns().fullname(0) == 'foo@example.org'
+    assert mock_load.called is False
+
+    mocker.patch('passpie.database.index.load', return_value=None)
+    make_credential_file(dbpath, 'example.com', 'bar', 'name: example.com\nlogin: bar\n')
+    built = Database(config).columns()
+    assert [built.fullname(i) for i in range(len(built))] == ['bar@example.com', 'foo@example.org']
+    assert mock_load.call_count == 1
+
+
+def test_database_columns_saves_columns_rebuilt_from_valid_index(mocker, tmpdir):
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.org', 'foo', 'name: example.org\nlogin: foo\n')
+    config = {'path': str(dbpath), 'extension': '.pass', 'cache_path': str(tmpdir.join('cache'))}
+    Database(config).credentials()
+    columns_files = tmpdir.join('cache').listdir(lambda p: p.ext == '.col')
+    columns_files[0].remove()
+
+    mock_summaries = mocker.patch.object(PasspieStorage, 'summaries',
+                                         wraps=PasspieStorage(str(dbpath)).summaries)
+    assert Database(config).columns().fullname(0) == 'foo@example.org'
+    assert columns_files[0].check() is True
+    assert Database(config).columns().fullname(0) == 'foo@example.org'
+    assert mock_summaries.call_count == 1
+
+
+def test_storage_find_with_login_opens_only_credential_file(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mock_load = mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    make_credential_file(dbpath, 'example.com', 'bar', 'name: example.com\nlogin: bar\n')
+    make_credential_file(dbpath, 'example.org', 'foo', 'name: example.org\nlogin: foo\n')
+    storage = PasspieStorage(str(dbpath))
+
+    assert storage.find('example.com', 'foo') == [{'name': 'example.com', 'login': 'foo'}]
+    assert storage.find('example.com', 'spam') == []
+    assert mock_load.call_count == 1
+
+
+def test_storage_find_name_only_scans_only_name_directory(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mock_load = mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    make_credential_file(dbpath, 'example.com', 'foo', 'name: example.com\nlogin: foo\n')
+    make_credential_file(dbpath, 'example.com', 'bar', 'name: example.com\nlogin: bar\n')
+    make_credential_file(dbpath, 'example.org', 'foo', 'name: example.org\nlogin: foo\n')
+    storage = PasspieStorage(str(dbpath))
+
+    found = storage.find('example.com')
+
+    assert [c['login'] for c in found] == ['bar', 'foo']
+    assert mock_load.call_count == 2
+
+
+def test_database_credential_uses_storage_find_without_reading_database(mocker):
+    config = {
+        'path': 'path',
+        'extension': '.pass',
+    }
+    mock_read = mocker.patch.object(PasspieStorage, 'read')
+    credential = {'name': 'example.com', 'login': 'foo'}
+    mock_find = mocker.patch.object(PasspieStorage, 'find', return_value=[credential])
+    db = Database(config)
+
+    assert db.credential('foo@example.com') == credential
+    assert db.credentials('example.com') == [credential]
+    mock_find.assert_any_call('example.com', 'foo')
+    mock_find.assert_any_call('example.com', None)
+    assert mock_read.called is False
+
+
+def test_database_credential_returns_none_when_storage_find_is_empty(mocker):
+    config = {
+        'path': 'path',
+        'extension': '.pass',
+    }
+    mocker.patch.object(PasspieStorage, 'find', return_value=[])
+    db = Database(config)
+
+    assert db.credential('foo@example.com') is None
+
+
+def test_packed_storage_appends_only_changed_records(tmpdir):
+    storage = PackedStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"},
+                                2: {"name": "example.com", "login": "bar"}}})
+    data = storage.read()
+    data["_default"][2]["comment"] = "changed"
+    del data["_default"][1]
+    storage.write(data)
+
+    with open(storage.logpath) as f:
+        headers = [json.loads(line.split("\t")[0]) for line in f]
+    assert len(headers) == 4
+    assert headers[2:] == [["del", "example.com", "foo"], ["put", "example.com", "bar"]]
+    assert list(PackedStorage(str(tmpdir)).read()["_default"].values()) == [
+        {"name": "example.com", "login": "bar", "comment": "changed"}]
+
+
+def test_packed_storage_find_reads_only_live_record_from_offset(mocker, tmpdir):
+    storage = PackedStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"},
+                                2: {"name": "example.org", "login": "foo"}}})
+    storage = PackedStorage(str(tmpdir))
+    mocker.spy(storage, 'decode')
+
+    assert storage.find('example.org', 'foo') == [{"name": "example.org", "login": "foo"}]
+    assert storage.find('example.net', 'foo') == []
+    assert storage.decode.call_count == 1
+
+
+def test_packed_storage_compact_keeps_only_live_records(tmpdir):
+    storage = PackedStorage(str(tmpdir))
+    for comment in ("one", "two", "three"):
+        storage.write({"_default": {1: {"name": "example.com", "login": "foo",
+                                        "comment": comment}}})
+
+    storage.compact()
+
+    with open(storage.logpath) as f:
+        assert len(f.readlines()) == 1
+    assert PackedStorage(str(tmpdir)).find('example.com', 'foo')[0]["comment"] == "three"
+
+
+def test_packed_storage_ignores_incomplete_trailing_record(tmpdir):
+    storage = PackedStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"}}})
+    with open(storage.logpath, "a") as f:
+        f.write('["put", "example.com", "bar"]\t{"name": "exa')
+
+    assert len(PackedStorage(str(tmpdir)).read()["_default"]) == 1
+
+
+def test_packed_storage_truncates_incomplete_record_before_appending(tmpdir):
+    storage = PackedStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"}}})
+    with open(storage.logpath, "a") as f:
+        f.write('["put", "example.com", "bar"]\t{"name": "exa')
+
+    storage = PackedStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"},
+                                2: {"name": "example.org", "login": "spam"}}})
+
+    with open(storage.logpath) as f:
+        assert [json.loads(line.split("\t")[0]) for line in f] == [
+            ["put", "example.com", "foo"], ["put", "example.org", "spam"]]
+    assert sorted(c["login"] for c in PackedStorage(str(tmpdir)).read()["_default"].values()) == [
+        "foo", "spam"]
+
+
+def test_packed_storage_skips_damaged_records(tmpdir):
+    storage = PackedStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"}}})
+    with open(storage.logpath, "a") as f:
+        f.write('["put", "example.com", "bar"]\t{"na["put", "example.org", "baz"]\t{}\n')
+        f.write('not json\t{}\n')
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"},
+                                2: {"name": "example.org", "login": "spam"}}})
+
+    assert sorted(c["login"] for c in PackedStorage(str(tmpdir)).read()["_default"].values()) == [
+        "foo", "spam"]
+
+
+def test_packed_storage_migrates_directory_layout(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    credpath = make_credential_file(dbpath, 'example.com', 'foo',
+                                    'name: example.com\nlogin: foo\n')
+
+    storage = PackedStorage(str(dbpath))
+
+    assert storage.find('example.com', 'foo') == [{"name": "example.com", "login": "foo"}]
+    assert os.path.exists(credpath) is False
+    assert os.path.exists(storage.logpath) is True
+
+
+@pytest.mark.parametrize('storage_name', ['packed', 'sqlite'])
+def test_storage_migrates_split_passwords_from_directory_layout(mocker, tmpdir, storage_name):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = str(tmpdir)
+    db = Database({'path': dbpath, 'extension': '.pass', 'split_passwords': True})
+    db.add(fullname='foo@example.com', password='s3cr3t', comment='')
+
+    db = Database({'path': dbpath, 'extension': '.pass', 'storage': storage_name})
+
+    assert db.password(db.credential('foo@example.com')) == 's3cr3t'
+    assert not os.path.exists(os.path.join(dbpath, '.passwords'))
+
+
+def test_database_selects_storage_from_config():
+    config = {
+        'path': 'path',
+        'extension': '.pass',
+        'storage': 'packed',
+    }
+    assert isinstance(Database(config)._storage.storage, PackedStorage)
+    assert Database(config).filename('foo@example.com') is None
+
+
+def test_sqlite_storage_reads_written_credentials_with_stable_ids(tmpdir):
+    storage = SQLiteStorage(str(tmpdir))
+    modified = datetime(2016, 1, 2, 3, 4, 5)
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo", "modified": modified},
+                                2: {"name": "example.com", "login": "bar"}}})
+
+    data = SQLiteStorage(str(tmpdir)).read()
+
+    assert data == {"_default": {1: {"name": "example.com", "login": "foo", "modified": modified},
+                                 2: {"name": "example.com", "login": "bar"}}}
+
+
+def test_sqlite_storage_write_deletes_and_updates_only_changed_rows(tmpdir):
+    storage = SQLiteStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.com", "login": "foo"},
+                                2: {"name": "example.com", "login": "bar"}}})
+    statements = []
+    storage.connection.set_trace_callback(statements.append)
+
+    storage.write({"_default": {2: {"name": "example.com", "login": "bar", "comment": "new"}}})
+
+    assert len([s for s in statements if s.startswith("DELETE")]) == 1
+    assert len([s for s in statements if s.startswith("INSERT")]) == 1
+    assert storage.find("example.com") == [{"name": "example.com", "login": "bar", "comment": "new"}]
+
+
+def test_sqlite_storage_find_ordered_and_matches_run_in_sql(tmpdir):
+    storage = SQLiteStorage(str(tmpdir))
+    storage.write({"_default": {1: {"name": "example.org", "login": "foo", "comment": ""},
+                                2: {"name": "example.com", "login": "spam", "comment": "eggs"},
+                                3: {"name": "example.com", "login": "bar", "comment": ""}}})
+
+    assert [c["login"] for c in storage.find("example.com")] == ["bar", "spam"]
+    assert storage.find("example.com", "foo") == []
+    assert [c["name"] + c["login"] for c in storage.ordered()] == [
+        "example.combar", "example.comspam", "example.orgfoo"]
+    assert [c["login"] for c in storage.matches("eg+s")] == ["spam"]
+    assert [c["login"] for c in storage.matches(".*org")] == ["foo"]
+
+
+def test_database_matches_and_credentials_use_storage_queries_when_available(mocker):
+    config = {
+        'path': 'path',
+        'extension': '.pass',
+        'storage': 'sqlite',
+    }
+    mock_ordered = mocker.patch.object(SQLiteStorage, 'ordered', return_value=[])
+    mock_matches = mocker.patch.object(SQLiteStorage, 'matches', return_value=[])
+    db = Database(config)
+
+    assert db.credentials() == []
+    assert db.matches('foo') == []
+    assert mock_ordered.called is True
+    mock_matches.assert_called_once_with('foo')
+
+
+def make_numbered_database(dbpath, number):
+    for i in range(number):
+        make_credential_file(dbpath, 'name{}'.format(i % 3), 'login{}'.format(i),
+                             'name: name{}\nlogin: login{}\n'.format(i % 3, i))
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_storage_read_with_workers_returns_same_credentials_in_same_order(mocker, tmpdir, pool):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    dbpath = tmpdir.join('db')
+    make_numbered_database(dbpath, 20)
+    expected = PasspieStorage(str(dbpath)).read()
+
+    mocker.patch.object(PasspieStorage, 'workers', 4)
+    mocker.patch.object(PasspieStorage, 'pool', pool)
+    result = PasspieStorage(str(dbpath)).read()
+
+    assert list(result["_default"].items()) == list(expected["_default"].items())
+
+
+def test_storage_read_with_workers_parses_only_stale_files_in_pool(mocker, tmpdir):
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch.object(PasspieStorage, 'workers', 4)
+    mocker.patch('passpie.codec.yaml.load', side_effect=safe_load)
+    mock_executor = mocker.patch('passpie.database.ThreadPoolExecutor')
+    executor = mock_executor.return_value
+    executor.__enter__.return_value = executor
+    executor.map.side_effect = lambda func, paths, chunksize: map(func, paths)
+    dbpath = tmpdir.join('db')
+    make_numbered_database(dbpath, 5)
+    storage = PasspieStorage(str(dbpath))
+    storage.read()
+    storage.read()
+
+    assert executor.map.call_count == 1
+    mock_executor.assert_called_once_with(max_workers=4)
+
+
+def test_database_data_key_is_created_once_and_unwrapped_with_passphrase(mocker, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mock_write_key = mocker.patch('passpie.database.envelope.write_key',
+                                  side_effect=lambda path, *args: tmpdir.join('.vaultkey').write(''))
+    mock_read_key = mocker.patch('passpie.database.envelope.read_key', return_value=b'k' * 32)
+    config = {'path': str(tmpdir), 'extension': '.pass', 'recipient': 'r', 'homedir': 'h',
+              'envelope': 'aes-gcm'}
+
+    created = Database(config).data_key(create=True)
+    unwrapped = Database(config).data_key('passphrase', create=True)
+
+    assert mock_write_key.call_count == 1
+    assert mock_write_key.call_args[0][1] == created
+    assert unwrapped == b'k' * 32
+    mock_read_key.assert_called_with(str(tmpdir), 'r', 'passphrase', 'h')
+
+
+@pytest.mark.skipif(envelope.AESGCM is None, reason='cryptography is not installed')
+def test_database_set_data_key_replaces_data_key_once_batch_is_written(mocker, tmpdir):
+    mocker.patch('passpie.database.Repository')
+    mocker.patch.object(PasspieStorage, 'cache_path', None)
+    mocker.patch('passpie.envelope.crypt.encrypt', side_effect=lambda data, *args: data)
+    mocker.patch('passpie.envelope.crypt.decrypt', side_effect=lambda data, *args: data)
+    config = {'path': str(tmpdir), 'extension': '.pass', 'recipient': 'r', 'homedir': 'h',
+              'envelope': 'aes-gcm'}
+    db = Database(config)
+    old_key = db.data_key(create=True)
+    db.add('foo@example.com', envelope.seal(old_key, u's3cr3t'), '')
+
+    def reset(key):
+        with db.batch():
+            db.set_data_key(key)
+            db.purge()
+            db.add('foo@example.com', envelope.seal(key, u's3cr3t'), '')
+
+    # the credentials are not written, the old key stays
+    mock_write = mocker.patch.object(PasspieStorage, 'write', side_effect=IOError)
+    with pytest.raises(IOError):
+        reset(envelope.new_key())
+    mocker.stop(mock_write)
+    db = Database(config)
+    assert db.data_key() == old_key
+
+    # the credentials are written but the key is not swapped in, both open
+    mock_commit_key = mocker.patch('passpie.database.envelope.commit_key', side_effect=OSError)
+    with pytest.raises(OSError):
+        reset(envelope.new_key())
+    mocker.stop(mock_commit_key)
+    db = Database(config)
+    password = db.password(db.credential('foo@example.com'))
+    assert envelope.unseal(db.data_key(), password) is None
+    assert envelope.unseal_any(db.data_keys(), password) == u's3cr3t'
+
+    new_key = envelope.new_key()
+    reset(new_key)
+    assert db.data_key() == new_key
+    assert Database(config).data_key() == new_key
+    assert not tmpdir.join('.vaultkey.new').check()
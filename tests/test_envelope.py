@@ -0,0 +1,82 @@
+import base64
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from passpie import envelope
+
+
+@pytest.mark.parametrize('name', envelope.CIPHERS)
+def test_seal_and_unseal_round_trip_and_reject_other_keys(name):
+    key = envelope.new_key()
+    sealed = envelope.seal(key, u'sécret', name)
+
+    assert sealed.startswith('$passpie${}$'.format(name))
+    assert envelope.is_sealed(sealed) is True
+    assert envelope.unseal(key, sealed) == u'sécret'
+    assert envelope.unseal(envelope.new_key(), sealed) is None
+    assert envelope.unseal(key, sealed.replace('$passpie$', '$passpie$x', 1)) is None
+
+
+def test_seal_names_key_and_unseal_any_opens_with_that_key():
+    keys = [envelope.new_key(), envelope.new_key()]
+    sealed = envelope.seal(keys[1], u's3cr3t')
+
+    assert sealed.split('$')[3] == envelope.key_id(keys[1])
+    assert envelope.unseal(keys[0], sealed) is None
+    assert envelope.unseal_any(keys, sealed) == u's3cr3t'
+    assert envelope.unseal_any(keys[:1], sealed) is None
+
+
+def test_unseal_opens_passwords_sealed_without_key_id():
+    key = envelope.new_key()
+    nonce = b'n' * envelope.NONCE_SIZE
+    header = '$passpie$aes-gcm$'
+    ciphertext = envelope.AESGCM(key).encrypt(nonce, b's3cr3t', header.encode('ascii'))
+    sealed = header + base64.b64encode(nonce + ciphertext).decode('ascii')
+
+    assert envelope.unseal(key, sealed) == u's3cr3t'
+
+
+def test_is_sealed_is_false_for_openpgp_messages():
+    assert envelope.is_sealed('-----BEGIN PGP MESSAGE-----') is False
+    assert envelope.is_sealed('hQEMA9a8') is False
+    assert envelope.is_sealed(None) is False
+
+
+def test_check_raises_value_error_for_unknown_cipher():
+    envelope.check('aes-gcm')
+    with pytest.raises(ValueError):
+        envelope.check('rot13')
+
+
+def test_write_key_wraps_key_to_recipient_and_read_key_unwraps_it(mocker, tmpdir):
+    mock_encrypt = mocker.patch('passpie.envelope.crypt.encrypt', return_value='wrapped')
+    key = envelope.new_key()
+    mock_decrypt = mocker.patch('passpie.envelope.crypt.decrypt',
+                                return_value=base64.b64encode(key).decode('ascii') + '\n')
+
+    envelope.write_key(str(tmpdir), key, 'recipient', 'homedir')
+
+    assert tmpdir.join('.vaultkey').read() == 'wrapped'
+    assert tmpdir.listdir() == [tmpdir.join('.vaultkey')]
+    mock_encrypt.assert_called_once_with(base64.b64encode(key).decode('ascii'),
+                                         'recipient', 'homedir')
+    assert envelope.read_key(str(tmpdir), 'recipient', 'passphrase', 'homedir') == key
+    mock_decrypt.assert_called_once_with('wrapped', 'recipient', 'passphrase', 'homedir')
+    mock_decrypt.return_value = ''
+    assert envelope.read_key(str(tmpdir), 'recipient', 'wrong', 'homedir') is None
+
+
+def test_write_key_pending_writes_side_file_that_commit_key_swaps_in(mocker, tmpdir):
+    mocker.patch('passpie.envelope.crypt.encrypt', side_effect=lambda data, *args: data)
+    tmpdir.join('.vaultkey').write('old')
+    key = envelope.new_key()
+
+    envelope.write_key(str(tmpdir), key, 'recipient', 'homedir', pending=True)
+    assert tmpdir.join('.vaultkey').read() == 'old'
+
+    envelope.commit_key(str(tmpdir))
+    assert tmpdir.listdir() == [tmpdir.join('.vaultkey')]
+    assert tmpdir.join('.vaultkey').read() == base64.b64encode(key).decode('ascii')
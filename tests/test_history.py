@@ -1,5 +1,6 @@
 import pytest
 from passpie.history import ensure_git, Repository, clone
+from passpie.utils import FileLock
 
 
 @pytest.fixture
@@ -190,3 +191,15 @@ def test_reset_call_git_reset_hard_on_commit_when_found(mocker, mock_process):
     repo.reset(index)
 
     mock_process.call.assert_called_once_with(cmd, cwd=repo.path)
+
+
+def test_repository_commits_holding_exclusive_lock(mocker, mock_process, tmpdir):
+    lock = FileLock(str(tmpdir))
+    modes = []
+    mock_process.call.side_effect = lambda *args, **kwargs: modes.append(lock.mode)
+
+    repo = Repository(str(tmpdir), lock=lock)
+    repo.commit('message')
+
+    assert modes == ['exclusive', 'exclusive']
+    assert lock.mode is None
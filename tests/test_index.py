@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from passpie import index
+
+
+def test_index_load_returns_dumped_records(tmpdir):
+    credential = {'name': 'example.com', 'login': 'foo', 'comment': None,
+                  'password': 's3cr3t', 'modified': datetime(2016, 5, 1, 12, 30, 15, 120)}
+    filename = str(tmpdir.join('index.idx'))
+    with open(filename, 'wb') as f:
+        f.write(index.dumps([('example.com/foo.pass', [1.5, 10, 42], credential)]))
+
+    records = index.load(filename)
+
+    assert records == [('example.com/foo.pass', [1.5, 10, 42], {
+        'fullname': 'foo@example.com',
+        'name': 'example.com',
+        'login': 'foo',
+        'comment': None,
+        'modified': datetime(2016, 5, 1, 12, 30, 15, 120),
+    })]
+
+
+def test_index_dumps_interns_repeated_strings():
+    records = [('example.com/{}.pass'.format(login), [0, 0, 0],
+                {'name': 'example.com', 'login': login, 'comment': 'shared'})
+               for login in ('foo', 'bar')]
+
+    content = index.dumps(records)
+
+    assert content.count(b'\0example.com\0') == 1
+    assert content.count(b'shared\0') == 1
+
+
+def test_index_load_returns_none_for_missing_or_invalid_file(tmpdir):
+    filename = str(tmpdir.join('index.idx'))
+    assert index.load(filename) is None
+
+    with open(filename, 'wb') as f:
+        f.write(b'not an index file')
+    assert index.load(filename) is None
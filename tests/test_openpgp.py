@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+pytest.importorskip('cryptography')
+
+import passpie.crypt
+from passpie import openpgp, process
+from passpie.crypt import GPGBackend
+from passpie.utils import which
+
+
+@pytest.fixture
+def keys_path(tmpdir):
+    path = str(tmpdir.join('.keys'))
+    openpgp.OpenPGPBackend().create_keys(u'pässphrase', path, key_length=1024)
+    return path
+
+
+@pytest.fixture
+def homedir(keys_path, tmpdir):
+    return openpgp.OpenPGPBackend().import_keys(keys_path, str(tmpdir.mkdir('homedir')))
+
+
+def test_enarmor_and_dearmor_round_trip_and_check_crc():
+    armored = openpgp.enarmor('MESSAGE', b'\x85\x01data')
+    body, checksum = armored.rsplit('\n=', 1)
+
+    assert openpgp.dearmor(armored) == [('MESSAGE', b'\x85\x01data')]
+    with pytest.raises(ValueError):
+        openpgp.dearmor(body + '\n=AAAA' + checksum[4:])
+
+
+def test_read_packets_reads_old_format_and_partial_body_lengths():
+    old_format = b'\xac\x03lit'
+    partial = b'\xcb\xe1ab' + b'\x01c'
+
+    assert list(openpgp.read_packets(old_format + partial)) == [(11, b'lit'), (11, b'abc')]
+
+
+def test_openpgp_backend_round_trips_armored_and_binary_messages(homedir):
+    backend = openpgp.OpenPGPBackend()
+    recipient = backend.get_default_recipient(homedir)
+
+    armored = backend.encrypt(u'sécret', recipient, homedir)
+    binary = backend.encrypt(u'sécret', recipient, homedir, armor=False)
+
+    assert armored.startswith('-----BEGIN PGP MESSAGE-----')
+    assert passpie.crypt.binary_packets(binary) is not None
+    assert backend.decrypt_many([armored, binary, 'garbage'], recipient, u'pässphrase',
+                                homedir) == [u'sécret', u'sécret', None]
+    assert backend.decrypt(armored, recipient, 'wrong', homedir) == ''
+
+
+def test_decrypt_message_refuses_data_without_integrity_protection(homedir):
+    backend = openpgp.OpenPGPBackend()
+    keys = backend.unlocked(homedir, u'pässphrase')
+    message = openpgp.encrypt_message(b'secret', keys[0])
+    (_, session_body), (_, protected) = openpgp.read_packets(message)
+    algorithm, session = openpgp.session_key(session_body, keys)
+    size = openpgp.block_size(algorithm)
+    prefix = b'p' * size + b'pp'
+    literal = openpgp.packet(11, b'b\0\0\0\0\0secret')
+    head = openpgp.cfb(algorithm, session, b'\0' * size, prefix, decrypt=False)
+    unprotected = head + openpgp.cfb(algorithm, session, head[2:], literal, decrypt=False)
+
+    assert openpgp.decrypt_message(message, keys) == b'secret'
+    with pytest.raises(ValueError):
+        openpgp.decrypt_message(openpgp.packet(1, session_body) +
+                                openpgp.packet(9, unprotected), keys)
+    with pytest.raises(ValueError):
+        openpgp.decrypt_message(openpgp.packet(1, session_body) +
+                                openpgp.packet(18, b'\x02' + protected[1:]), keys)
+
+
+def test_openpgp_backend_encrypt_raises_value_error_for_unknown_recipient(homedir, tmpdir):
+    backend = openpgp.OpenPGPBackend()
+
+    assert backend.encrypt('data', 'passpie@local', homedir) != ''
+    with pytest.raises(ValueError):
+        backend.encrypt('data', 'nobody@example.com', homedir)
+    with pytest.raises(ValueError):
+        backend.encrypt('data', None, str(tmpdir.mkdir('empty')))
+
+
+def test_use_openpgp_raises_value_error_without_usable_keys_file(keys_path, tmpdir):
+    assert passpie.crypt.use('openpgp', keyring=keys_path).name == 'openpgp'
+    tmpdir.join('public.keys').write(openpgp.enarmor('PUBLIC KEY BLOCK', b''))
+    for keyring in (str(tmpdir.join('missing.keys')), str(tmpdir.join('public.keys'))):
+        with pytest.raises(ValueError):
+            passpie.crypt.use('openpgp', keyring=keyring)
+    passpie.crypt.use('gpg')
+
+
+@pytest.mark.skipif(not which('gpg'), reason='gpg is not installed')
+def test_openpgp_and_gpg_backends_read_each_other_messages_and_keys(keys_path, homedir, tmpdir):
+    gpg, backend = GPGBackend(), openpgp.OpenPGPBackend()
+    gpg_homedir = gpg.import_keys(keys_path, str(tmpdir.mkdir('gnupg')))
+    recipient = gpg.get_default_recipient(gpg_homedir)
+
+    assert recipient == backend.get_default_recipient(homedir)
+    for armor in (True, False):
+        from_gpg = gpg.encrypt(u'sécret', recipient, gpg_homedir, armor=armor)
+        assert backend.decrypt(from_gpg, recipient, u'pässphrase', homedir) == u'sécret'
+    from_openpgp = backend.encrypt(u'sécret', recipient, homedir)
+    assert gpg.decrypt(from_openpgp, recipient, u'pässphrase', gpg_homedir) == u'sécret'
+
+
+@pytest.mark.skipif(not which('gpg'), reason='gpg is not installed')
+@pytest.mark.parametrize('key_type,subkey_type', [('DSA', 'ELG-E'), ('RSA', 'RSA')])
+def test_openpgp_backend_reads_keys_and_messages_of_gpg(tmpdir, key_type, subkey_type):
+    gpg, backend = GPGBackend(), openpgp.OpenPGPBackend()
+    gpg_homedir = str(tmpdir.mkdir('gnupg'))
+    key_input = passpie.crypt.KEY_INPUT.replace('DSA', key_type).replace('ELG-E', subkey_type)
+    process.call([which('gpg'), '--batch', '--no-tty', '--homedir', gpg_homedir, '--gen-key'],
+                 input=key_input.format(1024, u'pässphrase'))
+    keys_path = tmpdir.join('.keys')
+    keys_path.write(passpie.crypt.export_keys(gpg_homedir) +
+                    passpie.crypt.export_secret_keys(gpg_homedir, u'pässphrase'))
+    homedir = backend.import_keys(str(keys_path), str(tmpdir.mkdir('homedir')))
+    recipient = gpg.get_default_recipient(gpg_homedir)
+
+    assert recipient == backend.get_default_recipient(homedir)
+    for armor in (True, False):
+        from_gpg = gpg.encrypt(u'sécret', recipient, gpg_homedir, armor=armor)
+        assert backend.decrypt(from_gpg, recipient, u'pässphrase', homedir) == u'sécret'
+        from_openpgp = backend.encrypt(u'sécret', recipient, homedir, armor=armor)
+        assert gpg.decrypt(from_openpgp, recipient, u'pässphrase', gpg_homedir) == u'sécret'
@@ -65,3 +65,16 @@ def test_call_output_and_error_doesnt_decode_in_case_of_unicode(mocker, mock_pop
 
     assert result_output == output
     assert result_error == error
+
+
+def test_call_output_is_not_decoded_when_binary(mocker, mock_popen):
+    MockProc = mocker.patch('passpie.process.Proc')
+    output = mocker.MagicMock()
+    error = mocker.MagicMock()
+    MockProc().__enter__.return_value.communicate.return_value = (output, error)
+
+    result_output, result_error = call(['echo', 'hello'], binary=True)
+
+    assert output.decode.called is False
+    assert result_output == output
+    assert result_error == error.decode('utf-8')
@@ -1,7 +1,10 @@
+import fcntl
+import os
 import re
 import pytest
 
-from passpie.utils import genpass, mkdir_open, ensure_dependencies, touch
+from passpie.utils import (genpass, mkdir_open, replace_open, ensure_dependencies, touch,
+                           FileLock, chunked)
 
 
 def mock_open():
@@ -47,6 +50,23 @@ def test_mkdir_open_handle_oserror_for_file_exist(mocker):
             pass
 
 
+def test_replace_open_replaces_path_on_success_and_keeps_it_on_error(tmpdir):
+    path = tmpdir.join('export.yml')
+    path.write('old')
+
+    with pytest.raises(ValueError):
+        with replace_open(str(path)) as f:
+            f.write(u'partial')
+            raise ValueError('failed')
+    assert path.read() == 'old'
+    assert tmpdir.listdir() == [path]
+
+    with replace_open(str(path)) as f:
+        f.write(u'new')
+    assert path.read() == 'new'
+    assert tmpdir.listdir() == [path]
+
+
 def test_ensure_dependencies_raises_runtime_when_gpg_not_installed(mocker):
     mocker.patch('passpie.utils.which', return_value=None)
 
@@ -65,3 +85,49 @@ def test_touch_open_file_on_path(mocker):
 
     assert mock_builtin_open.called
     mock_builtin_open.assert_called_once_with(path, 'w')
+
+
+def locked_by_other_process(path, operation):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return False
+    except (IOError, OSError):
+        return True
+    finally:
+        os.close(fd)
+
+
+def test_file_lock_shared_allows_readers_and_exclusive_blocks_them(tmpdir):
+    lock = FileLock(str(tmpdir))
+
+    with lock.shared():
+        assert locked_by_other_process(str(tmpdir), fcntl.LOCK_SH) is False
+        assert locked_by_other_process(str(tmpdir), fcntl.LOCK_EX) is True
+        with lock.exclusive():
+            assert lock.mode == "exclusive"
+            assert locked_by_other_process(str(tmpdir), fcntl.LOCK_SH) is True
+            with lock.shared():
+                assert lock.mode == "exclusive"
+        assert lock.fd is not None
+
+    assert lock.fd is None
+    assert locked_by_other_process(str(tmpdir), fcntl.LOCK_EX) is False
+
+
+def test_file_lock_logs_wait_time_and_skips_missing_path(mocker, tmpdir):
+    mock_logging = mocker.patch('passpie.utils.logging')
+
+    with FileLock(str(tmpdir.join('missing'))).exclusive() as lock:
+        assert lock.fd is None
+    assert mock_logging.debug.called is False
+
+    with FileLock(str(tmpdir)).exclusive():
+        pass
+    message = mock_logging.debug.call_args[0][0]
+    assert message.startswith('waited') and 'exclusive lock on' in message
+
+
+def test_chunked_yields_lists_of_size_items():
+    assert list(chunked(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []